@@ -0,0 +1,67 @@
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+
+from benchmarks.load import DEFAULT_PATHS, print_results, run_load
+
+
+def wait_until_ready(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            httpx.get(url + "/categories?limit=1", timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not start")
+
+
+def bench_mode(mode, args):
+    url = f"http://127.0.0.1:{args.port}"
+    env = dict(os.environ, DB_MODE=mode)
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "main:app",
+            "--port",
+            str(args.port),
+            "--workers",
+            str(args.workers),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+    )
+    try:
+        wait_until_ready(url)
+        return asyncio.run(
+            run_load(url, args.paths or DEFAULT_PATHS, args.concurrency, args.duration)
+        )
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare requests/sec of the sync and async database modes."
+    )
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--path", action="append", dest="paths")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=15)
+    args = parser.parse_args()
+
+    for mode in ("sync", "async"):
+        print_results(
+            bench_mode(mode, args),
+            f"\nDB_MODE={mode}, concurrency {args.concurrency}",
+        )
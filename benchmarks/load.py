@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import time
+from typing import Any, Callable, NamedTuple, Optional, Union
+
+import httpx
+
+
+class Case(NamedTuple):
+    # One kind of request. url and body may be callables of a running counter,
+    # so successive requests can vary their ids or create unique names.
+    label: str
+    method: str
+    url: Union[str, Callable[[int], str]]
+    body: Optional[Union[Any, Callable[[int], Any]]] = None
+
+    def build(self, n):
+        url = self.url(n) if callable(self.url) else self.url
+        body = self.body(n) if callable(self.body) else self.body
+        return url, body
+
+
+def as_case(spec):
+    # Plain paths are GET requests labelled with the path
+    return spec if isinstance(spec, Case) else Case(spec, "GET", spec)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, round(pct / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+async def run_load(base_url, paths, concurrency, duration, warmup=1.0):
+    # Each worker keeps exactly one request in flight and cycles through paths,
+    # so the server sees a fixed concurrency for the whole run
+    cases = [as_case(spec) for spec in paths]
+    latencies = {case.label: [] for case in cases}
+    errors = {case.label: 0 for case in cases}
+    counter = iter(range(1 << 62))
+    limits = httpx.Limits(
+        max_connections=concurrency, max_keepalive_connections=concurrency
+    )
+    async with httpx.AsyncClient(
+        base_url=base_url, timeout=60, limits=limits
+    ) as client:
+
+        async def worker(offset, until, record):
+            i = offset
+            while time.perf_counter() < until:
+                case = cases[i % len(cases)]
+                i += 1
+                url, body = case.build(next(counter))
+                start = time.perf_counter()
+                try:
+                    response = await client.request(case.method, url, json=body)
+                    ok = response.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                if not record:
+                    continue
+                if ok:
+                    latencies[case.label].append(time.perf_counter() - start)
+                else:
+                    errors[case.label] += 1
+
+        if warmup:
+            until = time.perf_counter() + warmup
+            await asyncio.gather(*(worker(n, until, False) for n in range(concurrency)))
+        started = time.perf_counter()
+        until = started + duration
+        await asyncio.gather(*(worker(n, until, True) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    results = {}
+    for label in latencies:
+        values = sorted(latencies[label])
+        results[label] = {
+            "requests": len(values),
+            "errors": errors[label],
+            "rps": len(values) / elapsed,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+    return results
+
+
+def print_results(results, title=None):
+    if title:
+        print(title)
+    print(
+        f"{'path':48} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}"
+    )
+    for path, stats in results.items():
+        print(
+            f"{path[:48]:48} {stats['rps']:9.1f} {stats['p50_ms']:8.1f} "
+            f"{stats['p95_ms']:8.1f} {stats['p99_ms']:8.1f} {stats['errors']:7d}"
+        )
+    total = sum(stats["rps"] for stats in results.values())
+    print(f"{'total':48} {total:9.1f}")
+
+
+DEFAULT_PATHS = [
+    "/categories",
+    "/products?limit=20",
+    "/inventory/stock/low-stock",
+    "/sales?limit=50",
+    "/sales/revenue?group_by=month",
+]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Drive a running API at a fixed concurrency and report latency."
+    )
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--path", action="append", dest="paths")
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=15)
+    args = parser.parse_args()
+
+    results = asyncio.run(
+        run_load(args.url, args.paths or DEFAULT_PATHS, args.concurrency, args.duration)
+    )
+    print_results(results)
@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from datetime import date, timedelta
+
+import httpx
+
+from benchmarks.load import Case, print_results, run_load
+
+# Compared metrics; higher rps is better, lower latency is better
+TRACKED = {"rps": 1, "p50_ms": -1, "p95_ms": -1, "p99_ms": -1}
+
+
+def sample_data(url):
+    # Ids and dates to parameterize requests with, read through the API itself
+    with httpx.Client(base_url=url, timeout=60) as client:
+        categories = [c["id"] for c in client.get("/categories?limit=50").json()]
+        listed = client.get("/products?limit=200").json()
+        products = [p["id"] for p in listed]
+        # Two word queries, e.g. "Wireless Headphones", as a shopper would type
+        phrases = [" ".join(p["name"].split()[:2]) for p in listed]
+        inventory = []
+        for product_id in products[:20]:
+            inventory.extend(client.get(f"/inventory?product_id={product_id}").json())
+        months = client.get("/sales/revenue?group_by=month").json()
+    if not (categories and products and inventory and months):
+        raise SystemExit(
+            "Seed the database first, e.g. python -m database.generate_data"
+        )
+    last = date.fromisoformat(months[-1]["period"])
+    return {
+        "categories": categories,
+        "products": products,
+        "phrases": phrases,
+        "inventory": inventory,
+        "last_month": last,
+    }
+
+
+def read_cases(data):
+    products = data["products"]
+    categories = data["categories"]
+    inventory = data["inventory"]
+    phrases = data["phrases"]
+    end = data["last_month"]
+    start = end - timedelta(days=90)
+    window = f"start_date={start}&end_date={end}"
+
+    def pick(values, n):
+        return values[n % len(values)]
+
+    return [
+        Case("GET /categories", "GET", "/categories?limit=100"),
+        Case("GET /products", "GET", "/products?limit=100"),
+        Case(
+            "GET /products?expand",
+            "GET",
+            "/products?limit=100&expand=category,inventory",
+        ),
+        Case(
+            "GET /products/search",
+            "GET",
+            lambda n: f"/products/search?limit=20&q={pick(phrases, n)}",
+        ),
+        Case(
+            "GET /products/search?prefix",
+            "GET",
+            lambda n: f"/products/search?limit=10&prefix=true"
+            f"&q={pick(phrases, n)[:-3]}&category_id={pick(categories, n)}",
+        ),
+        Case("GET /products/{id}", "GET", lambda n: f"/products/{pick(products, n)}"),
+        Case(
+            "GET /inventory?product_id",
+            "GET",
+            lambda n: f"/inventory?product_id={pick(products, n)}",
+        ),
+        Case(
+            "GET /inventory/{id}",
+            "GET",
+            lambda n: f"/inventory/{pick(inventory, n)['id']}",
+        ),
+        Case("GET /inventory/stock/low-stock", "GET", "/inventory/stock/low-stock"),
+        Case("GET /inventory/forecast", "GET", "/inventory/forecast?limit=100"),
+        Case("GET /sales", "GET", f"/sales?limit=100&{window}"),
+        Case("GET /sales?total", "GET", f"/sales?limit=100&{window}&total=true"),
+        Case(
+            "GET /sales?channel",
+            "GET",
+            lambda n: f"/sales?limit=100&{window}&channel={pick(inventory, n)['channel']}",
+        ),
+        Case(
+            "GET /sales?product_id",
+            "GET",
+            lambda n: f"/sales?limit=100&{window}&product_id={pick(products, n)}",
+        ),
+        Case(
+            "GET /sales/export",
+            "GET",
+            f"/sales/export?format=ndjson&start_date={end}&end_date={end}",
+        ),
+        Case("GET /sales/revenue", "GET", f"/sales/revenue?group_by=month&{window}"),
+        Case(
+            "GET /sales/revenue?category_id",
+            "GET",
+            lambda n: f"/sales/revenue?{window}&category_id={pick(categories, n)}",
+        ),
+        Case(
+            "GET /sales/compare",
+            "GET",
+            f"/sales/compare?start1={end - timedelta(days=30)}&end1={end}"
+            f"&start2={end - timedelta(days=395)}&end2={end - timedelta(days=365)}",
+        ),
+        Case("GET /diagnostics/pool", "GET", "/diagnostics/pool"),
+        Case("GET /diagnostics/cache", "GET", "/diagnostics/cache"),
+        Case("GET /diagnostics/cube", "GET", "/diagnostics/cube"),
+        Case("GET /metrics", "GET", "/metrics"),
+    ]
+
+
+def write_cases(data):
+    # Writes change the data set, so they only run with --writes
+    products = data["products"]
+    categories = data["categories"]
+    inventory = data["inventory"]
+    run = int(time.time())
+
+    def pick(values, n):
+        return values[n % len(values)]
+
+    return [
+        Case(
+            "POST /categories",
+            "POST",
+            "/categories",
+            lambda n: {"name": f"bench {run} {n}"},
+        ),
+        Case(
+            "POST /products",
+            "POST",
+            "/products",
+            lambda n: {
+                "name": f"bench {n}",
+                "price": 9.99,
+                "category_id": pick(categories, n),
+            },
+        ),
+        Case(
+            "POST /inventory",
+            "POST",
+            "/inventory",
+            lambda n: {
+                "product_id": pick(products, n),
+                "channel": f"bench {run} {n}",
+                "quantity": 100,
+                "reorder_level": 10,
+            },
+        ),
+        Case(
+            "PUT /inventory/{id}",
+            "PUT",
+            lambda n: f"/inventory/{pick(inventory, n)['id']}",
+            {"quantity": 1000, "comment": "benchmark"},
+        ),
+        Case(
+            "POST /inventory/adjust",
+            "POST",
+            "/inventory/adjust",
+            lambda n: [
+                {"inventory_id": pick(inventory, n)["id"], "delta": 1 - 2 * (n % 2)}
+            ],
+        ),
+        Case(
+            "POST /sales/ingest",
+            "POST",
+            "/sales/ingest",
+            lambda n: {
+                "product_id": pick(inventory, n)["product_id"],
+                "channel": pick(inventory, n)["channel"],
+                "quantity": 1,
+                "price": 9.99,
+                "sale_date": f"{date.today()}T12:00:00",
+            },
+        ),
+        Case(
+            "POST /sales/bulk",
+            "POST",
+            "/sales/bulk",
+            lambda n: [
+                {
+                    "product_id": item["product_id"],
+                    "channel": item["channel"],
+                    "quantity": 1,
+                    "price": 9.99,
+                    "sale_date": f"{date.today()}T12:00:00",
+                }
+                for item in (pick(inventory, n + k) for k in range(10))
+            ],
+        ),
+    ]
+
+
+def uncovered_routes(cases):
+    # Routes declared in routers/ that no case exercises
+    from routers import catalog, categories, diagnostics, inventory, products, sales
+
+    labels = {case.label.split("?")[0].replace("{id}", "") for case in cases}
+    missing = []
+    for module in (categories, catalog, products, inventory, sales, diagnostics):
+        for route in module.router.routes:
+            for method in route.methods:
+                path = route.path.split("{")[0]
+                if f"{method} {path}" not in labels:
+                    missing.append(f"{method} {route.path}")
+    return missing
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    # Print the change of every tracked metric and return the regressions
+    regressions = []
+    print(f"\nAgainst baseline {baseline.get('commit')} ({baseline.get('timestamp')})")
+    for label, stats in results.items():
+        before = baseline["results"].get(label)
+        if not before:
+            continue
+        changes = []
+        for metric, direction in TRACKED.items():
+            if not before[metric]:
+                continue
+            change = (stats[metric] - before[metric]) / before[metric] * 100
+            changes.append(f"{metric} {change:+.0f}%")
+            if change * direction < -threshold:
+                regressions.append(f"{label}: {metric} {change:+.0f}%")
+        print(f"{label[:48]:48} {', '.join(changes)}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load test every API route and track latency across runs."
+    )
+    parser.add_argument("--url", default="http://localhost:8001")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument(
+        "--writes", action="store_true", help="include routes that change data"
+    )
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--baseline", help="compare against an earlier --json file")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=20,
+        help="percent change of a metric counted as a regression",
+    )
+    args = parser.parse_args()
+
+    data = sample_data(args.url)
+    cases = read_cases(data)
+    if args.writes:
+        cases += write_cases(data)
+    for route in uncovered_routes(cases):
+        print(f"Not exercised: {route}")
+
+    results = asyncio.run(run_load(args.url, cases, args.concurrency, args.duration))
+    print_results(results, f"\nconcurrency {args.concurrency}, {args.duration:g}s")
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "results": results,
+    }
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+import serialization
+from main import app
+from pagination import NEXT_CURSOR_HEADER
+
+# /categories and /products always take the column path, see etags
+PATHS = (
+    "/inventory",
+    "/sales?limit={limit}",
+)
+
+
+async def measure(client, path, requests):
+    # Best of several rounds, so a stray pause does not skew one side
+    timings = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = await client.get(path)
+        timings.append(time.perf_counter() - started)
+        response.raise_for_status()
+    return min(timings), response
+
+
+async def run(limit, requests):
+    # The app runs in process, so the numbers are server time without network
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+        for template in PATHS:
+            path = template.format(limit=limit)
+            results = {}
+            for fast in (False, True):
+                serialization.FAST_LIST_RESPONSES = fast
+                results[fast] = await measure(client, path, requests)
+            (model_time, model), (fast_time, fast) = results[False], results[True]
+            same_body = json.loads(model.content) == json.loads(fast.content)
+            cursor = NEXT_CURSOR_HEADER.lower()
+            if not same_body or model.headers.get(cursor) != fast.headers.get(cursor):
+                raise SystemExit(f"{path}: fast path response differs")
+            rows = len(json.loads(fast.content))
+            print(
+                f"{path:28} {rows:>6} rows  model {model_time * 1000:7.1f}ms"
+                f"  fast {fast_time * 1000:7.1f}ms  {model_time / fast_time:4.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare list endpoint latency with and without FAST_LIST_RESPONSES."
+    )
+    parser.add_argument("--limit", type=int, default=1000)
+    parser.add_argument("--requests", type=int, default=20)
+    args = parser.parse_args()
+
+    encoder = "orjson" if serialization.orjson is not None else "json"
+    print(f"encoder: {encoder}")
+    asyncio.run(run(args.limit, args.requests))
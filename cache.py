@@ -0,0 +1,257 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import date, datetime
+
+from fastapi import Response
+
+from metrics import REGISTRY, CounterMetric
+
+# Seconds a cached response stays valid; 0 disables the cache
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "60"))
+# Upper bound for the serialized bodies held by the in-process backend
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 << 20)))
+# Optional shared backend, so invalidations reach every worker
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL")
+
+CACHE_EVENTS = CounterMetric(
+    "response_cache_events_total",
+    "Response cache hits, misses, evictions and invalidations.",
+    ("event",),
+)
+REGISTRY.append(CACHE_EVENTS)
+
+
+def _day(value):
+    # The analytics read day-granular rollups, so times of day never matter
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _overlaps(spans, days):
+    # days is sorted, so each span costs one binary search
+    for start, end in spans:
+        i = bisect_left(days, start)
+        if i < len(days) and days[i] <= end:
+            return True
+    return False
+
+
+class LocalBackend:
+    # LRU ordered dict with per-entry expiry, bounded by total body size
+
+    def __init__(self, ttl, max_bytes):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def begin(self):
+        return self.generation
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            body, spans, expires = entry
+            if expires < time.monotonic():
+                self._drop(key)
+                return None
+            self.entries.move_to_end(key)
+            return body
+
+    def set(self, key, body, spans, generation):
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            # An invalidation ran while the body was computed, so it may be stale
+            if generation != self.generation:
+                return
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (body, spans, time.monotonic() + self.ttl)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+                CACHE_EVENTS.inc("eviction")
+
+    def invalidate(self, days):
+        with self.lock:
+            self.generation += 1
+            stale = [
+                key
+                for key, (_, spans, _) in self.entries.items()
+                if _overlaps(spans, days)
+            ]
+            for key in stale:
+                self._drop(key)
+        return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": "local",
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+            }
+
+    def _drop(self, key):
+        body, _, _ = self.entries.pop(key)
+        self.size -= len(body)
+
+
+class RedisBackend:
+    # Shared by every worker. Redis maxmemory with an LRU policy bounds memory;
+    # a sorted set indexes each key with its date spans for range
+    # invalidation, scored by expiry so entries that expired are trimmed.
+
+    def __init__(self, url, ttl, prefix="response-cache:"):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+        self.index = prefix + "spans"
+        self.generation_key = prefix + "generation"
+
+    def begin(self):
+        return self.client.get(self.generation_key)
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, body, spans, generation):
+        if self.client.get(self.generation_key) != generation:
+            return
+        ttl = max(int(self.ttl), 1)
+        # A key always has the same spans, so storing it again moves its
+        # index entry's expiry instead of adding one
+        member = json.dumps(
+            [key, [[start.isoformat(), end.isoformat()] for start, end in spans]]
+        )
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, body, ex=ttl)
+        pipe.zadd(self.index, {member: time.time() + ttl})
+        pipe.execute()
+
+    def invalidate(self, days):
+        self.client.incr(self.generation_key)
+        self.client.zremrangebyscore(self.index, "-inf", time.time())
+        stale = []
+        for member in self.client.zrange(self.index, 0, -1):
+            key, spans = json.loads(member)
+            spans = [
+                (date.fromisoformat(start), date.fromisoformat(end))
+                for start, end in spans
+            ]
+            if _overlaps(spans, days):
+                stale.append((key, member))
+        if stale:
+            pipe = self.client.pipeline()
+            pipe.delete(*(self.prefix + key for key, _ in stale))
+            pipe.zrem(self.index, *(member for _, member in stale))
+            pipe.execute()
+        return len(stale)
+
+    def clear(self):
+        # Every key under the prefix, the index included, whether or not the
+        # index still lists it
+        self.client.incr(self.generation_key)
+        generation_key = self.generation_key.encode()
+        batch = []
+        for key in self.client.scan_iter(match=self.prefix + "*", count=1000):
+            if key != generation_key:
+                batch.append(key)
+            if len(batch) >= 1000:
+                self.client.delete(*batch)
+                batch = []
+        if batch:
+            self.client.delete(*batch)
+
+    def stats(self):
+        self.client.zremrangebyscore(self.index, "-inf", time.time())
+        return {
+            "backend": "redis",
+            "entries": self.client.zcard(self.index),
+            "ttl": self.ttl,
+        }
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def key(self, name, **params):
+        normalized = {
+            param: _day(value).isoformat() if isinstance(value, date) else value
+            for param, value in sorted(params.items())
+        }
+        return name + ":" + json.dumps(normalized, separators=(",", ":"))
+
+    def begin(self):
+        return self.backend.begin() if self.enabled else None
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        body = self.backend.get(key)
+        if body is None:
+            CACHE_EVENTS.inc("miss")
+            return None
+        CACHE_EVENTS.inc("hit")
+        return Response(body, media_type="application/json")
+
+    def store(self, key, data, spans, generation):
+        # Serialize once: the same bytes are sent now and on every later hit
+        body = json.dumps(data, separators=(",", ":")).encode()
+        if self.enabled:
+            spans = [
+                (_day(start) if start else date.min, _day(end) if end else date.max)
+                for start, end in spans
+            ]
+            self.backend.set(key, body, spans, generation)
+        return Response(body, media_type="application/json")
+
+    def invalidate(self, days):
+        # Drop every entry whose date spans contain one of the given days
+        if not self.enabled or not days:
+            return
+        dropped = self.backend.invalidate(sorted(set(days)))
+        CACHE_EVENTS.inc("invalidation", amount=dropped)
+
+    def clear(self):
+        if self.enabled:
+            self.backend.clear()
+
+    def stats(self):
+        if not self.enabled:
+            return {"backend": None}
+        return self.backend.stats()
+
+
+def _make_backend():
+    if RESPONSE_CACHE_TTL <= 0:
+        return None
+    if CACHE_REDIS_URL:
+        return RedisBackend(CACHE_REDIS_URL, RESPONSE_CACHE_TTL)
+    return LocalBackend(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_BYTES)
+
+
+response_cache = ResponseCache(_make_backend())
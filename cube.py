@@ -0,0 +1,445 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import Date, cast, literal, select
+from starlette.concurrency import run_in_threadpool
+
+from database.database import engine
+import database.models as models
+from metrics import COLLECTORS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger("cube")
+
+# Serve /sales/revenue and /sales/compare from in-process NumPy arrays
+CUBE_ENABLED = os.getenv("CUBE_ENABLED", "false").lower() in ("1", "true")
+# Memory bound for the column arrays; the oldest days are evicted beyond it
+CUBE_MAX_BYTES = int(os.getenv("CUBE_MAX_BYTES", str(512 << 20)))
+# Seconds between pulls of sales written by other processes
+CUBE_REFRESH_SECONDS = float(os.getenv("CUBE_REFRESH_SECONDS", "1"))
+# Ids skipped by a refresh may belong to transactions that commit later, so
+# they are looked up again for this long before counting as rolled back
+CUBE_GAP_SECONDS = 60
+CUBE_MAX_GAPS = 10000
+LOAD_BATCH = 100_000
+
+EPOCH = date(1970, 1, 1)
+COLUMNS = (
+    ("day", "int32"),
+    ("product_id", "int32"),
+    ("category_id", "int32"),
+    ("channel", "int16"),
+    ("quantity", "int32"),
+    ("price", "float64"),
+    # quantity * price, kept so queries do not convert and multiply every row
+    ("revenue", "float64"),
+)
+
+SALES_QUERY = select(
+    models.Sale.id,
+    (cast(models.Sale.sale_date, Date) - literal(EPOCH)).label("day"),
+    models.Sale.product_id,
+    models.Product.category_id,
+    models.Sale.channel,
+    models.Sale.quantity,
+    models.Sale.price,
+).join(models.Product, models.Product.id == models.Sale.product_id)
+
+
+def _epoch_day(value):
+    if isinstance(value, datetime):
+        value = value.date()
+    return (value - EPOCH).days
+
+
+def _period_keys(days, group_by):
+    # Epoch day of the period start, matching date_trunc in the SQL path
+    if group_by == "day":
+        return days
+    if group_by == "week":
+        # 1970-01-01 was a Thursday; weeks start on Monday
+        return days - (days + 3) % 7
+    unit = "datetime64[M]" if group_by == "month" else "datetime64[Y]"
+    return (
+        days.astype("datetime64[D]")
+        .astype(unit)
+        .astype("datetime64[D]")
+        .astype(np.int64)
+    )
+
+
+class SalesCube:
+    def __init__(self, max_bytes):
+        self.row_bytes = sum(np.dtype(dtype).itemsize for _, dtype in COLUMNS)
+        self.max_rows = max_bytes // self.row_bytes
+        self.arrays = {name: np.empty(0, dtype) for name, dtype in COLUMNS}
+        self.size = 0
+        self.channels = {}
+        # Rows before this epoch day were evicted; None while history is complete
+        self.first_day = None
+        self.watermark = 0
+        self.gaps = {}
+        # Category of each product id, as of catalog_version; rows take their
+        # category from it again when the catalog changes
+        self.catalog_version = None
+        self.category_map = np.zeros(0, np.int32)
+        self.ready = False
+        self.stale = False
+        self.refreshed_at = None
+        # lock guards the published arrays and size; refresh_lock serializes writers
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def snapshot(self):
+        # Appends only write past size and growth or eviction swaps in new
+        # arrays, so these views stay consistent without holding the lock
+        with self.lock:
+            views = {name: array[: self.size] for name, array in self.arrays.items()}
+            return views, self.first_day
+
+    def mark_stale(self):
+        # Sales were committed by this process; pull them before the next answer
+        self.stale = True
+
+    def refresh(self):
+        with self.refresh_lock:
+            self.stale = False
+            with engine.connect() as conn:
+                # Read first: rows appended below are joined with categories
+                # at least this new
+                version = conn.scalar(select(models.CatalogVersion.version))
+                if self.gaps:
+                    late = conn.execute(
+                        SALES_QUERY.where(models.Sale.id.in_(list(self.gaps)))
+                    ).all()
+                    for row in late:
+                        self.gaps.pop(row[0], None)
+                    self._append(late)
+                    expired = time.monotonic() - CUBE_GAP_SECONDS
+                    self.gaps = {i: t for i, t in self.gaps.items() if t > expired}
+                result = conn.execution_options(yield_per=LOAD_BATCH).execute(
+                    SALES_QUERY.where(models.Sale.id > self.watermark).order_by(
+                        models.Sale.id
+                    )
+                )
+                for rows in result.partitions():
+                    self._track_gaps(rows)
+                    self._append(rows)
+                if version != self.catalog_version:
+                    self._recategorize(conn)
+                self.catalog_version = version
+            self.refreshed_at = datetime.now()
+            if not self.ready:
+                logger.info("Sales cube loaded %d rows", self.size)
+            self.ready = True
+
+    def _recategorize(self, conn):
+        # A catalog write may have moved products to other categories, which
+        # the rows captured when they were loaded. The first load also takes
+        # them from the map, which may be newer than the rows' join.
+        rows = conn.execute(select(models.Product.id, models.Product.category_id)).all()
+        ids, categories = (
+            (np.array(column, np.int64) for column in zip(*rows))
+            if rows
+            else (np.zeros(0, np.int64), np.zeros(0, np.int64))
+        )
+        mapping = np.full(int(ids.max()) + 1 if len(ids) else 0, -1, np.int32)
+        mapping[ids] = categories
+        known = min(len(mapping), len(self.category_map))
+        moved = not self.ready or not np.array_equal(
+            mapping[:known], self.category_map[:known]
+        )
+        self.category_map = mapping
+        if not moved:
+            return
+        # Products are never deleted, so every row's product is in the map
+        category_ids = np.empty(len(self.arrays["category_id"]), np.int32)
+        category_ids[: self.size] = mapping[self.arrays["product_id"][: self.size]]
+        with self.lock:
+            self.arrays = dict(self.arrays, category_id=category_ids)
+        logger.info("Sales cube took product categories from catalog changes")
+
+    def _track_gaps(self, rows):
+        ids = np.fromiter((row[0] for row in rows), np.int64, len(rows))
+        previous = np.concatenate(([self.watermark], ids[:-1]))
+        jumps = ids - previous > 1
+        now = time.monotonic()
+        for before, after in zip(previous[jumps].tolist(), ids[jumps].tolist()):
+            for missing in range(before + 1, after):
+                self.gaps[missing] = now
+        # Ids are added in ascending order; the newest ones are kept
+        for missing in list(self.gaps)[: max(len(self.gaps) - CUBE_MAX_GAPS, 0)]:
+            del self.gaps[missing]
+        self.watermark = int(ids[-1])
+
+    def _append(self, rows):
+        if not rows:
+            return
+        _, days, product_ids, category_ids, channels, quantities, prices = zip(*rows)
+        codes = [
+            self.channels.setdefault(name, len(self.channels)) for name in channels
+        ]
+        batch = {
+            "day": np.array(days, np.int32),
+            "product_id": np.array(product_ids, np.int32),
+            "category_id": np.array(category_ids, np.int32),
+            "channel": np.array(codes, np.int16),
+            "quantity": np.array(quantities, np.int32),
+            "price": np.array(prices, np.float64),
+        }
+        batch["revenue"] = batch["quantity"] * batch["price"]
+        if self.first_day is not None:
+            keep = batch["day"] >= self.first_day
+            batch = {name: values[keep] for name, values in batch.items()}
+        count = len(batch["day"])
+        if self.size + count > self.max_rows:
+            self._evict(batch["day"])
+            keep = batch["day"] >= self.first_day
+            batch = {name: values[keep] for name, values in batch.items()}
+            count = len(batch["day"])
+        if self.size + count > len(self.arrays["day"]):
+            self._grow(self.size + count)
+        for name, values in batch.items():
+            self.arrays[name][self.size : self.size + count] = values
+        with self.lock:
+            self.size += count
+
+    def _grow(self, needed):
+        capacity = min(max(needed, 2 * len(self.arrays["day"]), 1024), self.max_rows)
+        arrays = {}
+        for name, dtype in COLUMNS:
+            arrays[name] = np.empty(capacity, dtype)
+            arrays[name][: self.size] = self.arrays[name][: self.size]
+        with self.lock:
+            self.arrays = arrays
+
+    def _evict(self, incoming):
+        # Drop the oldest days so the rows kept, incoming ones included, fill at
+        # most 90% of the bound; queries reaching before first_day go to SQL
+        days = self.arrays["day"][: self.size]
+        combined = np.concatenate((days, incoming))
+        keep = int(self.max_rows * 0.9)
+        # Every row of the cutoff day goes, so whole days are either in or out
+        cutoff = int(np.partition(combined, len(combined) - keep)[len(combined) - keep])
+        mask = days > cutoff
+        arrays = {}
+        for name, dtype in COLUMNS:
+            arrays[name] = np.empty(len(self.arrays[name]), dtype)
+            kept = self.arrays[name][: self.size][mask]
+            arrays[name][: len(kept)] = kept
+        with self.lock:
+            self.arrays = arrays
+            self.size = int(mask.sum())
+            self.first_day = cutoff + 1
+        logger.warning(
+            "Sales cube evicted days before %s", EPOCH + timedelta(cutoff + 1)
+        )
+
+    def _daily(self, start_date, end_date, product_id, category_id, channel):
+        # Revenue and row count per day of the filtered rows, as (first day,
+        # sums, counts), or None when the cube cannot answer and SQL must
+        if not self.ready:
+            return None
+        if self.stale:
+            self.refresh()
+        views, first_day = self.snapshot()
+        start = _epoch_day(start_date) if start_date else None
+        if first_day is not None and (start is None or start < first_day):
+            return None
+        conditions = []
+        if start is not None:
+            conditions.append(views["day"] >= start)
+        if end_date:
+            conditions.append(views["day"] <= _epoch_day(end_date))
+        if product_id:
+            conditions.append(views["product_id"] == product_id)
+        if category_id:
+            conditions.append(views["category_id"] == category_id)
+        if channel:
+            if channel not in self.channels:
+                return 0, np.zeros(0), np.zeros(0, np.int64)
+            conditions.append(views["channel"] == self.channels[channel])
+        days, revenue = views["day"], views["revenue"]
+        if conditions:
+            rows = np.flatnonzero(np.logical_and.reduce(conditions))
+            days, revenue = days[rows], revenue[rows]
+        if not len(days):
+            return 0, np.zeros(0), np.zeros(0, np.int64)
+        # Summing per day first keeps the rest of the work proportional to
+        # the number of days rather than rows
+        low = int(days.min())
+        offsets = days - low
+        return (
+            low,
+            np.bincount(offsets, weights=revenue),
+            np.bincount(offsets),
+        )
+
+    def revenue_by_period(self, filters, group_by="day"):
+        # Same rows as crud.revenue_by_period: (period start, revenue)
+        daily = self._daily(**filters)
+        if daily is None:
+            return None
+        low, sums, counts = daily
+        present = np.flatnonzero(counts)
+        periods, inverse = np.unique(
+            _period_keys(present + low, group_by), return_inverse=True
+        )
+        totals = np.bincount(inverse, weights=sums[present], minlength=len(periods))
+        return [
+            (datetime.combine(EPOCH + timedelta(period), datetime.min.time()), total)
+            for period, total in zip(periods.tolist(), totals.tolist())
+        ]
+
+    def compare_ranges(self, ranges, filters):
+        # Same rows as crud.compare_ranges: (label, day, revenue), zero filled
+        first = min(start for start, _ in ranges)
+        last = max(end for _, end in ranges)
+        daily = self._daily(first, last, **filters)
+        if daily is None:
+            return None
+        low, sums, _ = daily
+        rows = []
+        for label, (start, end) in enumerate(ranges, 1):
+            for offset in range((end - start).days + 1):
+                index = _epoch_day(start) + offset - low
+                revenue = float(sums[index]) if 0 <= index < len(sums) else 0.0
+                rows.append((label, start + timedelta(offset), revenue))
+        return rows
+
+    def stats(self):
+        with self.lock:
+            capacity = len(self.arrays["day"])
+            return {
+                "ready": self.ready,
+                "rows": self.size,
+                "capacity": capacity,
+                "max_rows": self.max_rows,
+                "bytes": capacity * self.row_bytes,
+                "max_bytes": self.max_rows * self.row_bytes,
+                "first_day": (
+                    (EPOCH + timedelta(self.first_day)).isoformat()
+                    if self.first_day is not None
+                    else None
+                ),
+                "watermark": self.watermark,
+                "pending_gaps": len(self.gaps),
+                "refreshed_at": (
+                    self.refreshed_at.isoformat() if self.refreshed_at else None
+                ),
+            }
+
+    def metric_lines(self):
+        stats = self.stats()
+        return [
+            "# HELP sales_cube_rows Sales rows held by the analytics cube.",
+            "# TYPE sales_cube_rows gauge",
+            f"sales_cube_rows {stats['rows']}",
+            "# HELP sales_cube_bytes Memory allocated for the cube column arrays.",
+            "# TYPE sales_cube_bytes gauge",
+            f"sales_cube_bytes {stats['bytes']}",
+        ]
+
+    async def run(self, interval):
+        # Initial load, then periodic pulls of sales committed elsewhere
+        while True:
+            try:
+                await run_in_threadpool(self.refresh)
+            except Exception:
+                logger.exception("Sales cube refresh failed")
+            await asyncio.sleep(interval)
+
+
+def verify(db, cube):
+    # Answer sample queries through the cube and the SQL rollup path and report
+    # any difference beyond float summation noise
+    from database import crud
+
+    last = (
+        db.query(models.SalesDaily.day).order_by(models.SalesDaily.day.desc()).first()
+    )
+    end = last[0] if last else date.today()
+    channel = next(iter(cube.channels), None)
+    start = datetime.combine(end - timedelta(days=60), datetime.min.time())
+    stop = datetime.combine(end, datetime.min.time())
+    # Whole history checks cover what the cube holds after evictions
+    held = {}
+    if cube.first_day is not None:
+        held["start_date"] = datetime.combine(
+            EPOCH + timedelta(cube.first_day), datetime.min.time()
+        )
+    checks = [
+        ("revenue by month", "revenue", held, "month"),
+        ("revenue by week", "revenue", dict(held, channel=channel), "week"),
+        ("revenue by day", "revenue", {"start_date": start, "end_date": stop}, "day"),
+        ("compare", "compare", {"channel": channel}, None),
+    ]
+    mismatches = []
+    for name, kind, filters, group_by in checks:
+        if kind == "revenue":
+            filters = dict(
+                dict.fromkeys(
+                    ("start_date", "end_date", "product_id", "category_id", "channel")
+                ),
+                **filters,
+            )
+            expected = crud.revenue_by_period(db, filters, group_by)
+            actual = cube.revenue_by_period(filters, group_by)
+        else:
+            ranges = [
+                (end - timedelta(days=30), end),
+                (end - timedelta(days=395), end - timedelta(days=365)),
+            ]
+            filters = dict(dict.fromkeys(("product_id", "category_id")), **filters)
+            expected = crud.compare_ranges(db, ranges, filters)
+            actual = cube.compare_ranges(ranges, filters)
+        if actual is None:
+            mismatches.append({"check": name, "detail": "not answerable by the cube"})
+            continue
+        expected = [tuple(row) for row in expected]
+        keys_match = [row[:-1] for row in expected] == [row[:-1] for row in actual]
+        values_match = keys_match and np.allclose(
+            [float(row[-1]) for row in expected],
+            [row[-1] for row in actual],
+            rtol=1e-9,
+            atol=1e-6,
+        )
+        if not values_match:
+            mismatches.append(
+                {
+                    "check": name,
+                    "detail": f"{len(expected)} SQL rows vs {len(actual)} cube rows",
+                }
+            )
+    return {"checks": len(checks), "mismatches": mismatches}
+
+
+class DisabledCube:
+    ready = False
+
+    def mark_stale(self):
+        pass
+
+    def stats(self):
+        return {"ready": False, "enabled": False}
+
+
+def _make_cube():
+    if not CUBE_ENABLED:
+        return DisabledCube()
+    if np is None:
+        raise RuntimeError("CUBE_ENABLED requires numpy (pip install numpy)")
+    cube = SalesCube(CUBE_MAX_BYTES)
+    COLLECTORS.append(cube.metric_lines)
+    return cube
+
+
+analytics_cube = _make_cube()
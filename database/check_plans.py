@@ -0,0 +1,185 @@
+import argparse
+import json
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import event, func, select, text
+
+from database import crud
+from database.database import SessionLocal, engine, init_db
+import database.models as models
+
+
+def sample_parameters(db):
+    # Parameters for the read cases, taken from the data
+    product_id = db.scalar(select(func.min(models.Product.id))) or 1
+    category_id = db.scalar(select(func.min(models.Category.id))) or 1
+    channel = db.scalar(select(func.min(models.Inventory.channel))) or "online"
+    name = db.scalar(select(models.Product.name).where(models.Product.id == product_id))
+    last = db.scalar(select(func.max(models.Sale.sale_date))) or datetime.now()
+    start = last - timedelta(days=30)
+    return SimpleNamespace(
+        product_id=product_id,
+        category_id=category_id,
+        channel=channel,
+        word=(name or "product").split()[0],
+        start=start,
+        end=last,
+        after=(start, 0),
+    )
+
+
+# The read queries behind the routers, each run with a session and the
+# sample parameters
+READ_CASES = {
+    "list categories": lambda db, p: crud.list_categories(db, p.category_id, 101),
+    "get category": lambda db, p: crud.get_category(db, p.category_id),
+    "list products": lambda db, p: crud.list_products(db, p.product_id, 101),
+    "get product": lambda db, p: crud.get_product(db, p.product_id),
+    "list products expanded": lambda db, p: crud.list_products(
+        db, p.product_id, 101, None, ("category", "inventory")
+    ),
+    "search products": lambda db, p: crud.search_products(
+        db, p.word, ("id",), False, None, None, 101
+    ),
+    "search products by prefix and category": lambda db, p: crud.search_products(
+        db, p.word[:3], ("id",), True, p.category_id, (0.1, p.product_id), 101
+    ),
+    "product sales summaries": lambda db, p: crud.product_sales_summaries(
+        db, list(range(p.product_id, p.product_id + 100)), p.start, p.end
+    ),
+    "list inventory by product": lambda db, p: crud.list_inventory(db, p.product_id),
+    "list inventory by channel": lambda db, p: crud.list_inventory(db, None, p.channel),
+    "get inventory": lambda db, p: crud.get_inventory(db, 1),
+    "low stock": lambda db, p: crud.list_low_stock(db),
+    "inventory as of": lambda db, p: crud.inventory_as_of(db, p.start, p.product_id),
+    "daily units for forecast": lambda db, p: crud.daily_units(
+        db, p.start.date(), p.end.date()
+    ),
+    "sales page": lambda db, p: crud.list_sales(db, {}, p.after, 101),
+    "sales by date range": lambda db, p: crud.list_sales(
+        db, {"start_date": p.start, "end_date": p.end}, None, 101
+    ),
+    "sales by channel and date range": lambda db, p: crud.list_sales(
+        db,
+        {"start_date": p.start, "end_date": p.end, "channel": p.channel},
+        p.after,
+        101,
+    ),
+    "sales by product and date range": lambda db, p: crud.list_sales(
+        db,
+        {"start_date": p.start, "end_date": p.end, "product_id": p.product_id},
+        p.after,
+        101,
+    ),
+    "sales by category and date range": lambda db, p: crud.list_sales(
+        db, {"start_date": p.start, "end_date": p.end, "category_id": p.category_id}
+    ),
+    "count sales by channel and date range": lambda db, p: crud.count_sales(
+        db, start_date=p.start, end_date=p.end, channel=p.channel
+    ),
+    "count inventory by product": lambda db, p: crud.count_inventory(db, p.product_id),
+    "revenue by date range": lambda db, p: crud.revenue_by_period(
+        db, {"start_date": p.start, "end_date": p.end}, "month"
+    ),
+    "revenue by product": lambda db, p: crud.revenue_by_period(
+        db, {"start_date": p.start, "end_date": p.end, "product_id": p.product_id}
+    ),
+    "revenue by channel": lambda db, p: crud.revenue_by_period(
+        db, {"start_date": p.start, "end_date": p.end, "channel": p.channel}
+    ),
+    "revenue by category": lambda db, p: crud.revenue_by_period(
+        db, {"start_date": p.start, "end_date": p.end, "category_id": p.category_id}
+    ),
+    "compare ranges": lambda db, p: crud.compare_ranges(
+        db,
+        [
+            (p.start.date(), p.end.date()),
+            (p.start.date() - timedelta(days=365), p.end.date() - timedelta(days=365)),
+        ],
+        {"channel": p.channel},
+    ),
+}
+
+
+def unindexed_scans(plan):
+    # Seq Scans, and index scans that only filter (no Index Cond), which read
+    # the whole index because no index matches the predicate
+    found = []
+    node = plan.get("Node Type")
+    if node == "Seq Scan":
+        found.append(f"sequential scan on {plan['Relation Name']}")
+    elif node in ("Index Scan", "Index Only Scan") and "Filter" in plan:
+        if "Index Cond" not in plan:
+            found.append(
+                f"full scan of {plan['Index Name']} on {plan['Relation Name']}"
+            )
+    for child in plan.get("Plans", []):
+        found.extend(unindexed_scans(child))
+    return found
+
+
+@contextmanager
+def captured_plans():
+    # Plans of the SELECTs run inside the block, EXPLAINed as they go out
+    plans = []
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def explain(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            explain_cursor = conn.connection.cursor()
+            explain_cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+            plans.append(explain_cursor.fetchone()[0][0]["Plan"])
+
+    try:
+        yield plans
+    finally:
+        event.remove(engine, "before_cursor_execute", explain)
+
+
+def prefer_indexes(db):
+    # Seq scans stay possible but are priced out, so the planner picks an
+    # index whenever one applies, even on small tables
+    db.execute(text("SET LOCAL enable_seqscan = off"))
+
+
+def case_scans(db, params, name):
+    # (unindexed scans, plans) of one read case
+    with captured_plans() as plans:
+        READ_CASES[name](db, params)
+    return sorted({scan for plan in plans for scan in unindexed_scans(plan)}), plans
+
+
+def check():
+    failures = 0
+    db = SessionLocal()
+    try:
+        params = sample_parameters(db)
+        prefer_indexes(db)
+        for name in READ_CASES:
+            scans, plans = case_scans(db, params, name)
+            if scans:
+                failures += 1
+                print(f"FAIL {name}: {', '.join(scans)}")
+                for plan in plans:
+                    print(json.dumps(plan, indent=2))
+            else:
+                print(f"ok   {name}")
+    finally:
+        db.rollback()
+        db.close()
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="EXPLAIN the API read queries and fail on unindexed scans."
+    )
+    parser.parse_args()
+
+    init_db()
+    failures = check()
+    print(f"{failures} queries are not served by an index.")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,113 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import func, select, text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from database.database import run_db
+
+# Totals the planner estimates above this are reported as approximate; below
+# it the rows are counted exactly, which is cheap at that size
+COUNT_EXACT_THRESHOLD = int(os.getenv("COUNT_EXACT_THRESHOLD", "10000"))
+# Seconds a total stays cached, so flipping through pages does not recount
+COUNT_CACHE_SECONDS = float(os.getenv("COUNT_CACHE_SECONDS", "10"))
+COUNT_CACHE_ENTRIES = 1024
+
+
+class Explain(Executable, ClauseElement):
+    # EXPLAIN (FORMAT JSON) of a statement, with its parameters bound as usual
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def _compile_explain(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+def table_estimate(db, table):
+    # reltuples as of the last ANALYZE or VACUUM, summed over the leaf
+    # partitions: an analyzed partitioned parent holds the total of its
+    # children too. A plain table is its own leaf. Never analyzed tables
+    # report -1 and count as empty.
+    return db.scalar(
+        text(
+            "SELECT coalesce(sum(greatest(reltuples, 0)), 0)"
+            " FROM pg_partition_tree(CAST(:table AS regclass)) AS tree"
+            " JOIN pg_class ON pg_class.oid = tree.relid"
+            " WHERE tree.isleaf"
+        ),
+        {"table": table},
+    )
+
+
+def plan_estimate(db, stmt):
+    plan = db.execute(Explain(stmt)).scalar()
+    # psycopg2 decodes json columns, asyncpg leaves them as text
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]["Plan Rows"]
+
+
+def count_rows(db, stmt, table, filtered):
+    # (total, exact) for the rows of stmt. Unfiltered totals start from the
+    # table statistics, filtered ones from the planner's row estimate.
+    estimate = plan_estimate(db, stmt) if filtered else table_estimate(db, table)
+    if estimate >= COUNT_EXACT_THRESHOLD:
+        return int(estimate), False
+    return db.scalar(select(func.count()).select_from(stmt.subquery())), True
+
+
+class CountCache:
+    # Small LRU of recent totals keyed by endpoint and filters, expiring after
+    # ttl seconds; writes are not tracked, so totals may lag by up to ttl
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, name, **filters):
+        return name + ":" + json.dumps(filters, sort_keys=True, default=str)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            total, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return total
+
+    def set(self, key, total):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (total, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+total_counts = CountCache(COUNT_CACHE_SECONDS, COUNT_CACHE_ENTRIES)
+
+
+async def cached_total(db, name, count, **filters):
+    # count(db, **filters) returns (total, exact); repeats within the cache
+    # lifetime skip the database
+    key = total_counts.key(name, **filters)
+    total = total_counts.get(key)
+    if total is None:
+        total = await run_db(db, count, **filters)
+        total_counts.set(key, total)
+    return total
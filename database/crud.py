@@ -0,0 +1,711 @@
+import re
+
+from sqlalchemy import (
+    Date,
+    DateTime,
+    Float,
+    Integer,
+    and_,
+    case,
+    cast,
+    column,
+    func,
+    insert,
+    literal,
+    literal_column,
+    or_,
+    select,
+    true,
+    tuple_,
+    update,
+    values,
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+
+from cache import response_cache
+from cube import analytics_cube
+from database.counts import count_rows
+import database.models as models
+from database.partitions import ensure_partitions
+from database.rollup import record_sales
+from forecast import velocity_cache
+
+BULK_SALE_COMMENT = "Bulk sale ingestion"
+# Letters and digits only, so typeahead input can never be tsquery syntax
+SEARCH_WORD = re.compile(r"[^\W_]+")
+# A concurrent insert of the same inventory item makes an upsert start over
+INVENTORY_UPSERT_ATTEMPTS = 3
+
+
+# Categories
+def list_categories(db, after_id=None, limit=100, columns=None):
+    query = select_columns(db, models.Category, columns)
+    if after_id is not None:
+        query = query.filter(models.Category.id > after_id)
+    return query.order_by(models.Category.id).limit(limit).all()
+
+
+def get_category(db, category_id):
+    return db.query(models.Category).filter(models.Category.id == category_id).first()
+
+
+def create_category(db, category):
+    db_category = models.Category(name=category.name)
+    db.add(db_category)
+    try:
+        db.flush()
+        bump_catalog_version(db)
+        db.commit()
+        db.refresh(db_category)
+    except Exception:
+        db.rollback()
+        return None
+    return db_category
+
+
+def catalog_version(db):
+    return db.scalar(select(models.CatalogVersion.version))
+
+
+def bump_catalog_version(db):
+    # Part of the writing transaction, so the new version becomes visible
+    # together with the write on the primary and on every replica
+    db.execute(
+        update(models.CatalogVersion).values(version=models.CatalogVersion.version + 1)
+    )
+
+
+# Products
+def select_columns(db, model, columns=None):
+    # Whole instances by default, or just the named columns as row tuples
+    if columns is None:
+        return db.query(model)
+    return db.query(*(getattr(model, name) for name in columns))
+
+
+def expand_options(expand):
+    # One extra SELECT ... WHERE id IN (...) per relationship, whatever the
+    # number of products
+    options = []
+    if "category" in expand:
+        options.append(selectinload(models.Product.category))
+    if "inventory" in expand:
+        options.append(selectinload(models.Product.inventory_items))
+    return options
+
+
+def list_products(db, after_id=None, limit=100, columns=None, expand=()):
+    query = select_columns(db, models.Product, columns)
+    if expand:
+        query = query.options(*expand_options(expand))
+    if after_id is not None:
+        query = query.filter(models.Product.id > after_id)
+    return query.order_by(models.Product.id).limit(limit).all()
+
+
+def get_product(db, product_id, expand=()):
+    return (
+        db.query(models.Product)
+        .options(*expand_options(expand))
+        .filter(models.Product.id == product_id)
+        .first()
+    )
+
+
+def product_sales_summaries(db, product_ids, start_date, end_date):
+    # Units and revenue per product over the window, from one grouped query
+    query = db.query(
+        models.SalesDaily.product_id,
+        func.sum(models.SalesDaily.units),
+        func.sum(models.SalesDaily.revenue),
+    ).filter(models.SalesDaily.product_id.in_(product_ids))
+    query = filter_rollup(query, start_date, end_date)
+    rows = query.group_by(models.SalesDaily.product_id).all()
+    return {product_id: (units, revenue) for product_id, units, revenue in rows}
+
+
+def search_query(q, prefix=False):
+    # websearch_to_tsquery accepts any input ("quoted phrases", or, -word);
+    # typeahead matches the last, possibly unfinished word as a prefix
+    config = literal_column(f"'{models.SEARCH_CONFIG}'::regconfig")
+    if not prefix:
+        return func.websearch_to_tsquery(config, q)
+    words = SEARCH_WORD.findall(q)
+    if not words:
+        return None
+    words[-1] += ":*"
+    return func.to_tsquery(config, " & ".join(words))
+
+
+def search_products(
+    db, q, columns, prefix=False, category_id=None, after=None, limit=100
+):
+    # Matches come from the GIN index on search_vector; only they are ranked.
+    # Keyset pagination on (rank desc, id) like the other list endpoints.
+    query = search_query(q, prefix)
+    if query is None:
+        return []
+    rank = cast(func.ts_rank_cd(models.Product.search_vector, query), Float)
+    stmt = select(
+        *(getattr(models.Product, name) for name in columns),
+        rank.label("rank"),
+    ).where(models.Product.search_vector.op("@@")(query))
+    if category_id is not None:
+        stmt = stmt.where(models.Product.category_id == category_id)
+    if after:
+        last_rank, last_id = after
+        stmt = stmt.where(
+            or_(rank < last_rank, and_(rank == last_rank, models.Product.id > last_id))
+        )
+    stmt = stmt.order_by(rank.desc(), models.Product.id).limit(limit)
+    return db.execute(stmt).mappings().all()
+
+
+def create_product(db, product):
+    db_product = models.Product(
+        name=product.name,
+        description=product.description,
+        price=product.price,
+        category_id=product.category_id,
+        sku=product.sku,
+    )
+    db.add(db_product)
+    try:
+        db.flush()
+        bump_catalog_version(db)
+        db.commit()
+        db.refresh(db_product)
+    except IntegrityError:
+        db.rollback()
+        return None
+    return db_product
+
+
+# Catalog import
+def resolve_categories(db, names, known):
+    # Adds the ids of names to the known name -> id map, creating missing
+    # categories; returns how many were created
+    missing = sorted(set(names) - known.keys())
+    if not missing:
+        return 0
+    created = db.execute(
+        pg_insert(models.Category)
+        .values([{"name": name} for name in missing])
+        .on_conflict_do_nothing(index_elements=[models.Category.name])
+        .returning(models.Category.name, models.Category.id)
+    ).all()
+    known.update(created)
+    existing = [name for name in missing if name not in known]
+    if existing:
+        known.update(
+            db.execute(
+                select(models.Category.name, models.Category.id).where(
+                    models.Category.name.in_(existing)
+                )
+            ).all()
+        )
+    return len(created)
+
+
+def upsert_products(db, products):
+    # One INSERT ... ON CONFLICT (sku) DO UPDATE for the chunk; xmax is 0 for
+    # rows the statement inserted. SKUs must be unique within products.
+    stmt = pg_insert(models.Product).values(products)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.Product.sku],
+        set_={
+            name: stmt.excluded[name]
+            for name in ("name", "description", "price", "category_id")
+        },
+    ).returning(literal_column("xmax = 0"))
+    flags = db.scalars(stmt).all()
+    inserted = sum(flags)
+    return inserted, len(flags) - inserted
+
+
+def import_products(db, category_names, products, categories):
+    # One chunk of a catalog import, in its own transaction. products carry
+    # their category by name; categories is the import's name -> id map.
+    created = resolve_categories(db, category_names, categories)
+    inserted = updated = 0
+    if products:
+        inserted, updated = upsert_products(
+            db,
+            [
+                {
+                    "sku": product["sku"],
+                    "name": product["name"],
+                    "description": product["description"],
+                    "price": product["price"],
+                    "category_id": categories[product["category"]],
+                }
+                for product in products
+            ],
+        )
+    if created or inserted or updated:
+        bump_catalog_version(db)
+    db.commit()
+    return created, inserted, updated
+
+
+# Inventory
+def create_inventory(db, item):
+    # Upsert on (product_id, channel). An existing row is locked before the
+    # statement replaces it, so the ledger can log the difference.
+    inventory = models.Inventory
+    for _ in range(INVENTORY_UPSERT_ATTEMPTS):
+        old_quantity = db.scalar(
+            select(inventory.quantity)
+            .where(
+                inventory.product_id == item.product_id,
+                inventory.channel == item.channel,
+            )
+            .with_for_update()
+        )
+        stmt = pg_insert(inventory).values(
+            product_id=item.product_id,
+            channel=item.channel,
+            quantity=item.quantity,
+            reorder_level=item.reorder_level,
+        )
+        stmt = stmt.on_conflict_do_update(
+            constraint="uix_product_channel",
+            set_={
+                "quantity": stmt.excluded.quantity,
+                "reorder_level": stmt.excluded.reorder_level,
+                "last_updated": func.now(),
+            },
+        ).returning(
+            *inventory.__table__.columns,
+            literal_column("xmax = 0").label("inserted"),
+        )
+        row = db.execute(stmt).mappings().one()
+        if row["inserted"] or old_quantity is not None:
+            break
+        # Another transaction inserted the row between the two statements;
+        # the next attempt sees and locks it
+        db.rollback()
+    else:
+        raise RuntimeError(
+            f"Inventory for product {item.product_id} on {item.channel!r} "
+            f"kept changing during the upsert"
+        )
+    if row["inserted"]:
+        # The opening stock is the first entry of the item's ledger
+        change, comment = row["quantity"], "Initial stock"
+    else:
+        change, comment = row["quantity"] - old_quantity, "Stock replaced"
+    if change or row["inserted"]:
+        db.execute(
+            insert(models.InventoryHistory.__table__).values(
+                inventory_id=row["id"], change_qty=change, comment=comment
+            )
+        )
+    db.commit()
+    return {column.name: row[column.name] for column in inventory.__table__.columns}
+
+
+def list_inventory(db, product_id=None, channel=None, columns=None):
+    query = select_columns(db, models.Inventory, columns)
+    if product_id is not None:
+        query = query.filter(models.Inventory.product_id == product_id)
+    if channel is not None:
+        query = query.filter(models.Inventory.channel == channel)
+    return query.all()
+
+
+def count_inventory(db, product_id=None, channel=None):
+    query = select(models.Inventory.id)
+    if product_id is not None:
+        query = query.where(models.Inventory.product_id == product_id)
+    if channel is not None:
+        query = query.where(models.Inventory.channel == channel)
+    filtered = product_id is not None or channel is not None
+    return count_rows(db, query, models.Inventory.__tablename__, filtered)
+
+
+def get_inventory(db, inventory_id):
+    return (
+        db.query(models.Inventory).filter(models.Inventory.id == inventory_id).first()
+    )
+
+
+def list_low_stock(db):
+    return (
+        db.query(models.Inventory)
+        .filter(models.Inventory.quantity <= models.Inventory.reorder_level)
+        .all()
+    )
+
+
+def inventory_as_of(db, ts, product_id=None, channel=None):
+    # Quantities at ts, replayed forward from the last snapshot taken by then,
+    # otherwise backward from the next snapshot or the current quantity, so a
+    # lookup reads at most SNAPSHOT_EVERY history rows per item plus the rows
+    # newer than the last compaction
+    history = models.InventoryHistory
+    snapshot = models.InventorySnapshot
+    inventory = models.Inventory
+    position = tuple_(history.timestamp, history.id)
+
+    def nearest(*conditions, newest):
+        order = (snapshot.taken_at, snapshot.history_id)
+        if newest:
+            order = tuple(column.desc() for column in order)
+        return (
+            select(snapshot.quantity, snapshot.taken_at, snapshot.history_id)
+            .where(snapshot.inventory_id == inventory.id, *conditions)
+            .order_by(*order)
+            .limit(1)
+        )
+
+    def changes(*conditions):
+        return (
+            select(func.coalesce(func.sum(history.change_qty), 0))
+            .where(history.inventory_id == inventory.id, *conditions)
+            .scalar_subquery()
+        )
+
+    before = nearest(snapshot.taken_at <= ts, newest=True).lateral("before")
+    after = nearest(snapshot.taken_at > ts, newest=False).lateral("after")
+    quantity = case(
+        (
+            before.c.taken_at.is_not(None),
+            before.c.quantity
+            + changes(
+                position > tuple_(before.c.taken_at, before.c.history_id),
+                history.timestamp <= ts,
+            ),
+        ),
+        (
+            after.c.taken_at.is_not(None),
+            after.c.quantity
+            - changes(
+                history.timestamp > ts,
+                position <= tuple_(after.c.taken_at, after.c.history_id),
+            ),
+        ),
+        else_=inventory.quantity - changes(history.timestamp > ts),
+    )
+    query = (
+        select(
+            inventory.id,
+            inventory.product_id,
+            inventory.channel,
+            quantity.label("quantity"),
+        )
+        .outerjoin(before, true())
+        .outerjoin(after, true())
+        .order_by(inventory.id)
+    )
+    if product_id is not None:
+        query = query.where(inventory.product_id == product_id)
+    if channel is not None:
+        query = query.where(inventory.channel == channel)
+    return db.execute(query).mappings().all()
+
+
+def daily_units(db, start_day, end_day):
+    # (product_id, channel, day offset from start_day, units) per rollup bucket
+    return db.execute(
+        select(
+            models.SalesDaily.product_id,
+            models.SalesDaily.channel,
+            (models.SalesDaily.day - literal(start_day, Date)).label("offset"),
+            models.SalesDaily.units,
+        ).where(models.SalesDaily.day.between(start_day, end_day))
+    ).all()
+
+
+def update_inventory(db, inventory_id, inv_update):
+    # Lock the row so the logged change matches the quantity being replaced
+    inv = (
+        db.query(models.Inventory)
+        .filter(models.Inventory.id == inventory_id)
+        .with_for_update()
+        .first()
+    )
+    if inv is None:
+        return None
+    old_qty = inv.quantity
+    inv.quantity = inv_update.quantity
+    # update last_updated handled by DB default on update
+    # calculate change
+    change = inv_update.quantity - old_qty
+    # record history
+    history = models.InventoryHistory(
+        inventory_id=inventory_id, change_qty=change, comment=inv_update.comment
+    )
+    db.add(history)
+    db.commit()
+    db.refresh(inv)
+    return inv
+
+
+# Sales
+def filter_sales(
+    query,
+    start_date=None,
+    end_date=None,
+    product_id=None,
+    category_id=None,
+    channel=None,
+):
+    # Filter by date
+    if start_date:
+        query = query.filter(models.Sale.sale_date >= start_date)
+    if end_date:
+        query = query.filter(models.Sale.sale_date <= end_date)
+    # Filter by product
+    if product_id:
+        query = query.filter(models.Sale.product_id == product_id)
+    # Filter by channel
+    if channel:
+        query = query.filter(models.Sale.channel == channel)
+    # Filter by category (join through product)
+    if category_id:
+        query = query.join(models.Product).filter(
+            models.Product.category_id == category_id
+        )
+    return query
+
+
+def filter_rollup(
+    query,
+    start_date=None,
+    end_date=None,
+    product_id=None,
+    category_id=None,
+    channel=None,
+):
+    # Same filters as filter_sales, applied to the daily rollup. The rollup is
+    # bucketed by day, so date bounds cover whole days.
+    if start_date:
+        query = query.filter(models.SalesDaily.day >= start_date.date())
+    if end_date:
+        query = query.filter(models.SalesDaily.day <= end_date.date())
+    if product_id:
+        query = query.filter(models.SalesDaily.product_id == product_id)
+    if channel:
+        query = query.filter(models.SalesDaily.channel == channel)
+    if category_id:
+        query = query.join(
+            models.Product, models.Product.id == models.SalesDaily.product_id
+        ).filter(models.Product.category_id == category_id)
+    return query
+
+
+def list_sales(db, filters, after=None, limit=100, columns=None):
+    query = filter_sales(select_columns(db, models.Sale, columns), **filters)
+    # Keyset pagination on (sale_date, id) so deep pages cost the same as the first
+    if after:
+        query = query.filter(
+            tuple_(models.Sale.sale_date, models.Sale.id) > tuple_(*after),
+            # Implied by the row comparison, but only plain bounds prune partitions
+            models.Sale.sale_date >= after[0],
+        )
+    return query.order_by(models.Sale.sale_date, models.Sale.id).limit(limit).all()
+
+
+def count_sales(db, **filters):
+    query = filter_sales(select(models.Sale.id), **filters)
+    filtered = any(filters.values())
+    return count_rows(db, query, models.Sale.__tablename__, filtered)
+
+
+def revenue_by_period(db, filters, group_by="day"):
+    # Periods are built from the daily rollup buckets rather than raw sales
+    period = func.date_trunc(group_by, cast(models.SalesDaily.day, DateTime))
+    query = db.query(
+        period.label("period"),
+        func.sum(models.SalesDaily.revenue).label("revenue"),
+    )
+    query = filter_rollup(query, **filters)
+    query = query.group_by("period").order_by("period")
+    return query.all()
+
+
+def compare_ranges(db, ranges, filters):
+    # Every range in one pass: the ranges become a VALUES list, generate_series
+    # expands each to its days, and the rollup is left joined so empty days read 0
+    bounds = values(
+        column("label", Integer),
+        column("start_day", Date),
+        column("end_day", Date),
+        name="ranges",
+    ).data([(label, start, end) for label, (start, end) in enumerate(ranges, 1)])
+    series = func.generate_series(
+        cast(bounds.c.start_day, DateTime),
+        cast(bounds.c.end_day, DateTime),
+        literal_column("interval '1 day'"),
+    )
+    days = select(bounds.c.label, cast(series, Date).label("day")).cte("days")
+    daily = filter_rollup(
+        select(
+            models.SalesDaily.day,
+            func.sum(models.SalesDaily.revenue).label("revenue"),
+        ),
+        **filters,
+    )
+    daily = (
+        daily.filter(models.SalesDaily.day.in_(select(days.c.day)))
+        .group_by(models.SalesDaily.day)
+        .subquery("daily")
+    )
+    stmt = (
+        select(days.c.label, days.c.day, func.coalesce(daily.c.revenue, 0))
+        .outerjoin_from(days, daily, daily.c.day == days.c.day)
+        .order_by(days.c.label, days.c.day)
+    )
+    return db.execute(stmt).all()
+
+
+def bulk_create_sales(db, sales):
+    # Rows that fail validation are reported by index and skipped; the rest of
+    # the batch is written in one transaction.
+    errors = []
+    product_ids = {sale.product_id for sale in sales}
+    known_products = set(
+        db.scalars(select(models.Product.id).where(models.Product.id.in_(product_ids)))
+    )
+
+    # Lock the inventory rows this batch draws from, in id order so concurrent
+    # batches cannot deadlock
+    keys = {
+        (sale.product_id, sale.channel)
+        for sale in sales
+        if sale.product_id in known_products
+    }
+    stock = {}
+    if keys:
+        rows = db.execute(
+            select(
+                models.Inventory.id,
+                models.Inventory.product_id,
+                models.Inventory.channel,
+                models.Inventory.quantity,
+            )
+            .where(
+                tuple_(models.Inventory.product_id, models.Inventory.channel).in_(keys)
+            )
+            .order_by(models.Inventory.id)
+            .with_for_update()
+        ).all()
+        stock = {
+            (product_id, channel): [inventory_id, quantity]
+            for inventory_id, product_id, channel, quantity in rows
+        }
+
+    accepted = []
+    taken = {}
+    for index, sale in enumerate(sales):
+        if sale.product_id not in known_products:
+            errors.append({"index": index, "detail": "Product not found"})
+            continue
+        entry = stock.get((sale.product_id, sale.channel))
+        if entry is None:
+            errors.append(
+                {
+                    "index": index,
+                    "detail": "Inventory not found for this product and channel",
+                }
+            )
+            continue
+        if sale.quantity <= 0:
+            errors.append({"index": index, "detail": "Quantity must be positive"})
+            continue
+        inventory_id, available = entry
+        if available < sale.quantity:
+            errors.append({"index": index, "detail": "Insufficient stock"})
+            continue
+        entry[1] -= sale.quantity
+        taken[inventory_id] = taken.get(inventory_id, 0) + sale.quantity
+        accepted.append(sale.dict())
+
+    if accepted:
+        ensure_partitions(db, "sales", (sale["sale_date"] for sale in accepted))
+        # executemany with insertmanyvalues: multi-row INSERTs from one cached
+        # compiled statement, instead of compiling a statement per batch size
+        db.execute(insert(models.Sale.__table__), accepted)
+        # One set-based UPDATE ... FROM (VALUES ...) for every touched row
+        deltas = values(
+            column("id", Integer), column("quantity", Integer), name="deltas"
+        ).data(sorted(taken.items()))
+        db.execute(
+            update(models.Inventory)
+            .where(models.Inventory.id == deltas.c.id)
+            .values(quantity=models.Inventory.quantity - deltas.c.quantity)
+            .execution_options(synchronize_session=False)
+        )
+        db.execute(
+            insert(models.InventoryHistory.__table__),
+            [
+                {
+                    "inventory_id": inventory_id,
+                    "change_qty": -quantity,
+                    "comment": BULK_SALE_COMMENT,
+                }
+                for inventory_id, quantity in sorted(taken.items())
+            ],
+        )
+        record_sales(db, accepted)
+        db.commit()
+        # Cached analytics covering these days are stale now
+        response_cache.invalidate({sale["sale_date"].date() for sale in accepted})
+        analytics_cube.mark_stale()
+        velocity_cache.invalidate()
+    return {"inserted": len(accepted), "errors": errors}
+
+
+def adjust_inventory(db, adjustments):
+    # Apply signed deltas relative to the stored quantity, so concurrent writers
+    # add up instead of overwriting each other
+    totals = {}
+    for adjustment in adjustments:
+        totals[adjustment.inventory_id] = (
+            totals.get(adjustment.inventory_id, 0) + adjustment.delta
+        )
+
+    # Lock in id order so concurrent batches cannot deadlock
+    found = set(
+        db.scalars(
+            select(models.Inventory.id)
+            .where(models.Inventory.id.in_(totals))
+            .order_by(models.Inventory.id)
+            .with_for_update()
+        )
+    )
+    missing = sorted(set(totals) - found)
+    if missing:
+        db.rollback()
+        return None, missing
+
+    deltas = values(
+        column("id", Integer), column("delta", Integer), name="deltas"
+    ).data(sorted(totals.items()))
+    items = (
+        db.execute(
+            update(models.Inventory)
+            .where(models.Inventory.id == deltas.c.id)
+            .values(quantity=models.Inventory.quantity + deltas.c.delta)
+            .returning(*models.Inventory.__table__.columns)
+            .execution_options(synchronize_session=False)
+        )
+        .mappings()
+        .all()
+    )
+    db.execute(
+        insert(models.InventoryHistory.__table__),
+        [
+            {
+                "inventory_id": adjustment.inventory_id,
+                "change_qty": adjustment.delta,
+                "comment": adjustment.comment,
+            }
+            for adjustment in adjustments
+        ],
+    )
+    db.commit()
+    return sorted((dict(item) for item in items), key=lambda item: item["id"]), []
@@ -0,0 +1,244 @@
+import argparse
+import io
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, select, text
+
+from database.database import SessionLocal, engine, init_db
+import database.models as models
+from database.partitions import ensure_range
+from database.rollup import rebuild
+from database.snapshots import compact
+
+# Channel share of sales; products are listed on every channel
+CHANNELS = {"Amazon": 0.45, "Walmart": 0.25, "Shopify": 0.2, "eBay": 0.1}
+QUANTITIES = ([1, 2, 3, 4, 5, 10], [60, 20, 9, 5, 4, 2])
+# Product names and descriptions are drawn from these words, so search has
+# common and rare terms to match
+ADJECTIVES = (
+    "Wireless Portable Smart Compact Deluxe Classic Ergonomic Rugged Slim Premium"
+    " Eco Digital Vintage Foldable Waterproof Heavy-Duty"
+).split()
+NOUNS = (
+    "Headphones Speaker Charger Keyboard Mouse Lamp Backpack Bottle Blender Kettle"
+    " Camera Tripod Monitor Router Drill Jacket Sneakers Watch Tent Mug"
+).split()
+FEATURES = (
+    "bluetooth usb-c rechargeable led stainless cotton aluminium bamboo solar"
+    " magnetic adjustable lightweight dishwasher-safe fast-charging 4k"
+).split()
+# Rows per COPY chunk, so memory stays flat whatever the row count
+COPY_CHUNK = 100_000
+
+
+def copy_rows(cursor, table, columns, rows):
+    buf = io.StringIO()
+    count = 0
+
+    def flush():
+        buf.seek(0)
+        cursor.copy_expert(
+            f"COPY {table} ({', '.join(columns)}) FROM STDIN", buf, size=1 << 20
+        )
+        buf.seek(0)
+        buf.truncate()
+
+    for row in rows:
+        buf.write("\t".join(map(str, row)))
+        buf.write("\n")
+        count += 1
+        if count % COPY_CHUNK == 0:
+            flush()
+    flush()
+    return count
+
+
+def allocate(total, weights):
+    # Split total across weights by largest remainder, so counts are exact
+    scale = total / sum(weights)
+    counts = [int(w * scale) for w in weights]
+    remainders = sorted(
+        range(len(weights)), key=lambda i: counts[i] - weights[i] * scale
+    )
+    for i in remainders[: total - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+
+def day_weights(rng, start, days):
+    # Growth over the period, busier weekends and a November/December peak
+    weights = []
+    for offset in range(days):
+        day = start + timedelta(days=offset)
+        weight = 1 + offset / days
+        if day.weekday() >= 5:
+            weight *= 1.3
+        if day.month == 11:
+            weight *= 1.4
+        elif day.month == 12:
+            weight *= 1.8
+        weights.append(weight * rng.uniform(0.85, 1.15))
+    return weights
+
+
+def generate(args):
+    rng = random.Random(args.seed)
+    channels = list(CHANNELS)
+    channel_weights = list(CHANNELS.values())
+
+    categories = [f"Category {n:03d}" for n in range(1, args.categories + 1)]
+    products = []
+    for n in range(1, args.products + 1):
+        price = round(min(rng.lognormvariate(3.5, 1.0), 5000), 2)
+        name = f"{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {n:06d}"
+        description = "With " + ", ".join(rng.sample(FEATURES, rng.randint(1, 3)))
+        products.append((name, description, rng.randint(1, args.categories), price))
+    # Zipf-like popularity over a shuffled rank, so ids do not encode popularity
+    ranks = list(range(1, args.products + 1))
+    rng.shuffle(ranks)
+    popularity = [1 / rank**args.skew for rank in ranks]
+
+    inventory = []
+    for product_id in range(1, args.products + 1):
+        for channel in channels:
+            reorder_level = rng.choice([5, 10, 20, 50])
+            # Roughly one in twelve rows starts below its reorder level
+            if rng.random() < 0.08:
+                quantity = rng.randint(0, reorder_level)
+            else:
+                quantity = rng.randint(reorder_level + 1, reorder_level * 20)
+            inventory.append((product_id, channel, quantity, reorder_level))
+
+    start = args.start
+    end = start + timedelta(days=args.days - 1)
+    counts = allocate(args.sales, day_weights(rng, start, args.days))
+
+    def sales_rows():
+        product_ids = range(1, args.products + 1)
+        for offset, count in enumerate(counts):
+            if not count:
+                continue
+            midnight = datetime.combine(
+                start + timedelta(days=offset), datetime.min.time()
+            )
+            picked = rng.choices(product_ids, weights=popularity, k=count)
+            picked_channels = rng.choices(channels, weights=channel_weights, k=count)
+            quantities = rng.choices(*QUANTITIES, k=count)
+            # Rows arrive in time order, as they would from a live shop
+            seconds = sorted(rng.randrange(86400) for _ in range(count))
+            for product_id, channel, quantity, second in zip(
+                picked, picked_channels, quantities, seconds
+            ):
+                base = products[product_id - 1][3]
+                price = round(base * (1 - rng.random() * 0.15), 2)
+                sale_date = midnight + timedelta(seconds=second)
+                yield product_id, channel, quantity, price, sale_date
+
+    def history_rows():
+        inventory_weights = [
+            popularity[product_id - 1] * CHANNELS[channel]
+            for product_id, channel, _, _ in inventory
+        ]
+        inventory_ids = range(1, len(inventory) + 1)
+        picked = rng.choices(inventory_ids, weights=inventory_weights, k=args.history)
+        span = args.days * 86400
+        stamps = sorted(rng.randrange(span) for _ in range(args.history))
+        origin = datetime.combine(start, datetime.min.time())
+        for inventory_id, second in zip(picked, stamps):
+            kind = rng.random()
+            if kind < 0.7:
+                change, comment = -rng.randint(1, 5), "Sale"
+            elif kind < 0.95:
+                change, comment = rng.randint(20, 200), "Restock"
+            else:
+                change, comment = rng.choice([-3, -2, -1, 1, 2, 3]), "Adjustment"
+            timestamp = origin + timedelta(seconds=second)
+            yield inventory_id, change, f"{timestamp}+00", comment
+
+    with engine.begin() as conn:
+        if args.reset:
+            conn.execute(
+                text(
+                    "TRUNCATE sales, sales_daily, inventory_snapshots, inventory_history,"
+                    " inventory, products, categories RESTART IDENTITY CASCADE"
+                )
+            )
+        elif conn.scalar(select(func.count()).select_from(models.Category)):
+            raise SystemExit(
+                "The database already has data; pass --reset to replace it."
+            )
+        ensure_range(conn, "sales", start, end)
+
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        timings = {}
+        for table, columns, rows in (
+            ("categories", ["name"], ((name,) for name in categories)),
+            ("products", ["name", "description", "category_id", "price"], products),
+            (
+                "inventory",
+                ["product_id", "channel", "quantity", "reorder_level"],
+                inventory,
+            ),
+            (
+                "sales",
+                ["product_id", "channel", "quantity", "price", "sale_date"],
+                sales_rows(),
+            ),
+            (
+                "inventory_history",
+                ["inventory_id", "change_qty", "timestamp", "comment"],
+                history_rows(),
+            ),
+        ):
+            started = time.perf_counter()
+            count = copy_rows(cursor, table, columns, rows)
+            timings[table] = (count, time.perf_counter() - started)
+        # Catalog ETags handed out before the load must not match
+        cursor.execute("UPDATE catalog_version SET version = version + 1")
+        raw.commit()
+    finally:
+        raw.close()
+
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        rollup_rows = rebuild(db, start, end)
+        timings["sales_daily"] = (rollup_rows, time.perf_counter() - started)
+    finally:
+        db.close()
+    started = time.perf_counter()
+    snapshots = compact(engine)
+    timings["inventory_snapshots"] = (snapshots, time.perf_counter() - started)
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").execute(text("ANALYZE"))
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Bulk load a deterministic synthetic dataset with COPY."
+    )
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--categories", type=int, default=25)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--sales", type=int, default=1_000_000)
+    parser.add_argument("--history", type=int, default=200_000)
+    parser.add_argument(
+        "--start", type=date.fromisoformat, default=date(2023, 1, 1), help="first day"
+    )
+    parser.add_argument("--days", type=int, default=730)
+    parser.add_argument(
+        "--skew", type=float, default=1.1, help="Zipf exponent of product popularity"
+    )
+    parser.add_argument(
+        "--reset", action="store_true", help="truncate existing data first"
+    )
+    args = parser.parse_args()
+
+    init_db()
+    for table, (count, seconds) in generate(args).items():
+        print(f"{table:18} {count:>10,} rows in {seconds:6.1f}s")
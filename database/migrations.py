@@ -0,0 +1,270 @@
+import argparse
+import logging
+import re
+
+from sqlalchemy import text
+
+from database.models import SEARCH_VECTOR
+from database.partitions import convert_to_partitioned
+
+logger = logging.getLogger("migrations")
+
+# Arbitrary key for the migration advisory lock, so workers starting together
+# apply each migration once
+MIGRATION_LOCK_KEY = 7301
+# Migrations that index or rewrite whole tables. Startup applies them only to
+# a database without sales, where they are quick; otherwise it refuses to
+# start until python -m database.migrations has applied them.
+OFFLINE_MIGRATIONS = {1, 2}
+# Offline migrations whose CREATE and DROP INDEX steps the command runs
+# CONCURRENTLY, outside a transaction, so writes carry on during the build
+CONCURRENT_MIGRATIONS = {1}
+INDEX_STEP = re.compile(
+    r"(CREATE|DROP) INDEX (IF (?:NOT )?EXISTS )?(\w+)(?: ON (?:ONLY )?(\w+))?"
+)
+
+# (version, description, steps). Steps are SQL strings or callables taking the
+# connection. create_all already builds the current schema for a fresh
+# database, so steps must tolerate objects that exist (IF [NOT] EXISTS).
+MIGRATIONS = [
+    (
+        1,
+        "Composite, covering, partial and BRIN indexes for the read paths",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_sales_sale_date_id ON sales (sale_date, id)",
+            "CREATE INDEX IF NOT EXISTS ix_sales_channel_sale_date_id"
+            " ON sales (channel, sale_date, id) INCLUDE (product_id, quantity, price)",
+            "CREATE INDEX IF NOT EXISTS ix_sales_product_sale_date_id"
+            " ON sales (product_id, sale_date, id) INCLUDE (channel, quantity, price)",
+            "CREATE INDEX IF NOT EXISTS ix_sales_sale_date_brin"
+            " ON sales USING brin (sale_date)",
+            "CREATE INDEX IF NOT EXISTS ix_sales_daily_product_day"
+            " ON sales_daily (product_id, day) INCLUDE (revenue)",
+            "CREATE INDEX IF NOT EXISTS ix_sales_daily_channel_day"
+            " ON sales_daily (channel, day) INCLUDE (revenue)",
+            "CREATE INDEX IF NOT EXISTS ix_inventory_channel ON inventory (channel)",
+            "CREATE INDEX IF NOT EXISTS ix_inventory_low_stock"
+            " ON inventory (id) WHERE quantity <= reorder_level",
+            # Leading columns of the composite indexes above
+            "DROP INDEX IF EXISTS ix_sales_channel",
+            "DROP INDEX IF EXISTS ix_sales_product_id",
+            "DROP INDEX IF EXISTS ix_sales_sale_date",
+            "DROP INDEX IF EXISTS ix_sales_daily_product_id",
+            "ANALYZE sales",
+            "ANALYZE sales_daily",
+            "ANALYZE inventory",
+        ],
+    ),
+    (
+        2,
+        "Range partition sales by month and sales_daily by year",
+        [
+            lambda conn: convert_to_partitioned(conn, "sales"),
+            lambda conn: convert_to_partitioned(conn, "sales_daily"),
+        ],
+    ),
+    (
+        3,
+        "Notify inventory_low_stock of changes to rows at or below reorder level",
+        [
+            "CREATE OR REPLACE FUNCTION notify_low_stock() RETURNS trigger AS $$"
+            " BEGIN"
+            " PERFORM pg_notify('inventory_low_stock', json_build_object("
+            " 'id', NEW.id, 'product_id', NEW.product_id, 'channel', NEW.channel,"
+            " 'quantity', NEW.quantity, 'reorder_level', NEW.reorder_level,"
+            " 'last_updated', NEW.last_updated,"
+            " 'low', NEW.quantity <= NEW.reorder_level)::text);"
+            " RETURN NULL;"
+            " END $$ LANGUAGE plpgsql",
+            # WHEN keeps writes to rows well above their reorder level free
+            "DROP TRIGGER IF EXISTS inventory_low_stock_insert ON inventory",
+            "CREATE TRIGGER inventory_low_stock_insert AFTER INSERT ON inventory"
+            " FOR EACH ROW WHEN (NEW.quantity <= NEW.reorder_level)"
+            " EXECUTE FUNCTION notify_low_stock()",
+            "DROP TRIGGER IF EXISTS inventory_low_stock_update ON inventory",
+            "CREATE TRIGGER inventory_low_stock_update"
+            " AFTER UPDATE OF quantity, reorder_level ON inventory FOR EACH ROW"
+            " WHEN (OLD.quantity <= OLD.reorder_level"
+            " OR NEW.quantity <= NEW.reorder_level)"
+            " EXECUTE FUNCTION notify_low_stock()",
+        ],
+    ),
+    (
+        4,
+        "Index inventory_history for replays between inventory snapshots",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_inventory_history_inventory_timestamp_id"
+            " ON inventory_history (inventory_id, timestamp, id) INCLUDE (change_qty)",
+            "DROP INDEX IF EXISTS ix_inventory_history_inventory_id",
+            "ANALYZE inventory_history",
+        ],
+    ),
+    (
+        5,
+        "Full-text search vector over product name and description",
+        [
+            "ALTER TABLE products ADD COLUMN IF NOT EXISTS search_vector tsvector"
+            f" GENERATED ALWAYS AS ({SEARCH_VECTOR}) STORED",
+            "CREATE INDEX IF NOT EXISTS ix_products_search_vector"
+            " ON products USING gin (search_vector)",
+            "ANALYZE products",
+        ],
+    ),
+    (
+        6,
+        "Product SKUs as the upsert key of catalog imports",
+        [
+            "ALTER TABLE products ADD COLUMN IF NOT EXISTS sku varchar",
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_products_sku ON products (sku)",
+        ],
+    ),
+    (
+        7,
+        "Catalog version shared by all workers for ETags",
+        [
+            "CREATE TABLE IF NOT EXISTS catalog_version ("
+            " id integer PRIMARY KEY, version bigint NOT NULL)",
+            # A random start, so ETags from before a database reset never match
+            "INSERT INTO catalog_version (id, version)"
+            " VALUES (1, floor(random() * 1e12)::bigint) ON CONFLICT DO NOTHING",
+        ],
+    ),
+]
+
+
+def applied_versions(conn):
+    conn.execute(
+        text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            " version integer PRIMARY KEY,"
+            " description text NOT NULL,"
+            " applied_at timestamptz NOT NULL DEFAULT now())"
+        )
+    )
+    return set(conn.scalars(text("SELECT version FROM schema_migrations")))
+
+
+def has_sales(conn):
+    return conn.scalar(text("SELECT EXISTS (SELECT 1 FROM sales)"))
+
+
+def apply(conn, version, description, steps):
+    for step in steps:
+        if callable(step):
+            step(conn)
+        else:
+            conn.execute(text(step))
+    record(conn, version, description)
+
+
+def record(conn, version, description):
+    conn.execute(
+        text(
+            "INSERT INTO schema_migrations (version, description)"
+            " VALUES (:version, :description)"
+        ),
+        {"version": version, "description": description},
+    )
+    logger.info("Applied migration %d: %s", version, description)
+
+
+def partitioned(conn, name):
+    # A partitioned table or index, which Postgres cannot build or drop
+    # CONCURRENTLY
+    return conn.scalar(
+        text(
+            "SELECT relkind IN ('p', 'I') FROM pg_class WHERE oid = to_regclass(:name)"
+        ),
+        {"name": name},
+    )
+
+
+def apply_concurrently(conn, steps):
+    # conn is in autocommit mode. A failed concurrent build leaves an invalid
+    # index behind, which IF NOT EXISTS would keep, so it is dropped first.
+    # Tables create_all made are already partitioned, and hold the model's
+    # indexes, so their steps run plainly and are normally no-ops.
+    for step in steps:
+        match = INDEX_STEP.match(step)
+        if match is None:
+            conn.execute(text(step))
+            continue
+        verb, _, name, table = match.groups()
+        if partitioned(conn, table if verb == "CREATE" else name):
+            conn.execute(text(step))
+            continue
+        if verb == "CREATE" and conn.scalar(
+            text(
+                "SELECT NOT indisvalid FROM pg_index"
+                " WHERE indexrelid = to_regclass(:name)"
+            ),
+            {"name": name},
+        ):
+            conn.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+        conn.execute(text(f"{verb} INDEX CONCURRENTLY {step[len(verb) + 7:]}"))
+
+
+def migrate(engine, offline=False):
+    if offline:
+        migrate_offline(engine)
+        return
+    # At startup the pending migrations are applied in one transaction
+    with engine.begin() as conn:
+        conn.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY}
+        )
+        applied = applied_versions(conn)
+        for version, description, steps in MIGRATIONS:
+            if version in applied:
+                continue
+            if version in OFFLINE_MIGRATIONS and has_sales(conn):
+                raise RuntimeError(
+                    f"Migration {version} ({description}) is applied offline:"
+                    f" run python -m database.migrations before starting the app"
+                )
+            apply(conn, version, description, steps)
+
+
+def migrate_offline(engine):
+    # Every pending migration in its own transaction, except concurrent index
+    # builds. The session lock is held by an idle autocommit connection, which
+    # the builds would otherwise wait for.
+    with engine.connect() as lock:
+        lock.execution_options(isolation_level="AUTOCOMMIT")
+        lock.execute(text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        try:
+            for version, description, steps in MIGRATIONS:
+                with engine.begin() as conn:
+                    if version in applied_versions(conn):
+                        continue
+                    populated = has_sales(conn)
+                    if version not in CONCURRENT_MIGRATIONS or not populated:
+                        apply(conn, version, description, steps)
+                        continue
+                logger.info("Applying migration %d concurrently", version)
+                with engine.connect() as conn:
+                    conn.execution_options(isolation_level="AUTOCOMMIT")
+                    apply_concurrently(conn, steps)
+                with engine.begin() as conn:
+                    record(conn, version, description)
+        finally:
+            lock.execute(
+                text("SELECT pg_advisory_unlock(:key)"), {"key": MIGRATION_LOCK_KEY}
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Create the schema and apply pending migrations, including"
+        " the offline ones startup refuses to apply to a populated database."
+    )
+    parser.parse_args()
+
+    from database.database import engine, init_db
+
+    init_db(offline=True)
+    with engine.connect() as conn:
+        for version, description, applied_at in conn.execute(
+            text("SELECT * FROM schema_migrations ORDER BY version")
+        ):
+            print(f"{version:04d} {applied_at:%Y-%m-%d %H:%M} {description}")
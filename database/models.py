@@ -1,17 +1,30 @@
 from sqlalchemy import (
+    BigInteger,
     Column,
+    Computed,
     Integer,
     String,
     Float,
+    Date,
     DateTime,
     ForeignKey,
+    Index,
     func,
     UniqueConstraint,
 )
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import deferred, relationship, declarative_base
 
 Base = declarative_base()
 
+# Text search configuration of products.search_vector and the queries against it
+SEARCH_CONFIG = "english"
+# Name matches rank above description matches
+SEARCH_VECTOR = (
+    f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(name, '')), 'A')"
+    f" || setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(description, '')), 'B')"
+)
+
 
 class Category(Base):
     __tablename__ = "categories"
@@ -30,11 +43,20 @@ class Product(Base):
     category_id = Column(
         Integer, ForeignKey("categories.id"), nullable=False, index=True
     )
+    # Supplier stock keeping unit, the key catalog imports upsert on
+    sku = Column(String)
+    # Maintained by Postgres on every write; deferred so product loads skip it
+    search_vector = deferred(Column(TSVECTOR, Computed(SEARCH_VECTOR, persisted=True)))
 
     category = relationship("Category", back_populates="products")
     sales = relationship("Sale", back_populates="product")
     inventory_items = relationship("Inventory", back_populates="product")
 
+    __table_args__ = (
+        Index("ix_products_search_vector", "search_vector", postgresql_using="gin"),
+        Index("ix_products_sku", "sku", unique=True),
+    )
+
 
 class Inventory(Base):
     __tablename__ = "inventory"
@@ -54,29 +76,119 @@ class Inventory(Base):
 
     __table_args__ = (
         UniqueConstraint("product_id", "channel", name="uix_product_channel"),
+        Index("ix_inventory_channel", "channel"),
+        # Partial index holding exactly the rows the low-stock report returns
+        Index(
+            "ix_inventory_low_stock",
+            "id",
+            postgresql_where=quantity <= reorder_level,
+        ),
     )
 
 
 class InventoryHistory(Base):
     __tablename__ = "inventory_history"
     id = Column(Integer, primary_key=True)
-    inventory_id = Column(
-        Integer, ForeignKey("inventory.id"), nullable=False, index=True
-    )
+    inventory_id = Column(Integer, ForeignKey("inventory.id"), nullable=False)
     change_qty = Column(Integer, nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
     comment = Column(String)
 
     inventory = relationship("Inventory", back_populates="history")
 
+    __table_args__ = (
+        # Replays between snapshots read one item's rows in (timestamp, id) order
+        Index(
+            "ix_inventory_history_inventory_timestamp_id",
+            "inventory_id",
+            "timestamp",
+            "id",
+            postgresql_include=["change_qty"],
+        ),
+    )
+
+
+class InventorySnapshot(Base):
+    # Quantity of an item once every history row up to and including
+    # (taken_at, history_id) is applied, written by database.snapshots
+    __tablename__ = "inventory_snapshots"
+    inventory_id = Column(Integer, ForeignKey("inventory.id"), primary_key=True)
+    taken_at = Column(DateTime(timezone=True), primary_key=True)
+    history_id = Column(Integer, primary_key=True)
+    quantity = Column(Integer, nullable=False)
+
 
 class Sale(Base):
     __tablename__ = "sales"
-    id = Column(Integer, primary_key=True)
-    product_id = Column(Integer, ForeignKey("products.id"), nullable=False, index=True)
-    channel = Column(String, nullable=False, index=True)
+    # Partitioned by month on sale_date (see database.partitions), so the
+    # partition key is part of the primary key
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    channel = Column(String, nullable=False)
     quantity = Column(Integer, nullable=False)
     price = Column(Float, nullable=False)
-    sale_date = Column(DateTime, nullable=False, index=True, server_default=func.now())
+    sale_date = Column(
+        DateTime, primary_key=True, nullable=False, server_default=func.now()
+    )
 
     product = relationship("Product", back_populates="sales")
+
+    # Indexes follow the read paths: an optional channel or product equality,
+    # then the (sale_date, id) keyset order. The INCLUDE columns let listings
+    # and exports run as index-only scans.
+    __table_args__ = (
+        Index("ix_sales_sale_date_id", "sale_date", "id"),
+        Index(
+            "ix_sales_channel_sale_date_id",
+            "channel",
+            "sale_date",
+            "id",
+            postgresql_include=["product_id", "quantity", "price"],
+        ),
+        Index(
+            "ix_sales_product_sale_date_id",
+            "product_id",
+            "sale_date",
+            "id",
+            postgresql_include=["channel", "quantity", "price"],
+        ),
+        # Tiny block range index for date range scans over append-only history
+        Index("ix_sales_sale_date_brin", "sale_date", postgresql_using="brin"),
+        {"postgresql_partition_by": "RANGE (sale_date)"},
+    )
+
+
+class SalesDaily(Base):
+    # Pre-aggregated revenue and units per (day, product, channel), kept in step
+    # with sales by database.rollup
+    __tablename__ = "sales_daily"
+    day = Column(Date, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    channel = Column(String, primary_key=True)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0)
+
+    __table_args__ = (
+        Index(
+            "ix_sales_daily_product_day",
+            "product_id",
+            "day",
+            postgresql_include=["revenue"],
+        ),
+        Index(
+            "ix_sales_daily_channel_day",
+            "channel",
+            "day",
+            postgresql_include=["revenue"],
+        ),
+        # Partitioned by year on day (see database.partitions)
+        {"postgresql_partition_by": "RANGE (day)"},
+    )
+
+
+class CatalogVersion(Base):
+    # A single row bumped by every transaction that writes categories or
+    # products; catalog ETags are derived from it (see etags)
+    __tablename__ = "catalog_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False)
@@ -0,0 +1,186 @@
+import argparse
+import os
+import re
+from datetime import date, datetime
+
+from sqlalchemy import text
+
+import database.models as models
+
+# Range partitioned tables: partition key column and partition width
+PARTITIONED_TABLES = {
+    "sales": ("sale_date", "month"),
+    "sales_daily": ("day", "year"),
+}
+# Months of empty sales partitions kept ready ahead of the clock
+PARTITIONS_AHEAD = int(os.getenv("PARTITIONS_AHEAD", "3"))
+
+
+def _day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def period_start(table, day):
+    width = PARTITIONED_TABLES[table][1]
+    day = _day(day)
+    if width == "year":
+        return date(day.year, 1, 1)
+    return date(day.year, day.month, 1)
+
+
+def next_period(table, start):
+    if PARTITIONED_TABLES[table][1] == "year":
+        return date(start.year + 1, 1, 1)
+    if start.month == 12:
+        return date(start.year + 1, 1, 1)
+    return date(start.year, start.month + 1, 1)
+
+
+def partition_name(table, start):
+    if PARTITIONED_TABLES[table][1] == "year":
+        return f"{table}_{start:%Y}"
+    return f"{table}_{start:%Y_%m}"
+
+
+def create_partition(conn, table, start):
+    # IF NOT EXISTS returns before locking the parent, so repeating this for
+    # partitions that exist is cheap
+    conn.execute(
+        text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(table, start)}"
+            f" PARTITION OF {table}"
+            f" FOR VALUES FROM ('{start}') TO ('{next_period(table, start)}')"
+        )
+    )
+
+
+def ensure_partitions(conn, table, days):
+    # Make sure rows dated on these days have a partition to land in
+    for start in sorted({period_start(table, day) for day in days}):
+        create_partition(conn, table, start)
+
+
+def ensure_range(conn, table, first, last):
+    start = period_start(table, first)
+    while start <= _day(last):
+        create_partition(conn, table, start)
+        start = next_period(table, start)
+
+
+def ensure_future_partitions(engine, ahead=PARTITIONS_AHEAD):
+    today = date.today()
+    month = today.month - 1 + ahead
+    horizon = date(today.year + month // 12, month % 12 + 1, 1)
+    with engine.begin() as conn:
+        for table in PARTITIONED_TABLES:
+            ensure_range(conn, table, today, horizon)
+
+
+def list_partitions(conn, table):
+    # (name, start) of the attached partitions, oldest first
+    names = conn.scalars(
+        text(
+            "SELECT child.relname FROM pg_inherits"
+            " JOIN pg_class child ON child.oid = pg_inherits.inhrelid"
+            " WHERE pg_inherits.inhparent = to_regclass(:table)"
+        ),
+        {"table": table},
+    )
+    pattern = re.compile(rf"^{table}_(\d{{4}})(?:_(\d{{2}}))?$")
+    partitions = []
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            year, month = match.groups()
+            partitions.append((name, date(int(year), int(month or 1), 1)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def detach_partitions(conn, table, before, drop=False):
+    # Detach every partition that ends on or before `before`. Detached tables
+    # keep their rows for archiving (e.g. pg_dump -t) unless dropped.
+    detached = []
+    for name, start in list_partitions(conn, table):
+        if next_period(table, start) > before:
+            continue
+        conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+        if drop:
+            conn.execute(text(f"DROP TABLE {name}"))
+        detached.append(name)
+    return detached
+
+
+def convert_to_partitioned(conn, table):
+    # Rebuild a plain table from before partitioning as a partitioned one
+    kind = conn.scalar(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"),
+        {"table": table},
+    )
+    if kind != "r":
+        return
+    legacy = f"{table}_legacy"
+    conn.execute(text(f"ALTER TABLE {table} RENAME TO {legacy}"))
+    # Free the index, constraint and sequence names for the new table
+    for index in conn.scalars(
+        text("SELECT indexname FROM pg_indexes WHERE tablename = :table"),
+        {"table": legacy},
+    ).all():
+        conn.execute(text(f"ALTER INDEX {index} RENAME TO {index}_legacy"))
+    source = models.Base.metadata.tables[table]
+    sequence = None
+    if "id" in source.columns:
+        sequence = conn.scalar(
+            text("SELECT pg_get_serial_sequence(:table, 'id')"), {"table": legacy}
+        )
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} RENAME TO {legacy}_id_seq"))
+
+    source.create(conn)
+    column = PARTITIONED_TABLES[table][0]
+    first, last = conn.execute(
+        text(f"SELECT min({column}), max({column}) FROM {legacy}")
+    ).one()
+    if first is not None:
+        ensure_range(conn, table, first, last)
+    columns = ", ".join(source.columns.keys())
+    conn.execute(
+        text(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM {legacy}")
+    )
+    if sequence:
+        # Continue numbering where the legacy table stopped
+        conn.execute(
+            text(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'),"
+                f" (SELECT max(id) FROM {legacy}))"
+            )
+        )
+    conn.execute(text(f"DROP TABLE {legacy}"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage range partitions.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ensure = commands.add_parser("ensure", help="create upcoming partitions")
+    ensure.add_argument("--ahead", type=int, default=PARTITIONS_AHEAD, help="months")
+    commands.add_parser("list", help="list attached partitions")
+    detach = commands.add_parser("detach", help="detach partitions for archiving")
+    detach.add_argument("--table", choices=PARTITIONED_TABLES, default="sales")
+    detach.add_argument(
+        "--before", type=date.fromisoformat, required=True, help="cutoff day (ISO)"
+    )
+    detach.add_argument("--drop", action="store_true", help="drop after detaching")
+    args = parser.parse_args()
+
+    from database.database import engine, init_db
+
+    init_db()
+    if args.command == "ensure":
+        ensure_future_partitions(engine, args.ahead)
+    elif args.command == "detach":
+        with engine.begin() as conn:
+            names = detach_partitions(conn, args.table, args.before, args.drop)
+        print(f"{'Dropped' if args.drop else 'Detached'}: {', '.join(names) or 'none'}")
+    with engine.connect() as conn:
+        for table in PARTITIONED_TABLES:
+            for name, start in list_partitions(conn, table):
+                print(f"{table}: {name} from {start}")
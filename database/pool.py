@@ -0,0 +1,111 @@
+import threading
+import time
+
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+
+class TimedPoolMixin:
+    # Records how long checkouts wait for a connection, which the pool itself
+    # does not expose. Stats live on the pool instance, so they reset when the
+    # engine is disposed.
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.wait_lock = threading.Lock()
+        self.wait_stats = {
+            "checkouts": 0,
+            "timeouts": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+        }
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self.wait_lock:
+                stats = self.wait_stats
+                stats["checkouts"] += 1
+                stats["timeouts"] += timed_out
+                stats["wait_seconds_total"] += waited
+                stats["wait_seconds_max"] = max(stats["wait_seconds_max"], waited)
+
+    def recreate(self):
+        # Keep the subclass when SQLAlchemy rebuilds the pool after a dispose
+        pool = super().recreate()
+        pool.wait_stats = self.wait_stats
+        return pool
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    pass
+
+
+class TimedAsyncAdaptedQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+
+def pool_status(pool):
+    # NullPool (PgBouncer mode) keeps no connections, so only the class is known
+    status = {"pool": type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            idle=pool.checkedin(),
+            overflow=max(pool.overflow(), 0),
+            max_overflow=pool._max_overflow,
+            timeout=pool.timeout(),
+        )
+    if isinstance(pool, TimedPoolMixin):
+        with pool.wait_lock:
+            stats = dict(pool.wait_stats)
+        stats["wait_seconds_avg"] = (
+            stats["wait_seconds_total"] / stats["checkouts"]
+            if stats["checkouts"]
+            else 0.0
+        )
+        status.update(stats)
+    return status
+
+
+POOL_GAUGES = (
+    ("db_pool_size", "size", "Configured pool size."),
+    ("db_pool_checked_out", "checked_out", "Connections currently checked out."),
+    ("db_pool_idle", "idle", "Idle connections held by the pool."),
+    ("db_pool_overflow", "overflow", "Overflow connections currently open."),
+)
+POOL_COUNTERS = (
+    ("db_pool_checkouts_total", "checkouts", "Connection checkouts."),
+    ("db_pool_timeouts_total", "timeouts", "Checkouts that timed out."),
+    (
+        "db_pool_wait_seconds_total",
+        "wait_seconds_total",
+        "Seconds spent waiting for a connection.",
+    ),
+)
+
+
+def pool_metric_lines(engines):
+    # Prometheus exposition lines for every engine that keeps a pool
+    statuses = {
+        name: pool_status(engine.pool)
+        for name, engine in engines.items()
+        if engine is not None
+    }
+    lines = []
+    for kind, metrics in (("gauge", POOL_GAUGES), ("counter", POOL_COUNTERS)):
+        for metric, key, description in metrics:
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, status in statuses.items():
+                if key in status:
+                    lines.append(f'{metric}{{engine="{name}"}} {status[key]}')
+    return lines
@@ -1,6 +1,8 @@
-from database import init_db
-from database import SessionLocal
-import models
+from database import crud
+from database.database import SessionLocal, init_db
+import database.models as models
+from database.partitions import ensure_partitions
+from database.rollup import record_sales
 from datetime import datetime
 
 
@@ -64,6 +66,7 @@ def populate():
         )
         db.add(p)
         product_objs.append(p)
+    crud.bump_catalog_version(db)
     db.commit()
     for p in product_objs:
         db.refresh(p)
@@ -93,7 +96,6 @@ def populate():
         },
         {"product": "Blender", "channel": "Amazon", "quantity": 10, "reorder": 3},
         {"product": "Blender", "channel": "Walmart", "quantity": 12, "reorder": 3},
-        {"product": "TV", "channel": "Walmart", "quantity": 12, "reorder": 50},
     ]
     inventory_objs = []
     for inv in inventory_entries:
@@ -198,15 +200,20 @@ def populate():
             "date": "2024-12-25",
         },
     ]
-    for sd in sales_data:
-        sale = models.Sale(
-            product_id=product_map[sd["product"]],
-            channel=sd["channel"],
-            quantity=sd["quantity"],
-            price=sd["price"],
-            sale_date=datetime.fromisoformat(sd["date"]),
-        )
-        db.add(sale)
+    sales = [
+        {
+            "product_id": product_map[sd["product"]],
+            "channel": sd["channel"],
+            "quantity": sd["quantity"],
+            "price": sd["price"],
+            "sale_date": datetime.fromisoformat(sd["date"]),
+        }
+        for sd in sales_data
+    ]
+    ensure_partitions(db, "sales", (sale["sale_date"] for sale in sales))
+    for sale in sales:
+        db.add(models.Sale(**sale))
+    record_sales(db, sales)
     db.commit()
 
     print("Database has been populated with demo data.")
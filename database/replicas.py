@@ -0,0 +1,125 @@
+import itertools
+import logging
+import math
+from datetime import datetime
+
+from sqlalchemy import event, text
+
+logger = logging.getLogger("replicas")
+
+# Set on responses to writes; while present, the client's reads stay on the
+# primary so it sees what it just wrote
+READ_PRIMARY_COOKIE = "read_primary"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+LAG_SQL = text(
+    # A streaming replica that has replayed everything it received is current,
+    # however long ago the primary last committed. Without a visible streaming
+    # receiver, fall back to the age of the last replayed transaction.
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0"
+    " WHEN pg_last_wal_receive_lsn() <= pg_last_wal_replay_lsn() AND EXISTS"
+    " (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN 0"
+    " ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class Replica:
+    def __init__(self, name, url, engine, serving_engine, session_factory):
+        self.name = name
+        self.url = url
+        self.engine = engine
+        self.serving_engine = serving_engine
+        self.session_factory = session_factory
+        self.healthy = False
+        self.lag = None
+        self.checked_at = None
+        # A dropped connection takes the replica out until the next good check
+        event.listen(
+            getattr(serving_engine, "sync_engine", serving_engine),
+            "handle_error",
+            self._on_error,
+        )
+
+    def _on_error(self, context):
+        if context.is_disconnect and self.healthy:
+            logger.warning("Replica %s disconnected", self.name)
+            self.healthy = False
+
+    def check(self):
+        try:
+            with self.engine.connect() as conn:
+                lag = float(conn.scalar(LAG_SQL) or 0)
+        except Exception as exc:
+            if self.healthy or self.checked_at is None:
+                logger.warning("Replica %s is unavailable: %s", self.name, exc)
+            self.healthy, self.lag = False, None
+        else:
+            self.healthy, self.lag = True, lag
+        self.checked_at = datetime.now()
+
+    def status(self):
+        return {
+            "name": self.name,
+            "url": self.url,
+            "healthy": self.healthy,
+            "lag_seconds": self.lag,
+            "checked_at": self.checked_at,
+        }
+
+
+class ReplicaSet:
+    def __init__(self, replicas, max_lag):
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self._turn = itertools.count()
+
+    def __bool__(self):
+        return bool(self.replicas)
+
+    def pick(self):
+        # Round-robin over replicas that answered the last check within the
+        # lag bound; None sends the read to the primary
+        usable = [
+            replica
+            for replica in self.replicas
+            if replica.healthy and replica.lag <= self.max_lag
+        ]
+        if not usable:
+            return None
+        return usable[next(self._turn) % len(usable)]
+
+    def check(self):
+        for replica in self.replicas:
+            replica.check()
+
+    def status(self):
+        return {
+            "max_lag_seconds": self.max_lag,
+            "replicas": [replica.status() for replica in self.replicas],
+        }
+
+
+class ReadYourWritesMiddleware:
+    # Plain ASGI middleware: a successful write pins the client's reads to the
+    # primary for as long as a usable replica may still be behind
+
+    def __init__(self, app, seconds):
+        self.app = app
+        self.cookie = (
+            f"{READ_PRIMARY_COOKIE}=1; Max-Age={math.ceil(seconds)}; Path=/;"
+            " HttpOnly; SameSite=Lax"
+        ).encode()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in SAFE_METHODS:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                headers = list(message.get("headers", []))
+                headers.append((b"set-cookie", self.cookie))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
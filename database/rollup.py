@@ -0,0 +1,107 @@
+import argparse
+from datetime import date, timedelta
+
+from sqlalchemy import Date, cast, delete, func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from cache import response_cache
+from database.database import SessionLocal, init_db
+import database.models as models
+from database.partitions import ensure_partitions, ensure_range
+
+
+def record_sales(db, sales):
+    # Fold newly written sales into the rollup. Call it in the transaction that
+    # inserts the sales so the rollup never drifts from the raw table.
+    buckets = {}
+    for sale in sales:
+        key = (sale["sale_date"].date(), sale["product_id"], sale["channel"])
+        units, revenue = buckets.get(key, (0, 0.0))
+        buckets[key] = (
+            units + sale["quantity"],
+            revenue + sale["quantity"] * sale["price"],
+        )
+    if not buckets:
+        return
+    ensure_partitions(db, "sales_daily", (day for day, _, _ in buckets))
+    # Sorted keys give concurrent writers the same lock order
+    rows = [
+        {
+            "day": day,
+            "product_id": product_id,
+            "channel": channel,
+            "units": units,
+            "revenue": revenue,
+        }
+        for (day, product_id, channel), (units, revenue) in sorted(buckets.items())
+    ]
+    stmt = insert(models.SalesDaily.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[
+            models.SalesDaily.day,
+            models.SalesDaily.product_id,
+            models.SalesDaily.channel,
+        ],
+        set_={
+            "units": models.SalesDaily.units + stmt.excluded.units,
+            "revenue": models.SalesDaily.revenue + stmt.excluded.revenue,
+        },
+    )
+    db.execute(stmt, rows)
+
+
+def rebuild(db, start: date = None, end: date = None):
+    # Recompute the rollup from the raw sales table, optionally for a day range
+    # Block concurrent record_sales calls so no sale is counted twice or lost
+    db.execute(text("LOCK TABLE sales_daily IN EXCLUSIVE MODE"))
+
+    day = cast(models.Sale.sale_date, Date)
+    cleanup = delete(models.SalesDaily)
+    source = select(
+        day.label("day"),
+        models.Sale.product_id,
+        models.Sale.channel,
+        func.sum(models.Sale.quantity),
+        func.sum(models.Sale.quantity * models.Sale.price),
+    )
+    bounds = select(func.min(day), func.max(day))
+    if start:
+        cleanup = cleanup.where(models.SalesDaily.day >= start)
+        source = source.where(models.Sale.sale_date >= start)
+        bounds = bounds.where(models.Sale.sale_date >= start)
+    if end:
+        cleanup = cleanup.where(models.SalesDaily.day <= end)
+        # Plain bounds on sale_date let the planner prune sales partitions
+        source = source.where(models.Sale.sale_date < end + timedelta(days=1))
+        bounds = bounds.where(models.Sale.sale_date < end + timedelta(days=1))
+    source = source.group_by(day, models.Sale.product_id, models.Sale.channel)
+
+    first, last = db.execute(bounds).one()
+    if first is not None:
+        ensure_range(db, "sales_daily", first, last)
+    db.execute(cleanup)
+    result = db.execute(
+        insert(models.SalesDaily).from_select(
+            ["day", "product_id", "channel", "units", "revenue"], source
+        )
+    )
+    db.commit()
+    response_cache.clear()
+    return result.rowcount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Backfill the sales_daily rollup from the sales table."
+    )
+    parser.add_argument("--start", type=date.fromisoformat, help="first day (ISO)")
+    parser.add_argument("--end", type=date.fromisoformat, help="last day (ISO)")
+    args = parser.parse_args()
+
+    init_db()
+    db = SessionLocal()
+    try:
+        rows = rebuild(db, args.start, args.end)
+    finally:
+        db.close()
+    print(f"Rebuilt sales_daily with {rows} rows.")
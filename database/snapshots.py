@@ -0,0 +1,107 @@
+import argparse
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, insert, or_, select, true, tuple_
+
+import database.models as models
+
+# History rows between two snapshots of an item, and so the most rows an as-of
+# lookup replays, apart from those newer than the last compaction
+SNAPSHOT_EVERY = int(os.getenv("SNAPSHOT_EVERY", "500"))
+# Newer history is left to the next run: a transaction still in flight may yet
+# commit a row with an earlier timestamp
+SNAPSHOT_LAG = timedelta(minutes=5)
+# Arbitrary key for pg_try_advisory_xact_lock, so one worker compacts at a time
+SNAPSHOT_LOCK_KEY = 7302
+
+
+def history_order():
+    return tuple_(models.InventoryHistory.timestamp, models.InventoryHistory.id)
+
+
+def compact(engine, every=SNAPSHOT_EVERY, lag=SNAPSHOT_LAG):
+    # Snapshot every item at each every-th history row after its last snapshot.
+    # Items without one start from their current quantity minus all of their
+    # history, so rows predating the ledger count as the opening stock.
+    history = models.InventoryHistory
+    snapshot = models.InventorySnapshot
+    inventory = models.Inventory
+    with engine.begin() as conn:
+        if not conn.scalar(select(func.pg_try_advisory_xact_lock(SNAPSHOT_LOCK_KEY))):
+            return 0
+        last = (
+            select(snapshot.quantity, snapshot.taken_at, snapshot.history_id)
+            .where(snapshot.inventory_id == inventory.id)
+            .order_by(snapshot.taken_at.desc(), snapshot.history_id.desc())
+            .limit(1)
+            .lateral("last")
+        )
+        start = (
+            select(
+                inventory.id.label("inventory_id"),
+                inventory.quantity.label("current"),
+                last.c.quantity,
+                last.c.taken_at,
+                last.c.history_id,
+            )
+            .outerjoin(last, true())
+            .subquery("start")
+        )
+        window = dict(
+            partition_by=history.inventory_id,
+            order_by=(history.timestamp, history.id),
+        )
+        cutoff = datetime.now(timezone.utc) - lag
+        steps = (
+            select(
+                history.inventory_id,
+                history.timestamp,
+                history.id,
+                start.c.current,
+                start.c.quantity,
+                func.sum(history.change_qty).over(**window).label("change"),
+                func.row_number().over(**window).label("n"),
+            )
+            .join(start, start.c.inventory_id == history.inventory_id)
+            .where(
+                history.timestamp < cutoff,
+                or_(
+                    start.c.taken_at.is_(None),
+                    history_order() > tuple_(start.c.taken_at, start.c.history_id),
+                ),
+            )
+            .subquery("steps")
+        )
+        # Only evaluated for the rows that become snapshots
+        ledger = (
+            select(func.coalesce(func.sum(history.change_qty), 0))
+            .where(history.inventory_id == steps.c.inventory_id)
+            .scalar_subquery()
+        )
+        result = conn.execute(
+            insert(snapshot).from_select(
+                ["inventory_id", "taken_at", "history_id", "quantity"],
+                select(
+                    steps.c.inventory_id,
+                    steps.c.timestamp,
+                    steps.c.id,
+                    func.coalesce(steps.c.quantity, steps.c.current - ledger)
+                    + steps.c.change,
+                ).where(steps.c.n % every == 0),
+            )
+        )
+        return result.rowcount
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Write inventory snapshots for point-in-time lookups."
+    )
+    parser.add_argument("--every", type=int, default=SNAPSHOT_EVERY)
+    args = parser.parse_args()
+
+    from database.database import engine, init_db
+
+    init_db()
+    print(f"{compact(engine, args.every)} snapshots written")
@@ -0,0 +1,90 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from fastapi import Response
+
+from metrics import REGISTRY, CounterMetric
+from pagination import PAGINATION_HEADERS
+from serialization import dumps
+
+# Serialized catalog responses kept per worker, keyed by ETag; 0 keeps none,
+# so only conditional requests are answered without running the query
+CATALOG_BODY_CACHE_ENTRIES = int(os.getenv("CATALOG_BODY_CACHE_ENTRIES", "256"))
+
+CATALOG_EVENTS = CounterMetric(
+    "catalog_etag_events_total",
+    "Catalog reads answered with 304, from cached bodies, or from the database.",
+    ("event",),
+)
+REGISTRY.append(CATALOG_EVENTS)
+
+
+def _matches(header, etag):
+    # If-None-Match compares weakly: W/ prefixes are ignored, * matches all
+    tags = [tag.strip() for tag in header.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+class CatalogCache:
+    # ETags are the catalog version plus a digest of the URL, so a response
+    # is known current without running its query. The version is read from
+    # the primary (crud.catalog_version), so every worker agrees on it and a
+    # lagging replica never hands out an older one; bodies of older versions
+    # are never looked up again and age out of the LRU.
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.bodies = OrderedDict()
+        self.lock = threading.Lock()
+
+    def etag(self, request, version):
+        url = f"{request.url.path}?{request.url.query}".encode()
+        digest = hashlib.sha1(url).hexdigest()[:16]
+        return f'"{version}-{digest}"'
+
+    def get(self, request, etag):
+        # A 304 or the cached body for etag, otherwise None
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and _matches(if_none_match, etag):
+            CATALOG_EVENTS.inc("not_modified")
+            return Response(status_code=304, headers=headers)
+        with self.lock:
+            entry = self.bodies.get(etag)
+            if entry is not None:
+                self.bodies.move_to_end(etag)
+        if entry is None:
+            CATALOG_EVENTS.inc("miss")
+            return None
+        CATALOG_EVENTS.inc("hit")
+        body, stored_headers = entry
+        return Response(
+            body, media_type="application/json", headers=stored_headers | headers
+        )
+
+    def store(self, etag, data, response=None):
+        # Keeps the pagination headers the endpoint set on its injected response
+        body = dumps(data)
+        stored_headers = {}
+        if response is not None:
+            stored_headers = {
+                name: response.headers[name]
+                for name in PAGINATION_HEADERS
+                if name in response.headers
+            }
+        if self.max_entries > 0:
+            with self.lock:
+                self.bodies[etag] = (body, stored_headers)
+                self.bodies.move_to_end(etag)
+                while len(self.bodies) > self.max_entries:
+                    self.bodies.popitem(last=False)
+        return Response(
+            body,
+            media_type="application/json",
+            headers=stored_headers | {"ETag": etag, "Cache-Control": "no-cache"},
+        )
+
+
+catalog_cache = CatalogCache(CATALOG_BODY_CACHE_ENTRIES)
@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+from datetime import date, timedelta
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Trailing days of sales behind the velocities, unless the request says otherwise
+FORECAST_DAYS = int(os.getenv("FORECAST_DAYS", "28"))
+# The short moving average catches items whose sales are picking up
+RECENT_DAYS = 7
+# Velocities are recomputed after sales are written through this worker, or
+# after this many seconds for sales written through other workers
+FORECAST_CACHE_SECONDS = float(os.getenv("FORECAST_CACHE_SECONDS", "300"))
+# Inventory columns the projection reads, in order
+INVENTORY_COLUMNS = ("id", "product_id", "channel", "quantity", "reorder_level")
+
+
+class Velocities:
+    # Average units per day for every (product, channel) that sold in the
+    # window, sorted by key so inventory rows can be matched with searchsorted
+
+    def __init__(self, channels, keys, window, recent):
+        self.channels = channels
+        self.keys = keys
+        self.window = window
+        self.recent = recent
+
+
+def compute_velocities(rows, days):
+    # rows are (product_id, channel, day offset in the window, units), one per
+    # sales_daily bucket
+    recent_days = min(RECENT_DAYS, days)
+    if not rows:
+        empty = np.zeros(0)
+        return Velocities({}, np.zeros(0, np.int64), empty, empty)
+    product_ids, channel_names, offsets, units = zip(*rows)
+    channels = {name: code for code, name in enumerate(sorted(set(channel_names)))}
+    codes = np.fromiter((channels[name] for name in channel_names), np.int64)
+    composite = np.array(product_ids, np.int64) * len(channels) + codes
+    keys, inverse = np.unique(composite, return_inverse=True)
+    # One row per item and a column per day, zero on days without sales
+    series = np.zeros((len(keys), days))
+    np.add.at(series, (inverse, np.array(offsets, np.int64)), np.array(units))
+    return Velocities(
+        channels,
+        keys,
+        series.sum(axis=1) / days,
+        series[:, -recent_days:].sum(axis=1) / recent_days,
+    )
+
+
+def project(velocities, inventory, today, limit):
+    # Days until each inventory row runs out at the higher of its two moving
+    # averages, most urgent first; rows that are not selling come last
+    if not inventory:
+        return []
+    ids, product_ids, channel_names, quantities, reorder_levels = (
+        np.array(column) for column in zip(*inventory)
+    )
+    ids = ids.astype(np.int64)
+    quantities = quantities.astype(np.float64)
+    reorder_levels = reorder_levels.astype(np.float64)
+    window = np.zeros(len(ids))
+    recent = np.zeros(len(ids))
+    if len(velocities.keys):
+        # Channels are few, so they are looked up once each
+        names, inverse = np.unique(channel_names, return_inverse=True)
+        codes = np.array(
+            [velocities.channels.get(name, -1) for name in names.tolist()], np.int64
+        )[inverse]
+        composite = product_ids.astype(np.int64) * len(velocities.channels) + codes
+        positions = np.searchsorted(velocities.keys, composite)
+        positions = np.minimum(positions, len(velocities.keys) - 1)
+        found = (codes >= 0) & (velocities.keys[positions] == composite)
+        window[found] = velocities.window[positions[found]]
+        recent[found] = velocities.recent[positions[found]]
+    rate = np.maximum(window, recent)
+    selling = rate > 0
+    stockout = np.full(len(ids), np.inf)
+    reorder = np.full(len(ids), np.inf)
+    stockout[selling] = np.maximum(quantities[selling], 0) / rate[selling]
+    reorder[selling] = (
+        np.maximum(quantities[selling] - reorder_levels[selling], 0) / rate[selling]
+    )
+    order = np.lexsort((ids, stockout))[:limit]
+
+    def finite(value):
+        return None if np.isinf(value) else round(float(value), 2)
+
+    results = []
+    for i in order.tolist():
+        days_left = finite(stockout[i])
+        results.append(
+            {
+                "id": int(ids[i]),
+                "product_id": int(product_ids[i]),
+                "channel": str(channel_names[i]),
+                "quantity": int(quantities[i]),
+                "reorder_level": int(reorder_levels[i]),
+                "velocity": round(float(window[i]), 3),
+                "recent_velocity": round(float(recent[i]), 3),
+                "days_until_reorder": finite(reorder[i]),
+                "days_until_stockout": days_left,
+                "stockout_date": (
+                    today + timedelta(days=int(days_left))
+                    if days_left is not None
+                    else None
+                ),
+            }
+        )
+    return results
+
+
+class VelocityCache:
+    # Velocities per window length, computed for the current day and dropped
+    # when sales are written. The generation keeps a computation that raced
+    # an invalidation from being stored.
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def begin(self):
+        return self.generation
+
+    def get(self, days):
+        with self.lock:
+            entry = self.entries.get(days)
+            if entry is None:
+                return None
+            velocities, day, expires = entry
+            if day != date.today() or expires < time.monotonic():
+                del self.entries[days]
+                return None
+            return velocities
+
+    def store(self, days, velocities, generation):
+        with self.lock:
+            if generation == self.generation:
+                self.entries[days] = (
+                    velocities,
+                    date.today(),
+                    time.monotonic() + self.ttl,
+                )
+        return velocities
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+
+velocity_cache = VelocityCache(FORECAST_CACHE_SECONDS)
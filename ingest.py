@@ -0,0 +1,257 @@
+import asyncio
+import itertools
+import logging
+import os
+from collections import deque
+
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from database import crud
+from database.database import run_db, session_scope
+from metrics import COLLECTORS, REGISTRY, CounterMetric
+import schemas
+
+logger = logging.getLogger("ingest")
+
+# Sales held in memory before POST /sales/ingest starts pushing back
+INGEST_BUFFER_SIZE = int(os.getenv("INGEST_BUFFER_SIZE", "10000"))
+# A batch is written once it has this many sales or its first sale has
+# waited INGEST_FLUSH_SECONDS, whichever comes first
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+INGEST_FLUSH_SECONDS = float(os.getenv("INGEST_FLUSH_SECONDS", "0.05"))
+# Seconds a request waits for room in a full buffer before it gets a 503
+INGEST_WAIT_SECONDS = float(os.getenv("INGEST_WAIT_SECONDS", "1"))
+# Append-only file of acknowledged sales, replayed after a crash. Each worker
+# process needs a path of its own.
+INGEST_SPOOL_PATH = os.getenv("INGEST_SPOOL_PATH")
+# Seconds shutdown waits for the buffer to be written
+INGEST_DRAIN_SECONDS = float(os.getenv("INGEST_DRAIN_SECONDS", "30"))
+INGEST_RETRY_SECONDS = (0.5, 1, 2, 5, 10)
+
+INGEST_EVENTS = CounterMetric(
+    "sale_ingest_sales_total",
+    "Sales taken by POST /sales/ingest, by outcome.",
+    ("outcome",),
+)
+REGISTRY.append(INGEST_EVENTS)
+
+
+class IngestBufferFull(Exception):
+    pass
+
+
+def transient(exc):
+    # Failures of the connection or the server, which a retry can get past;
+    # anything else would fail the same batch again
+    if isinstance(exc, DBAPIError) and exc.connection_invalidated:
+        return True
+    return isinstance(
+        exc, (OperationalError, InterfaceError, PoolTimeoutError, OSError)
+    )
+
+
+class Spool:
+    # Acknowledged sales as JSON lines, plus the offset up to which they are
+    # committed. A crash between a commit and its offset update replays that
+    # batch, so delivery is at least once.
+
+    def __init__(self, path):
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.committed = 0
+
+    def open(self):
+        # Sales past the committed offset, each with its size in the file
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path) as f:
+                self.committed = int(f.read() or 0)
+        pending = []
+        # A crash between emptying the file and resetting the offset leaves
+        # the offset past the end
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < self.committed:
+            self.committed = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                f.seek(self.committed)
+                for line in f:
+                    # A torn last line was never acknowledged
+                    if line.endswith(b"\n"):
+                        pending.append((schemas.SaleCreate.parse_raw(line), len(line)))
+        self.file = open(self.path, "ab")
+        self.file.truncate(self.committed + sum(size for _, size in pending))
+        return pending
+
+    def append(self, sale):
+        line = sale.json().encode() + b"\n"
+        # Flushed to the OS, so it survives the process but not the machine
+        self.file.write(line)
+        self.file.flush()
+        return len(line)
+
+    def commit(self, size, empty):
+        self.committed += size
+        if empty:
+            # Everything written is committed, so start the file over
+            self.file.truncate(0)
+            self.committed = 0
+        tmp = self.offset_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(self.committed))
+        os.replace(tmp, self.offset_path)
+
+    def close(self):
+        self.file.close()
+
+
+class SaleIngestQueue:
+    # Write-behind buffer: requests append and return, one flusher per worker
+    # writes the buffer through crud.bulk_create_sales in batches
+
+    def __init__(self, size, batch_size, flush_seconds, spool_path=None):
+        self.size = size
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.spool = Spool(spool_path) if spool_path else None
+        # (sale, bytes in the spool)
+        self.pending = deque()
+        self.changed = asyncio.Condition()
+        self.stopping = False
+        self.task = None
+
+    async def submit(self, sale, wait):
+        if self.stopping:
+            INGEST_EVENTS.inc("refused")
+            raise IngestBufferFull
+        async with self.changed:
+            try:
+                await asyncio.wait_for(
+                    self.changed.wait_for(lambda: len(self.pending) < self.size), wait
+                )
+            except asyncio.TimeoutError:
+                INGEST_EVENTS.inc("refused")
+                raise IngestBufferFull
+            # Spooled and buffered in one step, so both keep the same order
+            size = self.spool.append(sale) if self.spool else 0
+            self.pending.append((sale, size))
+            self.changed.notify_all()
+            INGEST_EVENTS.inc("accepted")
+            return len(self.pending)
+
+    async def next_batch(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.pending or self.stopping)
+            if not self.pending:
+                return None
+            try:
+                await asyncio.wait_for(
+                    self.changed.wait_for(
+                        lambda: len(self.pending) >= self.batch_size or self.stopping
+                    ),
+                    self.flush_seconds,
+                )
+            except asyncio.TimeoutError:
+                pass
+            count = min(self.batch_size, len(self.pending))
+            batch = [self.pending.popleft() for _ in range(count)]
+            # Room for waiting requests while the batch is written
+            self.changed.notify_all()
+            return batch
+
+    async def write(self, sales):
+        # Transient failures are retried until the database takes the batch;
+        # meanwhile the buffer fills up and requests are pushed back. Any
+        # other failure is narrowed down by halves to the sales causing it,
+        # which are reported like rows bulk_create_sales rejects.
+        for attempt in itertools.count():
+            try:
+                async with session_scope() as db:
+                    return await run_db(db, crud.bulk_create_sales, sales)
+            except Exception as exc:
+                if not transient(exc):
+                    failure = exc
+                    break
+                delay = INGEST_RETRY_SECONDS[
+                    min(attempt, len(INGEST_RETRY_SECONDS) - 1)
+                ]
+                logger.exception("Writing %d buffered sales failed", len(sales))
+                await asyncio.sleep(delay)
+        if len(sales) == 1:
+            detail = str(getattr(failure, "orig", None) or failure).splitlines()
+            return {
+                "inserted": 0,
+                "errors": [
+                    {"index": 0, "detail": detail[0] if detail else repr(failure)}
+                ],
+            }
+        logger.warning(
+            "Writing %d buffered sales failed, retrying in halves",
+            len(sales),
+            exc_info=failure,
+        )
+        middle = len(sales) // 2
+        first = await self.write(sales[:middle])
+        second = await self.write(sales[middle:])
+        return {
+            "inserted": first["inserted"] + second["inserted"],
+            "errors": first["errors"]
+            + [
+                dict(error, index=error["index"] + middle) for error in second["errors"]
+            ],
+        }
+
+    async def run(self):
+        while True:
+            batch = await self.next_batch()
+            if batch is None:
+                return
+            result = await self.write([sale for sale, _ in batch])
+            INGEST_EVENTS.inc("inserted", amount=result["inserted"])
+            if result["errors"]:
+                INGEST_EVENTS.inc("rejected", amount=len(result["errors"]))
+                for error in result["errors"]:
+                    logger.warning(
+                        "Dropped buffered sale %s: %s",
+                        batch[error["index"]][0].json(),
+                        error["detail"],
+                    )
+            if self.spool:
+                self.spool.commit(sum(size for _, size in batch), not self.pending)
+
+    def start(self):
+        # Before the first request, so submissions always find the spool open
+        if self.spool:
+            replayed = self.spool.open()
+            if replayed:
+                logger.info("Replaying %d spooled sales", len(replayed))
+            self.pending.extend(replayed)
+        self.task = asyncio.create_task(self.run())
+
+    async def drain(self, timeout):
+        # New sales are refused; the buffer is written before the worker exits.
+        # Spooled sales that do not make it are replayed on the next start.
+        self.stopping = True
+        async with self.changed:
+            self.changed.notify_all()
+        try:
+            await asyncio.wait_for(self.task, timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                "Shutting down with %d buffered sales unwritten", len(self.pending)
+            )
+        finally:
+            if self.spool:
+                self.spool.close()
+
+    def metric_lines(self):
+        return [
+            "# HELP sale_ingest_buffered Sales waiting in the ingest buffer.",
+            "# TYPE sale_ingest_buffered gauge",
+            f"sale_ingest_buffered {len(self.pending)}",
+        ]
+
+
+sale_ingest = SaleIngestQueue(
+    INGEST_BUFFER_SIZE, INGEST_BATCH_SIZE, INGEST_FLUSH_SECONDS, INGEST_SPOOL_PATH
+)
+COLLECTORS.append(sale_ingest.metric_lines)
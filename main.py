@@ -1,11 +1,43 @@
+import asyncio
+
 from fastapi import FastAPI
-from database.database import init_db
+from cube import CUBE_ENABLED, CUBE_REFRESH_SECONDS, analytics_cube
+from database.database import (
+    REPLICA_CHECK_SECONDS,
+    REPLICA_MAX_LAG_SECONDS,
+    async_engine,
+    init_db,
+    maintain_partitions,
+    maintain_snapshots,
+    monitor_replicas,
+    replicas,
+)
+from database.replicas import ReadYourWritesMiddleware
+from ingest import INGEST_DRAIN_SECONDS, sale_ingest
+from routers.catalog import router as catalog_router
 from routers.categories import router as categories_router
 from routers.products import router as products_router
 from routers.inventory import router as inventory_router
 from routers.sales import router as sales_router
+from routers.diagnostics import router as diagnostics_router
+from metrics import MetricsMiddleware
+from stock_events import low_stock_events
 
 app = FastAPI(title="E-commerce Admin Dashboard API")
+app.add_middleware(MetricsMiddleware)
+if replicas:
+    # A replica inside the lag bound has caught up with a write once this long
+    # has passed, even if the write landed just after its last check
+    app.add_middleware(
+        ReadYourWritesMiddleware,
+        seconds=REPLICA_MAX_LAG_SECONDS + REPLICA_CHECK_SECONDS,
+    )
+
+
+# Seconds between checks that future partitions exist
+PARTITION_CHECK_INTERVAL = 6 * 60 * 60
+# Seconds between inventory snapshot runs
+SNAPSHOT_INTERVAL = 15 * 60
 
 
 @app.on_event("startup")
@@ -13,7 +45,48 @@ def on_startup():
     init_db()
 
 
+@app.on_event("startup")
+async def start_background_tasks():
+    app.state.partition_task = asyncio.create_task(
+        maintain_partitions(PARTITION_CHECK_INTERVAL)
+    )
+    app.state.snapshot_task = asyncio.create_task(maintain_snapshots(SNAPSHOT_INTERVAL))
+    app.state.stock_events_task = asyncio.create_task(low_stock_events.run())
+    sale_ingest.start()
+    app.state.replica_task = (
+        asyncio.create_task(monitor_replicas(REPLICA_CHECK_SECONDS))
+        if replicas
+        else None
+    )
+    # The cube loads in the background; revenue queries use SQL until it is ready
+    app.state.cube_task = (
+        asyncio.create_task(analytics_cube.run(CUBE_REFRESH_SECONDS))
+        if CUBE_ENABLED
+        else None
+    )
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    # Buffered sales are written while the database is still reachable
+    await sale_ingest.drain(INGEST_DRAIN_SECONDS)
+    app.state.partition_task.cancel()
+    app.state.snapshot_task.cancel()
+    app.state.stock_events_task.cancel()
+    if app.state.cube_task is not None:
+        app.state.cube_task.cancel()
+    if app.state.replica_task is not None:
+        app.state.replica_task.cancel()
+    if async_engine is not None:
+        await async_engine.dispose()
+    for replica in replicas.replicas:
+        if replica.serving_engine is not replica.engine:
+            await replica.serving_engine.dispose()
+
+
 app.include_router(categories_router)
+app.include_router(catalog_router)
 app.include_router(products_router)
 app.include_router(inventory_router)
 app.include_router(sales_router)
+app.include_router(diagnostics_router)
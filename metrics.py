@@ -0,0 +1,273 @@
+import contextvars
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import event
+
+logger = logging.getLogger("metrics")
+
+# Debug mode logs slow statements with their EXPLAIN ANALYZE plan and warns
+# about requests that look like N+1 query patterns
+SQL_DEBUG = os.getenv("SQL_DEBUG", "false").lower() in ("1", "true")
+SLOW_STATEMENT_SECONDS = float(os.getenv("SLOW_STATEMENT_SECONDS", "0.2"))
+# A request repeating the same statement this many times is flagged as N+1
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+
+    def header(self):
+        return [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+
+class CounterMetric(Metric):
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        super().__init__(name, description, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+        lines = self.header()
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class HistogramMetric(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, *labels):
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self.lock:
+            series = {
+                labels: (list(counts), total, count)
+                for labels, (counts, total, count) in self.series.items()
+            }
+        lines = self.header()
+        names = self.label_names + ("le",)
+        for labels, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{self.name}_bucket{_labels(names, labels + (bound,))} {cumulative}"
+                )
+            lines.append(
+                f"{self.name}_bucket{_labels(names, labels + ('+Inf',))} {count}"
+            )
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {total}")
+            lines.append(
+                f"{self.name}_count{_labels(self.label_names, labels)} {count}"
+            )
+        return lines
+
+
+REQUEST_LATENCY = HistogramMetric(
+    "http_request_duration_seconds",
+    "HTTP request latency by route template.",
+    ("method", "route", "status"),
+)
+REQUEST_STATEMENTS = HistogramMetric(
+    "http_request_sql_statements",
+    "SQL statements issued per HTTP request.",
+    ("method", "route"),
+    STATEMENT_COUNT_BUCKETS,
+)
+REQUEST_SQL_TIME = HistogramMetric(
+    "http_request_sql_duration_seconds",
+    "Total SQL execution time per HTTP request.",
+    ("method", "route"),
+)
+STATEMENT_LATENCY = HistogramMetric(
+    "db_statement_duration_seconds",
+    "Latency of individual SQL statements.",
+    ("engine",),
+)
+N_PLUS_ONE = CounterMetric(
+    "http_requests_n_plus_one_total",
+    "Requests that repeated the same SQL statement at least N_PLUS_ONE_THRESHOLD times.",
+    ("method", "route"),
+)
+
+REGISTRY = [
+    REQUEST_LATENCY,
+    REQUEST_STATEMENTS,
+    REQUEST_SQL_TIME,
+    STATEMENT_LATENCY,
+    N_PLUS_ONE,
+]
+# Extra callables returning exposition lines, e.g. pool gauges
+COLLECTORS = []
+
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    for collect in COLLECTORS:
+        lines.extend(collect())
+    return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    def __init__(self):
+        self.statement_count = 0
+        self.sql_seconds = 0.0
+        self.statements = Counter()
+        self.lock = threading.Lock()
+
+    def record(self, statement, seconds):
+        with self.lock:
+            self.statement_count += 1
+            self.sql_seconds += seconds
+            self.statements[statement] += 1
+
+
+# Holds the RequestStats of the request being served. Sync handlers and
+# AsyncSession greenlets inherit the context, so engine hooks see it too.
+current_request = contextvars.ContextVar("current_request", default=None)
+
+_whitespace = re.compile(r"\s+")
+
+
+def _explain(cursor, statement, parameters):
+    # Runs inside a savepoint so a failing EXPLAIN cannot abort the transaction
+    cursor.execute("SAVEPOINT explain_slow_statement")
+    try:
+        cursor.execute("EXPLAIN ANALYZE " + statement, parameters)
+        return "\n".join(row[0] for row in cursor.fetchall())
+    finally:
+        cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_statement")
+
+
+def instrument_engine(engine, name):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(
+        conn, cursor, statement, parameters, context, executemany
+    ):
+        context._statement_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._statement_started
+        STATEMENT_LATENCY.observe(elapsed, name)
+        stats = current_request.get()
+        if stats is not None:
+            stats.record(statement, elapsed)
+        if SQL_DEBUG and elapsed >= SLOW_STATEMENT_SECONDS:
+            message = _whitespace.sub(" ", statement)
+            plan = None
+            # EXPLAIN ANALYZE executes the statement again, so only for reads
+            if not executemany and message.lstrip().upper().startswith("SELECT"):
+                try:
+                    plan = _explain(conn.connection.cursor(), statement, parameters)
+                except Exception as exc:
+                    plan = f"EXPLAIN failed: {exc}"
+            logger.warning(
+                "Slow statement (%.1f ms): %s\n%s", elapsed * 1000, message, plan or ""
+            )
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware, so streamed responses are timed until their last
+    # chunk and nothing is buffered
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_request.reset(token)
+            elapsed = time.perf_counter() - start
+            route = scope.get("route")
+            # Route templates keep label cardinality bounded
+            path = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            REQUEST_LATENCY.observe(elapsed, method, path, str(status))
+            REQUEST_STATEMENTS.observe(stats.statement_count, method, path)
+            REQUEST_SQL_TIME.observe(stats.sql_seconds, method, path)
+            repeated = [
+                (statement, count)
+                for statement, count in stats.statements.items()
+                if count >= N_PLUS_ONE_THRESHOLD
+            ]
+            if repeated:
+                N_PLUS_ONE.inc(method, path)
+                if SQL_DEBUG:
+                    for statement, count in repeated:
+                        logger.warning(
+                            "Possible N+1 on %s %s: statement ran %d times: %s",
+                            method,
+                            path,
+                            count,
+                            _whitespace.sub(" ", statement),
+                        )
@@ -0,0 +1,161 @@
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+import codecs
+import csv
+import json
+
+from cache import response_cache
+from cube import analytics_cube
+from database.database import DBSession, get_db, run_db
+from database import crud
+import schemas
+
+router = APIRouter()
+
+# Records written per transaction; memory holds one chunk at a time
+IMPORT_CHUNK_SIZE = 1000
+MAX_IMPORT_ERRORS = 100
+IMPORT_FIELDS = ("sku", "name", "description", "price", "category")
+PRODUCT_FIELDS = ("sku", "name", "price", "category")
+
+
+async def read_lines(stream):
+    # Decoded lines as the body arrives; only a partial line is held back
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    async for chunk in stream:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def csv_records(lines):
+    # A quoted field may span lines, so a record ends on a line that leaves
+    # its quotes balanced
+    header = None
+    record = ""
+    async for line in lines:
+        record += line + "\n"
+        if record.count('"') % 2:
+            continue
+        values = next(csv.reader([record]), [])
+        record = ""
+        if not values:
+            continue
+        if header is None:
+            header = [name.strip() for name in values]
+            if any(name not in header for name in PRODUCT_FIELDS):
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"The CSV header must name the columns "
+                    f"{', '.join(PRODUCT_FIELDS)}",
+                )
+            continue
+        yield dict(zip(header, values))
+
+
+async def ndjson_records(lines):
+    async for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        # Reported as a rejected row, not a failed import
+        yield record if isinstance(record, dict) else None
+
+
+def parse_record(record):
+    # (category, product or None), or an error message. A record with only a
+    # category creates that category.
+    if record is None:
+        return "Invalid JSON object"
+    values = {}
+    for name in IMPORT_FIELDS:
+        value = record.get(name)
+        values[name] = None if value is None else str(value).strip() or None
+    if values["category"] is None:
+        return "category is required"
+    if not any(values[name] for name in ("sku", "name", "price", "description")):
+        return values["category"], None
+    missing = [name for name in PRODUCT_FIELDS if values[name] is None]
+    if missing:
+        return f"{', '.join(missing)} required"
+    try:
+        price = float(values["price"])
+    except ValueError:
+        return "Invalid price"
+    if not price >= 0:
+        return "Price must not be negative"
+    return values["category"], dict(values, price=price)
+
+
+@router.post("/catalog/import", response_model=schemas.CatalogImportResult)
+async def import_catalog(
+    request: Request,
+    import_format: str = Query("csv", alias="format", regex="^(csv|ndjson)$"),
+    db: DBSession = Depends(get_db),
+):
+    # Upserts products on sku and creates missing categories by name, one
+    # chunk per transaction; chunks written before a failure stay written
+    lines = read_lines(request.stream())
+    records = csv_records(lines) if import_format == "csv" else ndjson_records(lines)
+    summary = {
+        "categories_created": 0,
+        "inserted": 0,
+        "updated": 0,
+        "rejected": 0,
+        "errors": [],
+    }
+    categories = {}
+    chunk_categories = set()
+    chunk_products = {}
+
+    async def flush():
+        created, inserted, updated = await run_db(
+            db,
+            crud.import_products,
+            chunk_categories,
+            list(chunk_products.values()),
+            categories,
+        )
+        summary["categories_created"] += created
+        summary["inserted"] += inserted
+        summary["updated"] += updated
+        chunk_categories.clear()
+        chunk_products.clear()
+
+    row = 0
+    try:
+        async for record in records:
+            row += 1
+            parsed = parse_record(record)
+            if isinstance(parsed, str):
+                summary["rejected"] += 1
+                if len(summary["errors"]) < MAX_IMPORT_ERRORS:
+                    summary["errors"].append({"row": row, "detail": parsed})
+                continue
+            category, product = parsed
+            # A statement may upsert a sku once, so a repeat starts a new chunk
+            # and the later record wins
+            if product is not None and product["sku"] in chunk_products:
+                await flush()
+            chunk_categories.add(category)
+            if product is not None:
+                chunk_products[product["sku"]] = product
+            if len(chunk_categories) + len(chunk_products) >= IMPORT_CHUNK_SIZE:
+                await flush()
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="The upload is not valid UTF-8")
+    if chunk_categories:
+        await flush()
+    if summary["updated"]:
+        # Products may have moved category, which cached revenue and the
+        # cube's rows depend on; the cube picks up the move on its refresh
+        response_cache.clear()
+        analytics_cube.mark_stale()
+    return summary
@@ -1,28 +1,45 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from typing import List, Optional
 
-from database.database import get_db
-import database.models as models, schemas
+from database.database import DBSession, get_db, get_primary_db, run_db
+from database import crud
+from etags import catalog_cache
+import schemas
+import serialization
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, decode_id_cursor, paginate
 
 router = APIRouter()
 
 
 @router.get("/categories", response_model=List[schemas.Category])
-def read_categories(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    categories = db.query(models.Category).offset(skip).limit(limit).all()
-    return categories
+async def read_categories(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    # Replicas lag by different amounts, so the version, and the ETag, is
+    # read from the primary to stay the same from one request to the next
+    db: DBSession = Depends(get_primary_db),
+):
+    after_id = decode_id_cursor(cursor) if cursor else None
+    # Read before the rows, so a body is never older than its ETag
+    version = await run_db(db, crud.catalog_version)
+    etag = catalog_cache.etag(request, version)
+    cached = catalog_cache.get(request, etag)
+    if cached is not None:
+        return cached
+    fields = serialization.columns(schemas.Category)
+    rows = await run_db(db, crud.list_categories, after_id, limit + 1, fields)
+    rows = paginate(response, rows, limit, lambda c: (c.id,))
+    return catalog_cache.store(etag, [dict(zip(fields, row)) for row in rows], response)
 
 
 @router.post("/categories", response_model=schemas.Category)
-def create_category(category: schemas.CategoryCreate, db: Session = Depends(get_db)):
-    db_category = models.Category(name=category.name)
-    db.add(db_category)
-    try:
-        db.commit()
-        db.refresh(db_category)
-    except Exception as e:
-        db.rollback()
+async def create_category(
+    category: schemas.CategoryCreate, db: DBSession = Depends(get_db)
+):
+    db_category = await run_db(db, crud.create_category, category)
+    if db_category is None:
         raise HTTPException(
             status_code=400, detail="Category with this name already exists"
         )
@@ -0,0 +1,61 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+
+from cache import response_cache
+from cube import analytics_cube, verify
+from database.database import (
+    DBSession,
+    async_engine,
+    engine,
+    get_primary_db,
+    replicas,
+    run_db,
+)
+from database.pool import pool_status
+from metrics import render_metrics
+
+router = APIRouter()
+
+
+@router.get("/diagnostics/pool")
+def pool_stats():
+    stats = {"sync": pool_status(engine.pool)}
+    if async_engine is not None:
+        stats["async"] = pool_status(async_engine.pool)
+    for replica in replicas.replicas:
+        stats[replica.name] = pool_status(replica.serving_engine.pool)
+    return stats
+
+
+@router.get("/diagnostics/replicas")
+def replica_stats():
+    return replicas.status()
+
+
+@router.get("/diagnostics/cache")
+def cache_stats():
+    return response_cache.stats()
+
+
+@router.get("/diagnostics/cube")
+async def cube_stats(
+    verify_sql: bool = Query(False, alias="verify"),
+    # The cube loads from the primary, so compare against the primary
+    db: DBSession = Depends(get_primary_db),
+):
+    stats = analytics_cube.stats()
+    if verify_sql:
+        if not analytics_cube.ready:
+            raise HTTPException(status_code=400, detail="The sales cube is not loaded")
+        # Pull recent sales first so both sides see the same data
+        await run_in_threadpool(analytics_cube.refresh)
+        stats["verify"] = await run_db(db, verify, analytics_cube)
+    return stats
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
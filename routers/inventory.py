@@ -1,90 +1,150 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from typing import List
+from datetime import date, datetime, timedelta
 
-from database.database import get_db
-import database.models as models, schemas
+from database.counts import cached_total
+from database.database import DBSession, get_db, get_primary_db, run_db
+from database import crud
+import forecast
+from forecast import FORECAST_DAYS, velocity_cache
+import schemas
+import serialization
+from pagination import set_total
+from stock_events import low_stock_events
 
 router = APIRouter()
 
+MAX_ADJUSTMENTS = 10000
+
 
 @router.post("/inventory", response_model=schemas.Inventory)
-def create_inventory(item: schemas.InventoryCreate, db: Session = Depends(get_db)):
+async def create_inventory(
+    item: schemas.InventoryCreate, db: DBSession = Depends(get_db)
+):
     # Check if product exists
-    product = (
-        db.query(models.Product).filter(models.Product.id == item.product_id).first()
-    )
+    product = await run_db(db, crud.get_product, item.product_id)
     if not product:
         raise HTTPException(status_code=400, detail="Product not found")
-    inv = models.Inventory(
-        product_id=item.product_id,
-        channel=item.channel,
-        quantity=item.quantity,
-        reorder_level=item.reorder_level,
-    )
-    db.add(inv)
-    try:
-        db.commit()
-        db.refresh(inv)
-    except Exception as e:
-        db.rollback()
-        raise HTTPException(
-            status_code=400,
-            detail="Inventory entry already exists for this product and channel",
-        )
-    return inv
+    # An existing entry for the product and channel takes the new values
+    return await run_db(db, crud.create_inventory, item)
 
 
 @router.get("/inventory", response_model=List[schemas.Inventory])
-def read_inventory(
-    product_id: int = None, channel: str = None, db: Session = Depends(get_db)
+async def read_inventory(
+    response: Response,
+    product_id: int = None,
+    channel: str = None,
+    total: bool = False,
+    db: DBSession = Depends(get_db),
 ):
-    query = db.query(models.Inventory)
-    if product_id is not None:
-        query = query.filter(models.Inventory.product_id == product_id)
-    if channel is not None:
-        query = query.filter(models.Inventory.channel == channel)
-    items = query.all()
-    return items
+    if total:
+        counted = await cached_total(
+            db,
+            "inventory",
+            crud.count_inventory,
+            product_id=product_id,
+            channel=channel,
+        )
+        set_total(response, *counted)
+    if serialization.FAST_LIST_RESPONSES:
+        fields = serialization.columns(schemas.Inventory)
+        rows = await run_db(db, crud.list_inventory, product_id, channel, fields)
+        return serialization.rows_response(rows, fields, response)
+    return await run_db(db, crud.list_inventory, product_id, channel)
+
+
+@router.get("/inventory/as-of", response_model=List[schemas.InventoryAsOf])
+async def inventory_as_of(
+    ts: datetime,
+    product_id: int = None,
+    channel: str = None,
+    db: DBSession = Depends(get_db),
+):
+    return await run_db(db, crud.inventory_as_of, ts, product_id, channel)
+
+
+@router.get("/inventory/forecast", response_model=List[schemas.InventoryForecast])
+async def inventory_forecast(
+    days: int = Query(FORECAST_DAYS, ge=1, le=365),
+    limit: int = Query(100, ge=1, le=10000),
+    # Velocities are cached until the next sale, so no lagging replica reads
+    db: DBSession = Depends(get_primary_db),
+):
+    # Every item at once: one query for the daily sales of the window, one for
+    # the inventory, then the moving averages and projections as array math
+    if forecast.np is None:
+        raise HTTPException(
+            status_code=501, detail="The forecast requires numpy (pip install numpy)"
+        )
+    today = date.today()
+    velocities = velocity_cache.get(days)
+    if velocities is None:
+        generation = velocity_cache.begin()
+        start = today - timedelta(days=days - 1)
+        rows = await run_db(db, crud.daily_units, start, today)
+        velocities = await run_in_threadpool(forecast.compute_velocities, rows, days)
+        velocity_cache.store(days, velocities, generation)
+    inventory = await run_db(
+        db, crud.list_inventory, None, None, forecast.INVENTORY_COLUMNS
+    )
+    return await run_in_threadpool(
+        forecast.project, velocities, inventory, today, limit
+    )
 
 
 @router.get("/inventory/{inventory_id}", response_model=schemas.Inventory)
-def get_inventory(inventory_id: int, db: Session = Depends(get_db)):
-    inv = db.query(models.Inventory).filter(models.Inventory.id == inventory_id).first()
+async def get_inventory(inventory_id: int, db: DBSession = Depends(get_db)):
+    inv = await run_db(db, crud.get_inventory, inventory_id)
     if inv is None:
         raise HTTPException(status_code=404, detail="Inventory item not found")
     return inv
 
 
 @router.get("/inventory/stock/low-stock", response_model=List[schemas.Inventory])
-def low_stock(db: Session = Depends(get_db)):
-    items = (
-        db.query(models.Inventory)
-        .filter(models.Inventory.quantity <= models.Inventory.reorder_level)
-        .all()
+async def low_stock(db: DBSession = Depends(get_db)):
+    return await run_db(db, crud.list_low_stock)
+
+
+@router.get("/inventory/stock/low-stock/stream")
+async def low_stock_stream():
+    # Server-sent events: a snapshot of the low stock rows, then a low_stock or
+    # restocked event whenever one of them changes
+    return StreamingResponse(
+        low_stock_events.stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    return items
 
 
 @router.put("/inventory/{inventory_id}", response_model=schemas.Inventory)
-def update_inventory(
+async def update_inventory(
     inventory_id: int,
     inv_update: schemas.InventoryUpdate,
-    db: Session = Depends(get_db),
+    db: DBSession = Depends(get_db),
 ):
-    inv = db.query(models.Inventory).filter(models.Inventory.id == inventory_id).first()
+    inv = await run_db(db, crud.update_inventory, inventory_id, inv_update)
     if inv is None:
         raise HTTPException(status_code=404, detail="Inventory item not found")
-    old_qty = inv.quantity
-    inv.quantity = inv_update.quantity
-    # update last_updated handled by DB default on update
-    # calculate change
-    change = inv_update.quantity - old_qty
-    # record history
-    history = models.InventoryHistory(
-        inventory_id=inventory_id, change_qty=change, comment=inv_update.comment
-    )
-    db.add(history)
-    db.commit()
-    db.refresh(inv)
     return inv
+
+
+@router.post("/inventory/adjust", response_model=List[schemas.Inventory])
+async def adjust_inventory_batch(
+    adjustments: List[schemas.InventoryAdjustment], db: DBSession = Depends(get_db)
+):
+    if len(adjustments) > MAX_ADJUSTMENTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_ADJUSTMENTS} adjustments can be submitted per request",
+        )
+    if not adjustments:
+        return []
+    items, missing = await run_db(db, crud.adjust_inventory, adjustments)
+    if missing:
+        raise HTTPException(
+            status_code=404,
+            detail=f"Inventory items not found: {', '.join(map(str, missing))}",
+        )
+    return items
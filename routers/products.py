@@ -1,44 +1,186 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from typing import List, Optional
+from datetime import date, datetime, time, timedelta
 
-from database.database import get_db
-import database.models as models, schemas
+from database.database import DBSession, get_db, get_primary_db, run_db
+from database import crud
+from etags import catalog_cache
+import schemas
+import serialization
+from pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    decode_cursor,
+    decode_id_cursor,
+    paginate,
+)
 
 router = APIRouter()
 
 
-@router.get("/products", response_model=List[schemas.Product])
-def read_products(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    products = db.query(models.Product).offset(skip).limit(limit).all()
-    return products
+EXPANSIONS = ("category", "inventory", "sales_summary")
+# Window of sales_summary when start_date and end_date are not given
+SALES_SUMMARY_DAYS = 30
+
+
+def parse_expand(values):
+    # expand=category,inventory and repeated expand= parameters both work
+    expand = {part for value in values for part in value.split(",") if part}
+    unknown = expand - set(EXPANSIONS)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown expand {', '.join(sorted(unknown))}; "
+            f"expected {', '.join(EXPANSIONS)}",
+        )
+    return expand
+
+
+def attributes(obj, schema):
+    return {name: getattr(obj, name) for name in serialization.columns(schema)}
+
+
+def expand_product(product, expand, summaries):
+    # Relationships were loaded up front, so nothing here queries
+    data = attributes(product, schemas.Product)
+    if "category" in expand:
+        data["category"] = attributes(product.category, schemas.Category)
+    if "inventory" in expand:
+        data["inventory"] = [
+            attributes(item, schemas.Inventory) for item in product.inventory_items
+        ]
+    if "sales_summary" in expand:
+        units, revenue = summaries.get(product.id, (0, 0.0))
+        data["sales_summary"] = {"units": units, "revenue": revenue}
+    return data
+
+
+async def sales_summaries(db, products, expand, start_date, end_date):
+    if "sales_summary" not in expand or not products:
+        return {}
+    end_date = end_date or datetime.combine(date.today(), time.min)
+    start_date = start_date or end_date - timedelta(days=SALES_SUMMARY_DAYS - 1)
+    return await run_db(
+        db,
+        crud.product_sales_summaries,
+        [product.id for product in products],
+        start_date,
+        end_date,
+    )
+
+
+@router.get(
+    "/products",
+    response_model=List[schemas.ProductExpanded],
+    response_model_exclude_unset=True,
+)
+async def read_products(
+    request: Request,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    expand: List[str] = Query([]),
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    # Replicas lag by different amounts, so the version, and the ETag, is
+    # read from the primary to stay the same from one request to the next
+    db: DBSession = Depends(get_primary_db),
+):
+    after_id = decode_id_cursor(cursor) if cursor else None
+    expand = parse_expand(expand)
+    if not expand:
+        # Plain products change only with the catalog version, which is read
+        # before the rows so a body is never older than its ETag
+        version = await run_db(db, crud.catalog_version)
+        etag = catalog_cache.etag(request, version)
+        cached = catalog_cache.get(request, etag)
+        if cached is not None:
+            return cached
+        fields = serialization.columns(schemas.Product)
+        rows = await run_db(db, crud.list_products, after_id, limit + 1, fields)
+        rows = paginate(response, rows, limit, lambda p: (p.id,))
+        data = [dict(zip(fields, row)) for row in rows]
+        return catalog_cache.store(etag, data, response)
+    products = await run_db(db, crud.list_products, after_id, limit + 1, None, expand)
+    products = paginate(response, products, limit, lambda p: (p.id,))
+    summaries = await sales_summaries(db, products, expand, start_date, end_date)
+    return [expand_product(product, expand, summaries) for product in products]
 
 
 @router.post("/products", response_model=schemas.Product)
-def create_product(product: schemas.ProductCreate, db: Session = Depends(get_db)):
+async def create_product(
+    product: schemas.ProductCreate, db: DBSession = Depends(get_db)
+):
     # Check if category exists
-    category = (
-        db.query(models.Category)
-        .filter(models.Category.id == product.category_id)
-        .first()
-    )
+    category = await run_db(db, crud.get_category, product.category_id)
     if not category:
         raise HTTPException(status_code=400, detail="Category not found")
-    db_product = models.Product(
-        name=product.name,
-        description=product.description,
-        price=product.price,
-        category_id=product.category_id,
-    )
-    db.add(db_product)
-    db.commit()
-    db.refresh(db_product)
+    db_product = await run_db(db, crud.create_product, product)
+    if db_product is None:
+        raise HTTPException(
+            status_code=400, detail="Product with this SKU already exists"
+        )
     return db_product
 
 
-@router.get("/products/{product_id}", response_model=schemas.Product)
-def get_product(product_id: int, db: Session = Depends(get_db)):
-    product = db.query(models.Product).filter(models.Product.id == product_id).first()
+def decode_search_cursor(cursor: str):
+    rank, last_id = decode_cursor(cursor, 2)
+    if not isinstance(rank, (int, float)) or not isinstance(last_id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return rank, last_id
+
+
+# Declared before /products/{product_id}, which would otherwise match "search"
+@router.get("/products/search", response_model=List[schemas.ProductSearchResult])
+async def search_products(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=200),
+    prefix: bool = False,
+    category_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: DBSession = Depends(get_db),
+):
+    after = decode_search_cursor(cursor) if cursor else None
+    rows = await run_db(
+        db,
+        crud.search_products,
+        q,
+        serialization.columns(schemas.Product),
+        prefix,
+        category_id,
+        after,
+        limit + 1,
+    )
+    return paginate(response, rows, limit, lambda p: (p["rank"], p["id"]))
+
+
+@router.get(
+    "/products/{product_id}",
+    response_model=schemas.ProductExpanded,
+    response_model_exclude_unset=True,
+)
+async def get_product(
+    request: Request,
+    product_id: int,
+    expand: List[str] = Query([]),
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    # Replicas lag by different amounts, so the version, and the ETag, is
+    # read from the primary to stay the same from one request to the next
+    db: DBSession = Depends(get_primary_db),
+):
+    expand = parse_expand(expand)
+    if not expand:
+        version = await run_db(db, crud.catalog_version)
+        etag = catalog_cache.etag(request, version)
+        cached = catalog_cache.get(request, etag)
+        if cached is not None:
+            return cached
+    product = await run_db(db, crud.get_product, product_id, expand)
     if product is None:
         raise HTTPException(status_code=404, detail="Product not found")
-    return product
+    if not expand:
+        return catalog_cache.store(etag, attributes(product, schemas.Product))
+    summaries = await sales_summaries(db, [product], expand, start_date, end_date)
+    return expand_product(product, expand, summaries)
@@ -1,132 +1,294 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from starlette.concurrency import run_in_threadpool
 from typing import List, Optional
 from datetime import datetime
+import csv
+import io
+import json
 
-from database.database import get_db
+from cache import response_cache
+from cube import analytics_cube
+from database.counts import cached_total
+from database.database import (
+    DBSession,
+    get_db,
+    get_primary_db,
+    run_db,
+    stream_rows,
+    use_replica,
+)
+from database import crud
+from ingest import INGEST_WAIT_SECONDS, IngestBufferFull, sale_ingest
 import database.models as models, schemas
+import serialization
+from pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    decode_cursor,
+    paginate,
+    set_total,
+)
 
 router = APIRouter()
 
+EXPORT_BATCH_SIZE = 5000
+EXPORT_COLUMNS = ("id", "product_id", "channel", "quantity", "price", "sale_date")
+MAX_BULK_SALES = 10000
+MAX_COMPARE_RANGES = 24
+MAX_COMPARE_DAYS = 366
+
+
+def decode_sale_cursor(cursor: str):
+    sale_date, sale_id = decode_cursor(cursor, 2)
+    try:
+        sale_date = datetime.fromisoformat(sale_date)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(sale_id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return sale_date, sale_id
+
+
+def sale_cursor_key(sale):
+    return sale.sale_date.isoformat(), sale.id
+
 
 @router.get("/sales", response_model=List[schemas.Sale])
-def read_sales(
+async def read_sales(
+    response: Response,
     start_date: Optional[datetime] = None,
     end_date: Optional[datetime] = None,
     product_id: int = None,
     category_id: int = None,
     channel: str = None,
-    db: Session = Depends(get_db),
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    total: bool = False,
+    db: DBSession = Depends(get_db),
 ):
-    query = db.query(models.Sale)
-    # Filter by date
-    if start_date:
-        query = query.filter(models.Sale.sale_date >= start_date)
-    if end_date:
-        query = query.filter(models.Sale.sale_date <= end_date)
-    # Filter by product
-    if product_id:
-        query = query.filter(models.Sale.product_id == product_id)
-    # Filter by channel
-    if channel:
-        query = query.filter(models.Sale.channel == channel)
-    # Filter by category (join through product)
-    if category_id:
-        query = query.join(models.Product).filter(
-            models.Product.category_id == category_id
+    filters = dict(
+        start_date=start_date,
+        end_date=end_date,
+        product_id=product_id,
+        category_id=category_id,
+        channel=channel,
+    )
+    after = decode_sale_cursor(cursor) if cursor else None
+    if total:
+        counted = await cached_total(db, "sales", crud.count_sales, **filters)
+        set_total(response, *counted)
+    if serialization.FAST_LIST_RESPONSES:
+        fields = serialization.columns(schemas.Sale)
+        rows = await run_db(db, crud.list_sales, filters, after, limit + 1, fields)
+        rows = paginate(response, rows, limit, sale_cursor_key)
+        return serialization.rows_response(rows, fields, response)
+    sales = await run_db(db, crud.list_sales, filters, after, limit + 1)
+    return paginate(response, sales, limit, sale_cursor_key)
+
+
+def encode_csv(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for sale_id, product_id, channel, quantity, price, sale_date in rows:
+        writer.writerow(
+            [sale_id, product_id, channel, quantity, price, sale_date.isoformat()]
         )
-    sales = query.all()
-    return sales
+    return buf.getvalue()
 
 
-@router.get("/sales/revenue")
-def revenue(
+def encode_ndjson(rows):
+    return "".join(
+        json.dumps(
+            {
+                "id": sale_id,
+                "product_id": product_id,
+                "channel": channel,
+                "quantity": quantity,
+                "price": price,
+                "sale_date": sale_date.isoformat(),
+            }
+        )
+        + "\n"
+        for sale_id, product_id, channel, quantity, price, sale_date in rows
+    )
+
+
+async def stream_sales(stmt, export_format, read_only):
+    if export_format == "csv":
+        yield ",".join(EXPORT_COLUMNS) + "\r\n"
+    encode = encode_csv if export_format == "csv" else encode_ndjson
+    # Batches come from a server-side cursor, so memory stays flat
+    async for rows in stream_rows(stmt, EXPORT_BATCH_SIZE, read_only):
+        yield encode(rows)
+
+
+@router.get("/sales/export")
+async def export_sales(
+    request: Request,
+    export_format: str = Query("csv", alias="format", regex="^(csv|ndjson)$"),
     start_date: Optional[datetime] = None,
     end_date: Optional[datetime] = None,
     product_id: int = None,
     category_id: int = None,
     channel: str = None,
-    group_by: str = Query("day", regex="^(day|week|month|year)$"),
-    db: Session = Depends(get_db),
 ):
-    # Determine grouping
-    if group_by == "day":
-        trunc_func = func.date_trunc("day", models.Sale.sale_date)
-    elif group_by == "week":
-        trunc_func = func.date_trunc("week", models.Sale.sale_date)
-    elif group_by == "month":
-        trunc_func = func.date_trunc("month", models.Sale.sale_date)
-    elif group_by == "year":
-        trunc_func = func.date_trunc("year", models.Sale.sale_date)
-    else:
-        raise HTTPException(status_code=400, detail="Invalid group_by parameter")
-
-    query = db.query(
-        trunc_func.label("period"),
-        func.sum(models.Sale.quantity * models.Sale.price).label("revenue"),
+    stmt = select(*(getattr(models.Sale, column) for column in EXPORT_COLUMNS))
+    stmt = crud.filter_sales(
+        stmt, start_date, end_date, product_id, category_id, channel
+    )
+    stmt = stmt.order_by(models.Sale.sale_date, models.Sale.id)
+    media_type = "text/csv" if export_format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        stream_sales(stmt, export_format, use_replica(request)),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=sales.{export_format}"},
     )
 
-    # filters
-    if start_date:
-        query = query.filter(models.Sale.sale_date >= start_date)
-    if end_date:
-        query = query.filter(models.Sale.sale_date <= end_date)
-    if product_id:
-        query = query.filter(models.Sale.product_id == product_id)
-    if channel:
-        query = query.filter(models.Sale.channel == channel)
-    if category_id:
-        query = query.join(models.Product).filter(
-            models.Product.category_id == category_id
+
+@router.post("/sales/bulk", response_model=schemas.SaleBulkResult)
+async def create_sales_bulk(
+    sales: List[schemas.SaleCreate], db: DBSession = Depends(get_db)
+):
+    if len(sales) > MAX_BULK_SALES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BULK_SALES} sales can be submitted per request",
+        )
+    return await run_db(db, crud.bulk_create_sales, sales)
+
+
+@router.post("/sales/ingest", response_model=schemas.SaleQueued, status_code=202)
+async def ingest_sale(sale: schemas.SaleCreate):
+    # Acknowledged once buffered; stock and product checks run when the batch
+    # is written, and sales failing them are logged and counted in /metrics
+    if sale.quantity <= 0:
+        raise HTTPException(status_code=400, detail="Quantity must be positive")
+    try:
+        buffered = await sale_ingest.submit(sale, INGEST_WAIT_SECONDS)
+    except IngestBufferFull:
+        raise HTTPException(
+            status_code=503,
+            detail="The ingest buffer is full, retry shortly",
+            headers={"Retry-After": "1"},
         )
+    return {"buffered": buffered}
 
-    query = query.group_by("period").order_by("period")
-    results = query.all()
+
+@router.get("/sales/revenue")
+async def revenue(
+    start_date: Optional[datetime] = None,
+    end_date: Optional[datetime] = None,
+    product_id: int = None,
+    category_id: int = None,
+    channel: str = None,
+    group_by: str = Query("day", regex="^(day|week|month|year)$"),
+    # Cached results must not predate the invalidation, so no replica reads
+    db: DBSession = Depends(get_primary_db),
+):
+    filters = dict(
+        start_date=start_date,
+        end_date=end_date,
+        product_id=product_id,
+        category_id=category_id,
+        channel=channel,
+    )
+    key = response_cache.key("revenue", group_by=group_by, **filters)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached
+    generation = response_cache.begin()
+    results = None
+    if analytics_cube.ready:
+        # None when the cube no longer holds the requested days
+        results = await run_in_threadpool(
+            analytics_cube.revenue_by_period, filters, group_by
+        )
+    if results is None:
+        results = await run_db(db, crud.revenue_by_period, filters, group_by)
     # Format output
     data = []
     for period, revenue in results:
         data.append({"period": period.date().isoformat(), "revenue": float(revenue)})
-    return data
+    return response_cache.store(key, data, [(start_date, end_date)], generation)
+
+
+def parse_range(value: str):
+    try:
+        start, end = (datetime.fromisoformat(part).date() for part in value.split(","))
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail=f"Invalid range {value!r}, expected start,end"
+        )
+    if start > end:
+        raise HTTPException(
+            status_code=400, detail=f"Range {value!r} ends before it starts"
+        )
+    return start, end
 
 
 @router.get("/sales/compare")
-def compare(
-    start1: datetime,
-    end1: datetime,
-    start2: datetime,
-    end2: datetime,
+async def compare(
+    start1: Optional[datetime] = None,
+    end1: Optional[datetime] = None,
+    start2: Optional[datetime] = None,
+    end2: Optional[datetime] = None,
+    ranges: List[str] = Query([], alias="range"),
     product_id: int = None,
     category_id: int = None,
     channel: str = None,
-    db: Session = Depends(get_db),
+    db: DBSession = Depends(get_primary_db),
 ):
-    # Aggregate daily revenue for each range
-    def get_daily_range(start_date, end_date):
-        query = db.query(
-            func.date_trunc("day", models.Sale.sale_date).label("day"),
-            func.sum(models.Sale.quantity * models.Sale.price).label("revenue"),
-        ).filter(models.Sale.sale_date >= start_date, models.Sale.sale_date <= end_date)
-
-        if product_id:
-            query = query.filter(models.Sale.product_id == product_id)
-        if channel:
-            query = query.filter(models.Sale.channel == channel)
-        if category_id:
-            query = query.join(models.Product).filter(
-                models.Product.category_id == category_id
-            )
-
-        query = query.group_by("day").order_by("day")
-        return query.all()
-
-    range1 = get_daily_range(start1, end1)
-    range2 = get_daily_range(start2, end2)
-
-    data1 = [
-        {"date": day.date().isoformat(), "revenue": float(rev)} for day, rev in range1
-    ]
-    data2 = [
-        {"date": day.date().isoformat(), "revenue": float(rev)} for day, rev in range2
-    ]
-    return {"range1": data1, "range2": data2}
+    # start1/end1/start2/end2 come first when given, then each range=start,end
+    legacy = (start1, end1, start2, end2)
+    if any(legacy) and not all(legacy):
+        raise HTTPException(
+            status_code=400, detail="start1, end1, start2 and end2 go together"
+        )
+    bounds = [parse_range(value) for value in ranges]
+    if all(legacy):
+        bounds[:0] = [(start1.date(), end1.date()), (start2.date(), end2.date())]
+    if not 2 <= len(bounds) <= MAX_COMPARE_RANGES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Compare between 2 and {MAX_COMPARE_RANGES} ranges",
+        )
+    if any((end - start).days >= MAX_COMPARE_DAYS for start, end in bounds):
+        raise HTTPException(
+            status_code=400,
+            detail=f"A range can span at most {MAX_COMPARE_DAYS} days",
+        )
+
+    filters = dict(product_id=product_id, category_id=category_id, channel=channel)
+    key = response_cache.key(
+        "compare",
+        ranges=[[start.isoformat(), end.isoformat()] for start, end in bounds],
+        **filters,
+    )
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached
+    generation = response_cache.begin()
+
+    rows = None
+    if analytics_cube.ready:
+        rows = await run_in_threadpool(analytics_cube.compare_ranges, bounds, filters)
+    if rows is None:
+        rows = await run_db(db, crud.compare_ranges, bounds, filters)
+    # Every day of every range is present, so day i of each series lines up
+    names = [f"range{label}" for label in range(1, len(bounds) + 1)]
+    data = {name: [] for name in names}
+    for label, day, revenue in rows:
+        data[names[label - 1]].append(
+            {"date": day.isoformat(), "revenue": float(revenue)}
+        )
+    totals = {name: sum(row["revenue"] for row in data[name]) for name in names}
+    base = totals[names[0]]
+    data["totals"] = totals
+    # Change of each range against the first one
+    data["change_pct"] = {
+        name: round((totals[name] - base) / base * 100, 2) if base else None
+        for name in names[1:]
+    }
+    return response_cache.store(key, data, bounds, generation)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from datetime import datetime
+from datetime import date, datetime
 from typing import Optional, List
 
 
@@ -25,6 +25,7 @@ class ProductBase(BaseModel):
     description: Optional[str] = None
     price: float
     category_id: int
+    sku: Optional[str] = None
 
 
 class ProductCreate(ProductBase):
@@ -38,6 +39,25 @@ class Product(ProductBase):
         orm_mode = True
 
 
+class ProductSearchResult(Product):
+    rank: float
+
+
+class CatalogImportError(BaseModel):
+    # 1-based position of the record in the upload, header excluded
+    row: int
+    detail: str
+
+
+class CatalogImportResult(BaseModel):
+    categories_created: int
+    inserted: int
+    updated: int
+    rejected: int
+    # The first MAX_IMPORT_ERRORS rejections
+    errors: List[CatalogImportError]
+
+
 # Inventory schemas
 class InventoryBase(BaseModel):
     product_id: int
@@ -58,11 +78,39 @@ class Inventory(InventoryBase):
         orm_mode = True
 
 
+class InventoryAsOf(BaseModel):
+    id: int
+    product_id: int
+    channel: str
+    quantity: int
+
+
+class InventoryForecast(BaseModel):
+    id: int
+    product_id: int
+    channel: str
+    quantity: int
+    reorder_level: int
+    # Average units sold per day over the window and over its last 7 days
+    velocity: float
+    recent_velocity: float
+    # None when the item sold nothing in the window
+    days_until_reorder: Optional[float] = None
+    days_until_stockout: Optional[float] = None
+    stockout_date: Optional[date] = None
+
+
 class InventoryUpdate(BaseModel):
     quantity: int
     comment: Optional[str] = None
 
 
+class InventoryAdjustment(BaseModel):
+    inventory_id: int
+    delta: int
+    comment: Optional[str] = None
+
+
 # Sale schemas
 class SaleBase(BaseModel):
     product_id: int
@@ -81,3 +129,31 @@ class Sale(SaleBase):
 
     class Config:
         orm_mode = True
+
+
+class SaleBulkError(BaseModel):
+    index: int
+    detail: str
+
+
+class SaleBulkResult(BaseModel):
+    inserted: int
+    errors: List[SaleBulkError]
+
+
+class SaleQueued(BaseModel):
+    # Sales waiting in the ingest buffer, this one included
+    buffered: int
+
+
+# Expanded product views
+class SalesSummary(BaseModel):
+    units: int
+    revenue: float
+
+
+class ProductExpanded(Product):
+    # Only the parts requested through expand= are present
+    category: Optional[Category] = None
+    inventory: Optional[List[Inventory]] = None
+    sales_summary: Optional[SalesSummary] = None
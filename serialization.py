@@ -0,0 +1,53 @@
+import json
+import os
+from datetime import datetime
+
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from pagination import PAGINATION_HEADERS
+
+# List endpoints select plain column tuples and encode them directly instead
+# of loading ORM instances and validating each one through its schema
+FAST_LIST_RESPONSES = os.getenv("FAST_LIST_RESPONSES", "false").lower() in (
+    "1",
+    "true",
+)
+
+
+def columns(schema):
+    # Fields in declaration order, so keys come out as the schema emits them
+    return tuple(schema.__fields__)
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        # UTC as Z, matching the schema serializer and orjson
+        text = value.isoformat()
+        if value.utcoffset() is not None and not value.utcoffset():
+            text = text[:-6] + "Z"
+        return text
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_UTC_Z)
+    return json.dumps(data, default=_default, separators=(",", ":")).encode()
+
+
+def rows_response(rows, fields, response=None):
+    # Keep the pagination headers the endpoint set on its injected response
+    headers = None
+    if response is not None:
+        headers = {
+            name: response.headers[name]
+            for name in PAGINATION_HEADERS
+            if name in response.headers
+        }
+    body = dumps([dict(zip(fields, row)) for row in rows])
+    return Response(body, media_type="application/json", headers=headers)
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import logging
+import os
+
+from starlette.concurrency import run_in_threadpool
+
+from database.database import engine
+from metrics import COLLECTORS
+
+logger = logging.getLogger("stock_events")
+
+# Filled by the triggers of migration 3
+CHANNEL = "inventory_low_stock"
+# Events buffered per client; a client further behind gets a fresh snapshot
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", "100"))
+# Comment lines keep idle connections open through proxies
+STREAM_KEEPALIVE_SECONDS = float(os.getenv("STREAM_KEEPALIVE_SECONDS", "15"))
+LISTEN_CHECK_SECONDS = 30
+LISTEN_RETRY_SECONDS = 5
+
+SNAPSHOT_SQL = (
+    "SELECT json_build_object('id', id, 'product_id', product_id,"
+    " 'channel', channel, 'quantity', quantity, 'reorder_level', reorder_level,"
+    " 'last_updated', last_updated)"
+    " FROM inventory WHERE quantity <= reorder_level ORDER BY id"
+)
+
+
+# Queued in place of events a subscriber lost
+RESYNC = object()
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class Subscriber:
+    def __init__(self):
+        self.queue = asyncio.Queue(STREAM_QUEUE_SIZE)
+        # Set when events were dropped; the next message is a new snapshot
+        self.resync = False
+
+
+class LowStockBroadcaster:
+    # One LISTEN connection per worker keeps the low stock rows in memory and
+    # fans changes out to every connected stream, so an idle stream costs a
+    # parked coroutine and a keepalive every STREAM_KEEPALIVE_SECONDS
+
+    def __init__(self):
+        self.items = {}
+        self.subscribers = set()
+        self.ready = asyncio.Event()
+
+    def snapshot(self):
+        return [self.items[item_id] for item_id in sorted(self.items)]
+
+    def publish(self, event, data):
+        # Encoded once, whatever the number of subscribers
+        message = format_event(event, data)
+        for subscriber in self.subscribers:
+            if subscriber.resync:
+                continue
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # A slow client skips what it missed instead of holding memory
+                self._resync(subscriber)
+
+    def _resync(self, subscriber):
+        subscriber.resync = True
+        while not subscriber.queue.empty():
+            subscriber.queue.get_nowait()
+        subscriber.queue.put_nowait(RESYNC)
+
+    def apply(self, payload):
+        item = json.loads(payload)
+        low = item.pop("low")
+        if low:
+            self.items[item["id"]] = item
+            self.publish("low_stock", item)
+        elif self.items.pop(item["id"], None) is not None:
+            self.publish("restocked", item)
+
+    def reset(self, items):
+        # After (re)connecting, every stream starts over from the new snapshot
+        self.items = {item["id"]: item for item in items}
+        for subscriber in self.subscribers:
+            self._resync(subscriber)
+        self.ready.set()
+
+    async def stream(self):
+        subscriber = Subscriber()
+        self.subscribers.add(subscriber)
+        try:
+            await self.ready.wait()
+            yield format_event("snapshot", self.snapshot())
+            while True:
+                try:
+                    message = await asyncio.wait_for(
+                        subscriber.queue.get(), STREAM_KEEPALIVE_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is RESYNC:
+                    subscriber.resync = False
+                    yield format_event("snapshot", self.snapshot())
+                else:
+                    yield message
+        finally:
+            self.subscribers.discard(subscriber)
+
+    def _connect(self):
+        # A dedicated connection outside the pool, since it listens for good
+        conn = engine.raw_connection()
+        conn.detach()
+        dbapi_conn = conn.dbapi_connection
+        dbapi_conn.autocommit = True
+        with dbapi_conn.cursor() as cursor:
+            # Listen before reading the snapshot, so no change falls between
+            cursor.execute(f"LISTEN {CHANNEL}")
+            cursor.execute(SNAPSHOT_SQL)
+            items = [row[0] for row in cursor.fetchall()]
+        return dbapi_conn, items
+
+    def _ping(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            conn = None
+            try:
+                conn, items = await run_in_threadpool(self._connect)
+                self.reset(items)
+                failed = loop.create_future()
+                # fileno() raises once psycopg2 has closed a broken connection
+                fd = conn.fileno()
+
+                def on_readable():
+                    try:
+                        conn.poll()
+                    except Exception as exc:
+                        if not failed.done():
+                            failed.set_exception(exc)
+                        return
+                    while conn.notifies:
+                        self.apply(conn.notifies.pop(0).payload)
+
+                try:
+                    while True:
+                        loop.add_reader(fd, on_readable)
+                        done, _ = await asyncio.wait(
+                            {failed}, timeout=LISTEN_CHECK_SECONDS
+                        )
+                        loop.remove_reader(fd)
+                        if done:
+                            failed.result()
+                        # A dead peer is only noticed when something is sent
+                        await run_in_threadpool(self._ping, conn)
+                        on_readable()
+                finally:
+                    loop.remove_reader(fd)
+            except Exception:
+                logger.exception("Listening for low stock changes failed")
+                await asyncio.sleep(LISTEN_RETRY_SECONDS)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def metric_lines(self):
+        return [
+            "# HELP low_stock_stream_clients Connected low stock event streams.",
+            "# TYPE low_stock_stream_clients gauge",
+            f"low_stock_stream_clients {len(self.subscribers)}",
+        ]
+
+
+low_stock_events = LowStockBroadcaster()
+COLLECTORS.append(low_stock_events.metric_lines)
@@ -0,0 +1,66 @@
+import uuid
+
+import pytest
+from sqlalchemy import delete, select, text
+
+from database.database import SessionLocal, engine, init_db
+import database.models as models
+
+
+@pytest.fixture(scope="session")
+def database():
+    # The database at DATABASE_URL, brought up to date; tests needing it are
+    # skipped when it is not reachable
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    except Exception:
+        pytest.skip("DATABASE_URL is not reachable")
+    init_db()
+    return engine
+
+
+@pytest.fixture
+def db(database):
+    with SessionLocal() as session:
+        yield session
+
+
+@pytest.fixture
+def product(db):
+    name = f"test-{uuid.uuid4().hex[:12]}"
+    category = models.Category(name=name)
+    db.add(category)
+    db.flush()
+    product = models.Product(name=name, price=1.0, category_id=category.id)
+    db.add(product)
+    db.commit()
+    yield product
+    db.rollback()
+    inventory_ids = select(models.Inventory.id).where(
+        models.Inventory.product_id == product.id
+    )
+    db.execute(
+        delete(models.InventorySnapshot).where(
+            models.InventorySnapshot.inventory_id.in_(inventory_ids)
+        )
+    )
+    db.execute(
+        delete(models.InventoryHistory).where(
+            models.InventoryHistory.inventory_id.in_(inventory_ids)
+        )
+    )
+    db.execute(
+        delete(models.Inventory).where(models.Inventory.product_id == product.id)
+    )
+    db.execute(delete(models.Sale).where(models.Sale.product_id == product.id))
+    db.execute(
+        delete(models.SalesDaily).where(models.SalesDaily.product_id == product.id)
+    )
+    db.execute(delete(models.Product).where(models.Product.id == product.id))
+    db.execute(
+        delete(models.Category).where(
+            models.Category.id.in_([category.id, product.category_id])
+        )
+    )
+    db.commit()
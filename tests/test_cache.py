@@ -0,0 +1,173 @@
+import sys
+import types
+from datetime import date, datetime
+from fnmatch import fnmatchcase
+
+import pytest
+
+import cache
+from cache import LocalBackend, RedisBackend, ResponseCache
+
+SPANS = [(date(2024, 5, 1), date(2024, 5, 31))]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Seconds on both clocks the cache reads, advanced by the test
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    return now
+
+
+def test_local_backend_evicts_least_recently_used():
+    backend = LocalBackend(60, max_bytes=10)
+    generation = backend.begin()
+    backend.set("a", b"aaaa", SPANS, generation)
+    backend.set("b", b"bbbb", SPANS, generation)
+    assert backend.get("a") == b"aaaa"
+    backend.set("c", b"cccc", SPANS, generation)
+    assert backend.get("b") is None
+    assert backend.get("a") == b"aaaa"
+    assert backend.get("c") == b"cccc"
+    assert backend.stats()["bytes"] == 8
+
+
+def test_local_backend_expires_entries(clock):
+    backend = LocalBackend(60, max_bytes=100)
+    backend.set("a", b"aaaa", SPANS, backend.begin())
+    clock[0] += 59
+    assert backend.get("a") == b"aaaa"
+    clock[0] += 2
+    assert backend.get("a") is None
+    assert backend.stats()["entries"] == 0
+
+
+def test_key_ignores_the_time_of_day():
+    responses = ResponseCache(None)
+    morning = responses.key(
+        "revenue", start_date=datetime(2024, 5, 6, 1), end_date=date(2024, 5, 7)
+    )
+    evening = responses.key(
+        "revenue", end_date=datetime(2024, 5, 7, 23, 59), start_date=date(2024, 5, 6)
+    )
+    assert morning == evening
+    assert morning != responses.key("revenue", start_date=date(2024, 5, 5))
+
+
+def test_clear_drops_entries_and_bodies_computed_before_it():
+    responses = ResponseCache(LocalBackend(60, max_bytes=1000))
+    generation = responses.begin()
+    responses.store("a", {"total": 1}, [(None, None)], generation)
+    assert responses.get("a").body == b'{"total":1}'
+    responses.clear()
+    assert responses.get("a") is None
+    # Computed before the clear, so it may hold rows the clear was for
+    responses.store("b", {"total": 2}, [(None, None)], generation)
+    assert responses.get("b") is None
+    assert responses.backend.stats()["bytes"] == 0
+
+
+class FakeRedis:
+    # The commands RedisBackend uses, on dicts; keys come back as bytes
+    # like redis-py returns them
+
+    def __init__(self):
+        self.values = {}
+        self.scores = {}
+
+    @staticmethod
+    def _key(key):
+        return key.encode() if isinstance(key, str) else key
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        return []
+
+    def get(self, key):
+        return self.values.get(self._key(key))
+
+    def set(self, key, value, ex=None):
+        self.values[self._key(key)] = value
+
+    def incr(self, key):
+        key = self._key(key)
+        self.values[key] = int(self.values.get(key) or 0) + 1
+
+    def delete(self, *keys):
+        for key in map(self._key, keys):
+            self.values.pop(key, None)
+            self.scores.pop(key, None)
+
+    def scan_iter(self, match, count):
+        keys = set(self.values) | set(self.scores)
+        return [key for key in keys if fnmatchcase(key.decode(), match)]
+
+    def zadd(self, name, mapping):
+        self.scores.setdefault(self._key(name), {}).update(mapping)
+
+    def zrem(self, name, *members):
+        for member in members:
+            self.scores.get(self._key(name), {}).pop(member, None)
+
+    def zremrangebyscore(self, name, low, high):
+        index = self.scores.get(self._key(name), {})
+        for member, score in list(index.items()):
+            if score <= high:
+                del index[member]
+
+    def zrange(self, name, start, end):
+        index = self.scores.get(self._key(name), {})
+        return sorted(index, key=index.get)
+
+    def zcard(self, name):
+        return len(self.scores.get(self._key(name), {}))
+
+
+@pytest.fixture
+def redis_backend(monkeypatch):
+    client = FakeRedis()
+    redis = types.SimpleNamespace(
+        Redis=types.SimpleNamespace(from_url=lambda url: client)
+    )
+    monkeypatch.setitem(sys.modules, "redis", redis)
+    return RedisBackend("redis://cache", 60)
+
+
+def test_redis_index_keeps_one_entry_per_key(clock, redis_backend):
+    generation = redis_backend.begin()
+    redis_backend.set("a", b"aaaa", SPANS, generation)
+    clock[0] += 30
+    redis_backend.set("a", b"aaaa", SPANS, generation)
+    assert redis_backend.stats()["entries"] == 1
+    # Stored again, so it expires 60 seconds after the second store
+    clock[0] += 45
+    assert redis_backend.stats()["entries"] == 1
+
+
+def test_redis_index_trims_expired_entries(clock, redis_backend):
+    generation = redis_backend.begin()
+    redis_backend.set("a", b"aaaa", SPANS, generation)
+    redis_backend.set("b", b"bbbb", [(date(2024, 6, 1), date(2024, 6, 30))], generation)
+    clock[0] += 61
+    assert redis_backend.stats()["entries"] == 0
+    assert redis_backend.invalidate([date(2024, 5, 6)]) == 0
+
+
+def test_redis_invalidate_and_clear(redis_backend):
+    generation = redis_backend.begin()
+    redis_backend.set("a", b"aaaa", SPANS, generation)
+    redis_backend.set("b", b"bbbb", [(date(2024, 6, 1), date(2024, 6, 30))], generation)
+    assert redis_backend.invalidate([date(2024, 5, 6)]) == 1
+    assert redis_backend.get("a") is None
+    assert redis_backend.get("b") == b"bbbb"
+
+    redis_backend.set("c", b"cccc", SPANS, redis_backend.begin())
+    redis_backend.clear()
+    assert redis_backend.get("b") is None
+    assert redis_backend.get("c") is None
+    assert redis_backend.stats()["entries"] == 0
+    # The generation survives, so bodies computed before the clear are dropped
+    assert redis_backend.client.get(redis_backend.generation_key) is not None
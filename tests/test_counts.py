@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, insert, select, text
+
+from database.counts import table_estimate
+import database.models as models
+from database.partitions import ensure_partitions
+
+
+def test_table_estimate_of_partitioned_sales(db, product):
+    start = datetime(2024, 1, 20)
+    rows = [
+        {
+            "product_id": product.id,
+            "channel": "web",
+            "quantity": 1,
+            "price": 1.0,
+            "sale_date": start + timedelta(hours=i),
+        }
+        for i in range(2000)
+    ]
+    ensure_partitions(db, "sales", (row["sale_date"] for row in rows))
+    db.execute(insert(models.Sale.__table__), rows)
+    # Rolled back with the rows; ANALYZE counts this transaction's inserts
+    db.execute(text("ANALYZE sales"))
+    estimate = table_estimate(db, "sales")
+    exact = db.scalar(select(func.count()).select_from(models.Sale))
+    assert abs(estimate - exact) <= exact * 0.1
+    db.rollback()
@@ -0,0 +1,58 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import insert, update
+
+from database import crud
+import database.models as models
+from database.partitions import ensure_partitions
+
+np = pytest.importorskip("numpy")
+
+from cube import SalesCube  # noqa: E402
+
+DAY = datetime(2024, 5, 6)
+
+
+def revenue(cube, category_id):
+    filters = dict.fromkeys(("start_date", "end_date", "product_id", "channel"))
+    return cube.revenue_by_period(
+        dict(filters, category_id=category_id, start_date=DAY, end_date=DAY)
+    )
+
+
+def test_cube_follows_products_to_new_categories(db, product):
+    first = product.category_id
+    second = models.Category(name=f"{product.name}-moved")
+    db.add(second)
+    db.commit()
+    ensure_partitions(db, "sales", [DAY])
+    db.execute(
+        insert(models.Sale.__table__),
+        [
+            {
+                "product_id": product.id,
+                "channel": "web",
+                "quantity": 2,
+                "price": 5.0,
+                "sale_date": DAY,
+            }
+        ],
+    )
+    db.commit()
+    cube = SalesCube(1 << 20)
+    cube.refresh()
+    assert revenue(cube, first) == [(DAY, 10.0)]
+    assert revenue(cube, second.id) == []
+
+    # What a catalog import moving the product does
+    db.execute(
+        update(models.Product)
+        .where(models.Product.id == product.id)
+        .values(category_id=second.id)
+    )
+    crud.bump_catalog_version(db)
+    db.commit()
+    cube.refresh()
+    assert revenue(cube, first) == []
+    assert revenue(cube, second.id) == [(DAY, 10.0)]
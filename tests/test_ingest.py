@@ -0,0 +1,137 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import pytest
+from sqlalchemy.exc import DataError, OperationalError
+
+import ingest
+from ingest import SaleIngestQueue, Spool
+import schemas
+
+
+def sale(product_id=1, quantity=1):
+    return schemas.SaleCreate(
+        product_id=product_id,
+        channel="web",
+        quantity=quantity,
+        price=2.5,
+        sale_date=datetime(2024, 5, 6, 12),
+    )
+
+
+def test_spool_replays_unwritten_sales_after_a_crash(tmp_path):
+    path = str(tmp_path / "ingest.spool")
+    spool = Spool(path)
+    assert spool.open() == []
+    sizes = [spool.append(sale(quantity=n)) for n in (1, 2, 3)]
+    spool.commit(sizes[0], empty=False)
+    # Crash: the process ends without writing the rest
+    spool.close()
+
+    spool = Spool(path)
+    replayed = spool.open()
+    assert [(s.quantity, size) for s, size in replayed] == [
+        (2, sizes[1]),
+        (3, sizes[2]),
+    ]
+    spool.commit(sizes[1] + sizes[2], empty=True)
+    spool.close()
+    assert Spool(path).open() == []
+
+
+def test_spool_ignores_a_torn_line_and_a_stale_offset(tmp_path):
+    path = str(tmp_path / "ingest.spool")
+    spool = Spool(path)
+    spool.open()
+    spool.append(sale(quantity=1))
+    spool.file.write(b'{"product_id": 1, "chan')
+    spool.close()
+    # A crash between emptying the file and resetting the offset
+    with open(path + ".offset", "w") as f:
+        f.write("100000")
+
+    spool = Spool(path)
+    replayed = spool.open()
+    spool.close()
+    assert [s.quantity for s, _ in replayed] == [1]
+    # The torn line is cut off, so later appends start on a line of their own
+    with open(path, "rb") as f:
+        assert f.read().endswith(b"}\n")
+
+
+@pytest.fixture
+def database_calls(monkeypatch):
+    # The batches handed to crud.bulk_create_sales; writer(sales) stands in
+    # for it and may raise
+    calls = []
+    state = {"writer": None}
+
+    @asynccontextmanager
+    async def session_scope():
+        yield None
+
+    async def run_db(db, fn, sales):
+        calls.append(list(sales))
+        return state["writer"](sales)
+
+    monkeypatch.setattr(ingest, "session_scope", session_scope)
+    monkeypatch.setattr(ingest, "run_db", run_db)
+    monkeypatch.setattr(ingest, "INGEST_RETRY_SECONDS", (0,))
+
+    def use(writer):
+        state["writer"] = writer
+        return calls
+
+    return use
+
+
+def inserted_all(sales):
+    return {"inserted": len(sales), "errors": []}
+
+
+def test_write_retries_transient_errors(database_calls):
+    failures = [OperationalError("INSERT", {}, Exception("server closed"))]
+
+    def writer(sales):
+        if failures:
+            raise failures.pop()
+        return inserted_all(sales)
+
+    calls = database_calls(writer)
+    queue = SaleIngestQueue(10, 10, 0)
+    result = asyncio.run(queue.write([sale(), sale()]))
+    assert result == {"inserted": 2, "errors": []}
+    assert [len(batch) for batch in calls] == [2, 2]
+
+
+def test_write_does_not_retry_permanent_errors(database_calls):
+    def writer(sales):
+        raise DataError("INSERT", {}, Exception("integer out of range"))
+
+    calls = database_calls(writer)
+    queue = SaleIngestQueue(10, 10, 0)
+    result = asyncio.run(queue.write([sale()]))
+    assert result == {
+        "inserted": 0,
+        "errors": [{"index": 0, "detail": "integer out of range"}],
+    }
+    assert len(calls) == 1
+
+
+def test_write_isolates_the_failing_sale(database_calls):
+    bad = 2**40
+
+    def writer(sales):
+        if any(s.product_id == bad for s in sales):
+            raise DataError("INSERT", {}, Exception("integer out of range"))
+        return inserted_all(sales)
+
+    database_calls(writer)
+    batch = [sale(product_id=bad if i == 5 else 1) for i in range(8)]
+    queue = SaleIngestQueue(10, 10, 0)
+    result = asyncio.run(queue.write(batch))
+    assert result == {
+        "inserted": 7,
+        "errors": [{"index": 5, "detail": "integer out of range"}],
+    }
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select, update
+
+from database import crud
+from database.snapshots import compact
+import database.models as models
+import schemas
+
+
+def test_create_inventory_replaces_existing_item(db, product):
+    item = schemas.InventoryCreate(
+        product_id=product.id, channel="web", quantity=5, reorder_level=2
+    )
+    first = crud.create_inventory(db, item)
+    second = crud.create_inventory(db, item.copy(update={"quantity": 12}))
+
+    assert second["id"] == first["id"]
+    assert second["quantity"] == 12
+    history = db.execute(
+        select(models.InventoryHistory.change_qty, models.InventoryHistory.comment)
+        .where(models.InventoryHistory.inventory_id == first["id"])
+        .order_by(models.InventoryHistory.id)
+    ).all()
+    assert history == [(5, "Initial stock"), (7, "Stock replaced")]
+
+
+def test_inventory_as_of_around_a_snapshot(database, db, product):
+    def day(n):
+        return datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(days=n)
+
+    item = crud.create_inventory(
+        db,
+        schemas.InventoryCreate(
+            product_id=product.id, channel="web", quantity=10, reorder_level=2
+        ),
+    )
+    history = models.InventoryHistory
+    db.execute(
+        update(history)
+        .where(history.inventory_id == item["id"])
+        .values(timestamp=day(1))
+    )
+    for n, change in ((2, 5), (3, -3), (4, -4)):
+        db.add(history(inventory_id=item["id"], change_qty=change, timestamp=day(n)))
+    db.get(models.Inventory, item["id"]).quantity = 8
+    db.commit()
+
+    # Every third row of the ledger: one snapshot, after the day 3 adjustment
+    compact(database, every=3)
+    snapshots = db.execute(
+        select(
+            models.InventorySnapshot.taken_at, models.InventorySnapshot.quantity
+        ).where(models.InventorySnapshot.inventory_id == item["id"])
+    ).all()
+    assert snapshots == [(day(3), 12)]
+
+    db.add(history(inventory_id=item["id"], change_qty=2, timestamp=day(5)))
+    db.get(models.Inventory, item["id"]).quantity = 10
+    db.commit()
+
+    def as_of(ts):
+        (row,) = crud.inventory_as_of(db, ts, product.id)
+        return row["quantity"]
+
+    # Before the snapshot the ledger is replayed backward from it, after it
+    # forward, and past the newest row the current quantity is returned
+    assert as_of(day(0)) == 0
+    assert as_of(day(1.5)) == 10
+    assert as_of(day(2.5)) == 15
+    assert as_of(day(3)) == 12
+    assert as_of(day(3.5)) == 12
+    assert as_of(day(4.5)) == 8
+    assert as_of(day(6)) == 10
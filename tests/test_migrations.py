@@ -0,0 +1,139 @@
+import uuid
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from database.migrations import MIGRATIONS, migrate
+from database.models import Base
+from database.partitions import ensure_future_partitions
+
+# The schema before versioned migrations, as the first release created it
+BASELINE_SCHEMA = [
+    "CREATE TABLE categories (id serial PRIMARY KEY, name varchar NOT NULL)",
+    "CREATE UNIQUE INDEX ix_categories_name ON categories (name)",
+    "CREATE TABLE products (id serial PRIMARY KEY, name varchar NOT NULL,"
+    " description varchar, price double precision NOT NULL,"
+    " category_id integer NOT NULL REFERENCES categories (id))",
+    "CREATE INDEX ix_products_name ON products (name)",
+    "CREATE INDEX ix_products_category_id ON products (category_id)",
+    "CREATE TABLE inventory (id serial PRIMARY KEY,"
+    " product_id integer NOT NULL REFERENCES products (id),"
+    " channel varchar NOT NULL, quantity integer NOT NULL,"
+    " reorder_level integer NOT NULL, last_updated timestamptz DEFAULT now(),"
+    " CONSTRAINT uix_product_channel UNIQUE (product_id, channel))",
+    "CREATE INDEX ix_inventory_product_id ON inventory (product_id)",
+    "CREATE TABLE inventory_history (id serial PRIMARY KEY,"
+    " inventory_id integer NOT NULL REFERENCES inventory (id),"
+    " change_qty integer NOT NULL, timestamp timestamptz DEFAULT now(),"
+    " comment varchar)",
+    "CREATE INDEX ix_inventory_history_inventory_id"
+    " ON inventory_history (inventory_id)",
+    "CREATE TABLE sales (id serial PRIMARY KEY,"
+    " product_id integer NOT NULL REFERENCES products (id),"
+    " channel varchar NOT NULL, quantity integer NOT NULL,"
+    " price double precision NOT NULL, sale_date timestamp NOT NULL DEFAULT now())",
+    "CREATE INDEX ix_sales_product_id ON sales (product_id)",
+    "CREATE INDEX ix_sales_channel ON sales (channel)",
+    "CREATE INDEX ix_sales_sale_date ON sales (sale_date)",
+]
+BASELINE_ROWS = [
+    "INSERT INTO categories (name) VALUES ('Books')",
+    "INSERT INTO products (name, price, category_id) VALUES ('Atlas', 20, 1)",
+    "INSERT INTO inventory (product_id, channel, quantity, reorder_level)"
+    " VALUES (1, 'web', 50, 5)",
+    "INSERT INTO inventory_history (inventory_id, change_qty, comment)"
+    " VALUES (1, 50, 'Initial stock')",
+    "INSERT INTO sales (product_id, channel, quantity, price, sale_date) VALUES"
+    " (1, 'web', 1, 20, '2024-01-15 10:00'), (1, 'web', 2, 40, '2024-01-20 11:00'),"
+    " (1, 'web', 1, 20, '2024-02-10 12:00'), (1, 'web', 3, 60, '2024-03-05 09:00')",
+]
+
+
+@pytest.fixture
+def baseline(database):
+    # A scratch database holding the baseline schema with rows in it
+    name = f"{database.url.database}_upgrade_{uuid.uuid4().hex[:8]}"
+    with database.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT")
+        conn.execute(text(f'CREATE DATABASE "{name}"'))
+    scratch = create_engine(database.url.set(database=name))
+    try:
+        with scratch.begin() as conn:
+            for statement in BASELINE_SCHEMA + BASELINE_ROWS:
+                conn.execute(text(statement))
+        yield scratch
+    finally:
+        scratch.dispose()
+        with database.connect() as conn:
+            conn.execution_options(isolation_level="AUTOCOMMIT")
+            conn.execute(text(f'DROP DATABASE "{name}" WITH (FORCE)'))
+
+
+def upgrade(engine):
+    # What python -m database.migrations runs (init_db with offline=True)
+    Base.metadata.create_all(bind=engine)
+    migrate(engine, offline=True)
+    ensure_future_partitions(engine)
+
+
+def test_startup_refuses_offline_migrations(baseline):
+    Base.metadata.create_all(bind=baseline)
+    with pytest.raises(RuntimeError, match="python -m database.migrations"):
+        migrate(baseline)
+
+
+def test_offline_upgrade_of_populated_database(baseline):
+    upgrade(baseline)
+    with baseline.connect() as conn:
+        applied = list(
+            conn.scalars(text("SELECT version FROM schema_migrations ORDER BY 1"))
+        )
+        invalid = conn.scalar(
+            text("SELECT count(*) FROM pg_index WHERE NOT indisvalid")
+        )
+        indexes = set(
+            conn.scalars(
+                text("SELECT indexname FROM pg_indexes WHERE tablename = 'sales'")
+            )
+        )
+    assert applied == [version for version, _, _ in MIGRATIONS]
+    assert invalid == 0
+    assert {
+        "ix_sales_sale_date_id",
+        "ix_sales_channel_sale_date_id",
+        "ix_sales_product_sale_date_id",
+        "ix_sales_sale_date_brin",
+    } <= indexes
+    assert not indexes & {"ix_sales_channel", "ix_sales_product_id"}
+    # Running it again finds nothing to do
+    upgrade(baseline)
+
+
+def test_offline_upgrade_partitions_existing_sales(baseline):
+    upgrade(baseline)
+    with baseline.begin() as conn:
+        kind = conn.scalar(text("SELECT relkind FROM pg_class WHERE relname = 'sales'"))
+        placed = dict(
+            conn.execute(
+                text(
+                    "SELECT tableoid::regclass::text, count(*) FROM sales"
+                    " GROUP BY 1 ORDER BY 1"
+                )
+            ).all()
+        )
+        recorded = conn.scalar(
+            text("SELECT count(*) FROM schema_migrations WHERE version = 2")
+        )
+        legacy = conn.scalar(text("SELECT to_regclass('sales_legacy')"))
+        next_id = conn.scalar(
+            text(
+                "INSERT INTO sales (product_id, channel, quantity, price, sale_date)"
+                " VALUES (1, 'web', 1, 20, '2024-03-06') RETURNING id"
+            )
+        )
+    assert kind == "p"
+    assert placed == {"sales_2024_01": 2, "sales_2024_02": 1, "sales_2024_03": 1}
+    assert recorded == 1
+    assert legacy is None
+    # Numbering continues after the copied rows
+    assert next_id == 5
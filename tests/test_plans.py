@@ -0,0 +1,28 @@
+import json
+
+import pytest
+
+from database.check_plans import (
+    READ_CASES,
+    case_scans,
+    prefer_indexes,
+    sample_parameters,
+)
+from database.database import SessionLocal
+
+
+@pytest.fixture(scope="module")
+def plan_session(database):
+    db = SessionLocal()
+    params = sample_parameters(db)
+    prefer_indexes(db)
+    yield db, params
+    db.rollback()
+    db.close()
+
+
+@pytest.mark.parametrize("name", READ_CASES)
+def test_read_query_is_served_by_an_index(plan_session, name):
+    db, params = plan_session
+    scans, plans = case_scans(db, params, name)
+    assert not scans, json.dumps(plans, indent=2)